@@ -0,0 +1,344 @@
+import json
+import os
+import random
+import socket
+import struct
+import threading
+import time
+
+from pyroute2.netlink.rtnl.marshal import MarshalRtnl
+
+from freifunk_telemetry import batadv
+from freifunk_telemetry.conntrack import NFGENMSG, NFNL_SUBSYS_CTNETLINK, IPCTNL_MSG_CT_GET
+from freifunk_telemetry.netlink import NLMSGHDR, NLMSG_DONE, NLMSG_ERROR, pack_attr
+
+DEV_HEADER = (
+    'Inter-|   Receive                                                |  Transmit\n'
+    ' face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo colls carrier '
+    'compressed\n'
+)
+
+
+def proc_net_dev(interfaces):
+    "a /proc/net/dev with `interfaces` devices, half of them exported"
+    lines = [DEV_HEADER]
+    for i in range(interfaces):
+        name = 'gw%04d-vpn' % i if i % 2 else 'veth%04d' % i
+        counters = ' '.join(str(random.randint(0, 2 ** 40)) for _ in range(16))
+        lines.append('%16s: %s\n' % (name, counters))
+    return ''.join(lines)
+
+
+def fastd_status(peers, online_ratio=0.6):
+    "a fastd status socket document with `peers` peers"
+    def statistics(scale):
+        return {key: {'packets': random.randint(0, scale), 'bytes': random.randint(0, scale * 1000)}
+                for key in ['rx', 'rx_reordered', 'tx', 'tx_dropped', 'tx_error']}
+
+    document = {
+        'uptime': 25593405,
+        'statistics': statistics(2 ** 32),
+        'peers': {},
+    }
+    for i in range(peers):
+        connection = None
+        if random.random() < online_ratio:
+            connection = {
+                'established': random.randint(0, 30 * 24 * 3600 * 1000),
+                'method': 'salsa2012+umac',
+                'statistics': statistics(2 ** 24),
+                'mac_addresses': ['da:ff:61:%02x:%02x:03' % (i // 256 % 256, i % 256)],
+            }
+        document['peers']['%064x' % random.getrandbits(256)] = {
+            'name': 'node-%d' % i,
+            'address': '[2001:db8::%x]:10000' % i,
+            'connection': connection,
+        }
+    return json.dumps(document, indent=2).encode('utf-8')
+
+
+def dhcpd_leases(leases, now=None):
+    "a dhcpd.leases with `leases` blocks for a /16, so addresses get renewed"
+    if now is None:
+        now = time.time()
+    blocks = []
+    for i in range(leases):
+        starts = now - random.randint(0, 3600)
+        ends = starts + 600
+        blocks.append(
+            'lease 10.%d.%d.%d {\n'
+            '  starts %s;\n'
+            '  ends %s;\n'
+            '  cltt %s;\n'
+            '  binding state %s;\n'
+            '  next binding state free;\n'
+            '  hardware ethernet 02:00:00:%02x:%02x:%02x;\n'
+            '  uid "\\001\\002\\000\\000\\000\\000\\000";\n'
+            '  client-hostname "node-%d";\n'
+            '}\n' % (
+                (i >> 16) % 256, (i >> 8) % 256, i % 256,
+                time.strftime('%w %Y/%m/%d %H:%M:%S', time.gmtime(starts)),
+                time.strftime('%w %Y/%m/%d %H:%M:%S', time.gmtime(ends)),
+                time.strftime('%w %Y/%m/%d %H:%M:%S', time.gmtime(starts)),
+                random.choice(['active', 'active', 'free']),
+                (i >> 16) % 256, (i >> 8) % 256, i % 256,
+                i,
+            )
+        )
+    return ''.join(blocks)
+
+
+def nla(attr_type, payload, nested=False):
+    data = struct.pack('=HH', 4 + len(payload), attr_type | (0x8000 if nested else 0)) + payload
+    return data + bytes(-len(data) % 4)
+
+
+def ctnetlink_message(seq, family, proto, state=None, zone=0):
+    "a conntrack entry like the kernel dumps it, with addresses, ports, timeout and counters"
+    addresses = nla(1, bytes(4)) + nla(2, bytes(4)) if family == socket.AF_INET else nla(3, bytes(16)) + nla(4, bytes(16))
+    ports = nla(2, struct.pack('>H', 1234)) + nla(3, struct.pack('>H', 443))
+    tuple_payload = nla(1, addresses, True) + nla(2, nla(1, bytes([proto])) + ports, True)
+    payload = nla(1, tuple_payload, True) + nla(2, tuple_payload, True)
+    payload += nla(3, struct.pack('>I', 0x18e)) + nla(7, struct.pack('>I', 431999))
+    if state is not None:
+        payload += nla(4, nla(1, nla(1, bytes([state])) + nla(2, b'\x07') + nla(3, b'\x07'), True), True)
+    payload += nla(8, bytes(4)) + nla(11, bytes(4)) + nla(12, struct.pack('>I', random.getrandbits(32)))
+    if zone:
+        payload += nla(18, struct.pack('>H', zone))
+    length = NLMSGHDR.size + NFGENMSG.size + len(payload)
+    return NLMSGHDR.pack(length, NFNL_SUBSYS_CTNETLINK << 8, 2, seq, 0) + NFGENMSG.pack(family, 0, 0) + payload
+
+
+def neigh_dump(neighbours, family, interfaces=50):
+    "an RTM_NEWNEIGH dump of `neighbours` entries spread over `interfaces`, like the kernel sends it"
+    states = [0x02, 0x02, 0x04, 0x04, 0x04, 0x20, 0x80]  # reachable, stale, failed, permanent
+    size = 4 if family == socket.AF_INET else 16
+    messages = []
+    for _ in range(neighbours):
+        payload = struct.pack('=BxxxiHBB', family, random.randint(1, interfaces), random.choice(states), 0, 1)
+        payload += nla(1, random.getrandbits(8 * size).to_bytes(size, 'big'))
+        payload += nla(2, random.getrandbits(48).to_bytes(6, 'big'))
+        payload += nla(3, struct.pack('=IIII', 1000, 1000, 1000, 0))
+        messages.append(NLMSGHDR.pack(NLMSGHDR.size + len(payload), 28, 2, 0, 0) + payload)
+    messages.append(NLMSGHDR.pack(NLMSGHDR.size + 4, NLMSG_DONE, 2, 0, 0) + bytes(4))
+    return b''.join(messages)
+
+
+class FakeIPRoute:
+    "answers get_neighbours() from prebuilt dumps, parsed by pyroute2's own rtnetlink marshal"
+
+    def __init__(self, dumps):
+        self.dumps = dumps
+        self.marshal = MarshalRtnl()
+
+    def get_neighbours(self, family):
+        return tuple(msg for msg in self.marshal.parse(self.dumps[family]) if msg['header']['type'] == 28)
+
+    def close(self):
+        pass
+
+
+def conntrack_table(entries):
+    "(family, proto, tcp state, zone) of `entries` connections, mostly tcp and udp like on a gateway"
+    table = []
+    for _ in range(entries):
+        proto = random.choice([socket.IPPROTO_TCP] * 6 + [socket.IPPROTO_UDP] * 3 + [socket.IPPROTO_ICMP])
+        state = random.choice([3, 3, 3, 7, 7, 1, 4]) if proto == socket.IPPROTO_TCP else None
+        table.append((random.choice([socket.AF_INET, socket.AF_INET6]), proto, state, random.choice([0, 0, 0, 1])))
+    return table
+
+
+class FakeNetlinkSocket:
+    "answers every dump request with the given (family, proto, tcp state, zone) entries"
+
+    def __init__(self, entries, per_recv=100):
+        messages = [ctnetlink_message(0, *entry) for entry in entries]
+        messages.append(NLMSGHDR.pack(NLMSGHDR.size + 4, NLMSG_DONE, 2, 0, 0) + bytes(4))
+        # (chunk, offsets of the messages in it), like the kernel fills one skb after the other
+        self._dump = []
+        for i in range(0, len(messages), per_recv):
+            chunk = bytearray()
+            offsets = []
+            for message in messages[i:i + per_recv]:
+                offsets.append(len(chunk))
+                chunk += message
+            self._dump.append((chunk, offsets))
+        self._chunks = []
+
+    def send(self, request):
+        _, msg_type, _, seq, _ = NLMSGHDR.unpack_from(request)
+        if msg_type & 0xff != IPCTNL_MSG_CT_GET:
+            # no per-cpu statistics
+            self._chunks = [NLMSGHDR.pack(NLMSGHDR.size + 4, NLMSG_DONE, 2, seq, 0) + bytes(4)]
+            return len(request)
+        for chunk, offsets in self._dump:
+            for offset in offsets:
+                struct.pack_into('=I', chunk, offset + 8, seq)
+        self._chunks = [chunk for chunk, _ in reversed(self._dump)]
+        return len(request)
+
+    def recv_into(self, buffer):
+        chunk = self._chunks.pop()
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+    def close(self):
+        pass
+
+
+def batadv_tables(originators, clients, hardifs=4):
+    "{command: [attributes of every entry]} of a mesh with `originators` nodes and `clients` clients"
+    def mac():
+        return bytes(random.getrandbits(8) for _ in range(6))
+
+    u8 = struct.Struct('=B').pack
+    u32 = struct.Struct('=I').pack
+    best = pack_attr(batadv.ATTR_FLAG_BEST, b'')
+    nodes = [mac() for _ in range(originators)]
+    tables = {
+        batadv.CMD_GET_MESH: [pack_attr(batadv.ATTR_TT_TTVN, u8(1)) + pack_attr(batadv.ATTR_GW_MODE, u8(1))],
+        batadv.CMD_GET_HARDIF: [pack_attr(batadv.ATTR_HARD_IFINDEX, u32(i)) +
+                                pack_attr(batadv.ATTR_HARD_IFNAME, b'mesh%d\0' % i) + pack_attr(batadv.ATTR_ACTIVE, b'')
+                                for i in range(hardifs)],
+        batadv.CMD_GET_ORIGINATORS: [],
+        batadv.CMD_GET_NEIGHBORS: [pack_attr(batadv.ATTR_HARD_IFINDEX, u32(i % hardifs)) for i in range(20)],
+        batadv.CMD_GET_GATEWAYS: [pack_attr(batadv.ATTR_ORIG_ADDRESS, node) + pack_attr(batadv.ATTR_TQ, u8(200)) +
+                                  pack_attr(batadv.ATTR_BANDWIDTH_DOWN, u32(1000)) +
+                                  pack_attr(batadv.ATTR_BANDWIDTH_UP, u32(100)) + (best if i == 0 else b'')
+                                  for i, node in enumerate(nodes[:8])],
+        batadv.CMD_GET_TRANSTABLE_LOCAL: [pack_attr(batadv.ATTR_TT_ADDRESS, mac()) +
+                                          pack_attr(batadv.ATTR_TT_FLAGS, u32(0)) for _ in range(50)],
+        batadv.CMD_GET_TRANSTABLE_GLOBAL: [],
+    }
+    for node in nodes:
+        # a few routes per originator, one of them the best
+        for i in range(3):
+            tables[batadv.CMD_GET_ORIGINATORS].append(
+                pack_attr(batadv.ATTR_ORIG_ADDRESS, node) + pack_attr(batadv.ATTR_NEIGH_ADDRESS, mac()) +
+                pack_attr(batadv.ATTR_HARD_IFINDEX, u32(random.randrange(hardifs))) +
+                pack_attr(batadv.ATTR_LAST_SEEN_MSECS, u32(random.randrange(5000))) +
+                pack_attr(batadv.ATTR_TQ, u8(random.randrange(256))) + (best if i == 0 else b''))
+    for _ in range(clients):
+        tables[batadv.CMD_GET_TRANSTABLE_GLOBAL].append(
+            pack_attr(batadv.ATTR_TT_ADDRESS, mac()) + pack_attr(batadv.ATTR_ORIG_ADDRESS, random.choice(nodes)) +
+            pack_attr(batadv.ATTR_TT_TTVN, u8(1)) + pack_attr(batadv.ATTR_TT_LAST_TTVN, u8(1)) +
+            pack_attr(batadv.ATTR_TT_CRC32, u32(0)) + pack_attr(batadv.ATTR_TT_VID, u32(0)) +
+            pack_attr(batadv.ATTR_TT_FLAGS, u32(random.choice([0, 0, 0x10]))) + best)
+    return tables
+
+
+class FakeGenlSocket:
+    "answers the requests for the batman-adv family and its tables, see `batadv_tables()`"
+
+    FAMILY = 0x21
+
+    def __init__(self, tables, per_recv=100):
+        self._dumps = {}
+        for cmd, entries in tables.items():
+            messages = []
+            for attrs in entries:
+                payload = struct.pack('=BBH', cmd, 1, 0) + attrs
+                messages.append(NLMSGHDR.pack(NLMSGHDR.size + len(payload), self.FAMILY, 2, 0, 0) + payload)
+            self._dumps[cmd] = [bytearray(b''.join(messages[i:i + per_recv]))
+                                for i in range(0, len(messages), per_recv)]
+        self._chunks = []
+
+    def send(self, request):
+        _, msg_type, flags, seq, _ = NLMSGHDR.unpack_from(request)
+        cmd = request[NLMSGHDR.size]
+        if msg_type == batadv.GENL_ID_CTRL:
+            family = pack_attr(batadv.CTRL_ATTR_FAMILY_ID, struct.pack('=H', self.FAMILY))
+            payload = struct.pack('=BBH', 1, 1, 0) + family
+            chunks = [bytearray(NLMSGHDR.pack(NLMSGHDR.size + len(payload), msg_type, 0, 0, 0) + payload)]
+        else:
+            chunks = self._dumps.get(cmd, [])
+        for chunk in chunks:
+            offset = 0
+            while offset < len(chunk):
+                struct.pack_into('=I', chunk, offset + 8, seq)
+                offset += struct.unpack_from('=I', chunk, offset)[0]
+        if flags & 0x300:
+            end = NLMSGHDR.pack(NLMSGHDR.size + 4, NLMSG_DONE, 2, seq, 0) + bytes(4)
+        else:
+            end = NLMSGHDR.pack(NLMSGHDR.size + 4 + len(request[:16]), NLMSG_ERROR, 0, seq, 0) + bytes(4) + \
+                request[:16]
+        self._chunks = [end] + [chunk for chunk in reversed(chunks)]
+        return len(request)
+
+    def recv_into(self, buffer):
+        chunk = self._chunks.pop()
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+    def close(self):
+        pass
+
+
+class FakeFastdSocket(threading.Thread):
+    "serves a status document on a unix socket, like fastd does"
+
+    def __init__(self, filename, content):
+        super().__init__()
+        self.daemon = True
+        self.filename = filename
+        self.content = content
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(filename)
+        self.socket.listen(8)
+        self.socket.settimeout(0.1)
+        self._run = True
+
+    def run(self):
+        while self._run:
+            try:
+                conn, _ = self.socket.accept()
+            except socket.timeout:
+                continue
+            with conn:
+                conn.sendall(self.content)
+
+    def stop(self):
+        self._run = False
+        self.join()
+        self.socket.close()
+        os.unlink(self.filename)
+
+
+class FakeCarbon(threading.Thread):
+    "accepts connections and counts the received bytes and lines"
+
+    def __init__(self):
+        super().__init__()
+        self.daemon = True
+        self.socket = socket.socket()
+        self.socket.bind(('127.0.0.1', 0))
+        self.socket.listen(8)
+        self.socket.settimeout(0.1)
+        self.port = self.socket.getsockname()[1]
+        self.bytes = 0
+        self.lines = 0
+        self._run = True
+
+    def run(self):
+        connections = []
+        while self._run:
+            try:
+                conn, _ = self.socket.accept()
+                conn.setblocking(False)
+                connections.append(conn)
+            except socket.timeout:
+                pass
+            for conn in connections:
+                try:
+                    data = conn.recv(1024 * 1024)
+                except BlockingIOError:
+                    continue
+                self.bytes += len(data)
+                self.lines += data.count(b'\n')
+        for conn in connections:
+            conn.close()
+
+    def stop(self):
+        self._run = False
+        self.join()
+        self.socket.close()
@@ -0,0 +1,344 @@
+"""
+Benchmarks the readers and senders against synthetic data at gateway scale.
+
+    python -m benchmarks.run [--scale 1] [--save results.json] [--compare results.json]
+
+Every benchmark runs in a process of its own and reports the median wall
+time over `--repeat` runs, the memory allocated during a single run
+(tracemalloc peak) and the peak RSS of its process. With `--compare` the medians are checked against an
+earlier `--save`d run and the exit status is 1 if any benchmark got slower
+by more than `--threshold`.
+"""
+import argparse
+import contextlib
+import gc
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import socket
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from unittest import mock
+
+import freifunk_telemetry.batadv
+import freifunk_telemetry.conntrack
+import freifunk_telemetry.dhcp
+import freifunk_telemetry.fastd
+import freifunk_telemetry.network
+from freifunk_telemetry import util
+from freifunk_telemetry.batadv import BatadvNetlink, MeshState
+from freifunk_telemetry.conntrack import ConntrackNetlink
+from freifunk_telemetry.dhcp import LeaseFile
+from freifunk_telemetry.graphite import GraphiteSender, PickleSender
+from freifunk_telemetry.rates import RateCalculator
+from freifunk_telemetry.sample import SampleFilter
+from freifunk_telemetry.sampler import InterfaceSampler
+from freifunk_telemetry.store import TimeSeriesStore
+
+from benchmarks.fixtures import proc_net_dev, fastd_status, dhcpd_leases, conntrack_table, batadv_tables, \
+    neigh_dump, FakeFastdSocket, FakeCarbon, FakeNetlinkSocket, FakeGenlSocket, FakeIPRoute
+
+# at --scale 1, roughly what one of the bigger gateways sees
+INTERFACES = 600
+FAST_INTERFACES = 8
+PEERS = 5000
+LEASES = 40000
+NEIGHBOURS = 20000
+CONNTRACK_ENTRIES = 100000
+ORIGINATORS = 1000
+MESH_CLIENTS = 20000
+
+
+def measure(func, repeat):
+    "returns the median wall time, the tracemalloc peak of one run and the peak rss of the process"
+    func()  # warm up caches, as the daemon would have
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    # kilobytes on linux
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return {
+        'time': statistics.median(times),
+        'allocated': peak,
+        'peak_rss': rss,
+    }
+
+
+@contextlib.contextmanager
+def proc_files(directory, files):
+    "redirects read_proc() for the given /proc paths to files in `directory`"
+    mapping = {}
+    for path, content in files.items():
+        filename = os.path.join(directory, path.strip('/').replace('/', '_'))
+        with open(filename, 'w') as fh:
+            fh.write(content)
+        mapping[path] = filename
+
+    def read_proc(filename):
+        return util.read_proc(mapping.get(filename, filename))
+
+    with mock.patch('freifunk_telemetry.network.read_proc', read_proc):
+        yield
+
+
+def bench_interface_counters(directory, scale, repeat):
+    with proc_files(directory, {'/proc/net/dev': proc_net_dev(INTERFACES * scale)}):
+        return measure(lambda: freifunk_telemetry.network.read_interface_counters({}), repeat)
+
+
+def bench_interface_sampler(directory, scale, repeat):
+    for i in range(FAST_INTERFACES * scale):
+        os.makedirs(os.path.join(directory, 'tun-%d' % i, 'statistics'))
+        for counter in ['rx_bytes', 'tx_bytes', 'rx_packets', 'tx_packets']:
+            with open(os.path.join(directory, 'tun-%d' % i, 'statistics', counter), 'w') as fh:
+                fh.write('%d\n' % random.randint(0, 2 ** 40))
+    # a single sample, the sampler takes one every second
+    sampler = InterfaceSampler(['tun-*'], capacity=120, sysfs=directory)
+    clock = iter(range(10 ** 9))
+    try:
+        return measure(lambda: sampler.sample(next(clock)), repeat)
+    finally:
+        sampler.close()
+
+
+def bench_rates(directory, scale, repeat):
+    update = {}
+    with proc_files(directory, {'/proc/net/dev': proc_net_dev(INTERFACES * scale)}):
+        freifunk_telemetry.network.read_interface_counters(update)
+
+    calculator = RateCalculator()
+    clock = iter(range(1, 1 << 30))
+    return measure(lambda: calculator.process(update, next(clock)), repeat)
+
+
+def bench_sample_filter(directory, scale, repeat):
+    update = {}
+    with proc_files(directory, {'/proc/net/dev': proc_net_dev(INTERFACES * scale)}):
+        freifunk_telemetry.network.read_interface_counters(update)
+
+    sample_filter = SampleFilter(exclude=['*.compressed'], skip_zero=True)
+    return measure(lambda: sample_filter.process(update, 0), repeat)
+
+
+def bench_store(directory, scale, repeat):
+    update = {}
+    with proc_files(directory, {'/proc/net/dev': proc_net_dev(INTERFACES * scale)}):
+        freifunk_telemetry.network.read_interface_counters(update)
+
+    # six hours at one minute, an append costs the same however full the store is
+    store = TimeSeriesStore(os.path.join(directory, 'store'), slots=360, max_series=len(update))
+    clock = iter(range(1, 1 << 30))
+    try:
+        return measure(lambda: store.send(update, next(clock)), repeat)
+    finally:
+        store.close()
+
+
+def bench_neigh(directory, scale, repeat):
+    # half the neighbours in each family, over 50 interfaces
+    ip_route = FakeIPRoute({family: neigh_dump(NEIGHBOURS * scale // 2, family)
+                            for family in [socket.AF_INET, socket.AF_INET6]})
+    thresholds = {'/proc/sys/net/%s/neigh/default/gc_thresh%d' % (label, i): '%d\n' % (1024 * i)
+                  for label in ['ipv4', 'ipv6'] for i in [1, 2, 3]}
+    interfaces = [(i, 'eth%d' % i) for i in range(1, 51)]
+    with proc_files(directory, thresholds), \
+            mock.patch('freifunk_telemetry.network._ip_route', ip_route), \
+            mock.patch('freifunk_telemetry.network.socket.if_nameindex', lambda: interfaces):
+        return measure(lambda: freifunk_telemetry.network.read_neigh({}), repeat)
+
+
+def bench_conntrack(directory, scale, repeat):
+    sock = FakeNetlinkSocket(conntrack_table(CONNTRACK_ENTRIES * scale))
+    with mock.patch('freifunk_telemetry.conntrack._conntrack', ConntrackNetlink(sock=sock)):
+        return measure(lambda: freifunk_telemetry.conntrack.read_conntrack_table({}), repeat)
+
+
+def bench_batadv(scale, repeat, cached):
+    batadv = BatadvNetlink(sock=FakeGenlSocket(batadv_tables(ORIGINATORS * scale, MESH_CLIENTS * scale)))
+    state = MeshState()
+    freifunk_telemetry.batadv.read_mesh(batadv, 'bat0', 1, state, {}, 0)
+
+    def read():
+        freifunk_telemetry.batadv.read_mesh(batadv, 'bat0', 1, state if cached else MeshState(), {}, 0)
+
+    return measure(read, repeat)
+
+
+def bench_dhcp_full(directory, scale, repeat):
+    filename = os.path.join(directory, 'dhcpd.leases')
+    with open(filename, 'w') as fh:
+        fh.write(dhcpd_leases(LEASES * scale))
+
+    def parse():
+        lease_file = LeaseFile(filename)
+        lease_file.update()
+        lease_file.counts()
+
+    return measure(parse, repeat)
+
+
+def bench_dhcp_incremental(directory, scale, repeat):
+    filename = os.path.join(directory, 'dhcpd.leases')
+    with open(filename, 'w') as fh:
+        fh.write(dhcpd_leases(LEASES * scale))
+    lease_file = LeaseFile(filename)
+    lease_file.update()
+    # about one renewal per 300 leases and reporting interval
+    renewals = dhcpd_leases(max(LEASES * scale // 300, 1))
+
+    def append():
+        with open(filename, 'a') as fh:
+            fh.write(renewals)
+        lease_file.update()
+        lease_file.counts()
+
+    return measure(append, repeat)
+
+
+def bench_fastd(directory, scale, repeat):
+    servers = [
+        FakeFastdSocket(os.path.join(directory, 'fastd-%s.sock' % instance), fastd_status(PEERS * scale // 2))
+        for instance in ['ffda-vpn', 'ffda-vpn1']
+    ]
+    for server in servers:
+        server.start()
+    try:
+        with mock.patch('freifunk_telemetry.fastd.SOCKET_GLOB', os.path.join(directory, 'fastd-*.sock')), \
+                mock.patch('freifunk_telemetry.fastd.get_fastd_process_stats', return_value={}):
+            return measure(lambda: freifunk_telemetry.fastd.read_fastd({}), repeat)
+    finally:
+        for server in servers:
+            server.stop()
+
+
+def bench_sender(sender_class, scale, repeat):
+    update = {}
+    with tempfile.TemporaryDirectory() as directory:
+        with proc_files(directory, {'/proc/net/dev': proc_net_dev(INTERFACES * scale)}):
+            freifunk_telemetry.network.read_interface_counters(update)
+
+    carbon = FakeCarbon()
+    carbon.start()
+    sender = sender_class('127.0.0.1', carbon.port, hostname='bench')
+    try:
+        def send():
+            sender.send(update)
+            if not sender.flush():
+                raise RuntimeError('sending to the fake carbon failed')
+        return measure(send, repeat)
+    finally:
+        sender.close()
+        carbon.stop()
+
+
+BENCHMARKS = [
+    ('interface_counters', bench_interface_counters),
+    ('interface_sampler', bench_interface_sampler),
+    ('rates', bench_rates),
+    ('sample_filter', bench_sample_filter),
+    ('store', bench_store),
+    ('neigh', bench_neigh),
+    ('conntrack', bench_conntrack),
+    ('batadv_full', lambda directory, scale, repeat: bench_batadv(scale, repeat, cached=False)),
+    ('batadv_cached', lambda directory, scale, repeat: bench_batadv(scale, repeat, cached=True)),
+    ('dhcp_full', bench_dhcp_full),
+    ('dhcp_incremental', bench_dhcp_incremental),
+    ('fastd', bench_fastd),
+    ('graphite_plaintext', lambda directory, scale, repeat: bench_sender(GraphiteSender, scale, repeat)),
+    ('graphite_pickle', lambda directory, scale, repeat: bench_sender(PickleSender, scale, repeat)),
+]
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, result in sorted(results.items()):
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        change = result['time'] / previous['time'] - 1
+        print('%-20s %+7.1f%%%s' % (name, change * 100, '  REGRESSION' if change > threshold else ''))
+        if change > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Benchmark freifunk-telemetry against synthetic gateway data')
+    parser.add_argument('--scale', type=int, default=1, help='multiply the fixture sizes by this')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', action='append', metavar='NAME', choices=[name for name, _ in BENCHMARKS],
+                        help='only run this benchmark (may be given more than once)')
+    parser.add_argument('--save', metavar='FILE', help='store the results as JSON')
+    parser.add_argument('--compare', metavar='FILE', help='compare against results stored with --save')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='relative slowdown that counts as a regression (default: %(default)s)')
+    return parser
+
+
+def run_benchmark(name, scale, repeat, seed):
+    random.seed(seed)
+    directory = tempfile.mkdtemp(prefix='ffbench-')
+    try:
+        return dict(BENCHMARKS)[name](directory, scale, repeat)
+    finally:
+        shutil.rmtree(directory)
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+
+    results = {}
+    print('%-20s %10s %12s %12s' % ('benchmark', 'time [ms]', 'alloc [KiB]', 'rss [MiB]'))
+    # ru_maxrss only ever grows, every benchmark gets a fresh process forked from this small one
+    context = multiprocessing.get_context('fork')
+    for name, _ in BENCHMARKS:
+        if args.only and name not in args.only:
+            continue
+        with context.Pool(1) as pool:
+            result = results[name] = pool.apply(run_benchmark, (name, args.scale, args.repeat, args.seed))
+        print('%-20s %10.2f %12d %12.1f' % (
+            name, result['time'] * 1000, result['allocated'] // 1024, result['peak_rss'] / 1024 / 1024))
+
+    if args.save:
+        with open(args.save, 'w') as fh:
+            json.dump({
+                'python': platform.python_version(),
+                'host': socket.gethostname(),
+                'scale': args.scale,
+                'time': time.time(),
+                'results': results,
+            }, fh, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as fh:
+            baseline = json.load(fh)
+        if baseline['scale'] != args.scale:
+            print('warning: comparing against a run with --scale %d' % baseline['scale'], file=sys.stderr)
+        print()
+        if compare(results, baseline['results'], args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,44 +1,464 @@
 #!/usr/bin/env python3
 import argparse
+import importlib
 import logging
+import math
 import pprint
+import sys
+import time
 
-from freifunk_telemetry.dhcp import read_dhcp_leases
-from freifunk_telemetry.fastd import read_from_fastd_socket, get_fastd_process_stats, read_fastd
-from freifunk_telemetry.graphite import write_to_graphite
-from freifunk_telemetry.network import read_interface_counters, read_snmp, read_snmp6, read_conntrack, read_neigh
-from freifunk_telemetry.system import read_context_switches, read_load
+from freifunk_telemetry.daemon import Daemon
+from freifunk_telemetry.graphite import write_to_graphite, GraphiteSender, PickleSender, DEFAULT_HOST, DEFAULT_PREFIX
+from freifunk_telemetry.influxdb import InfluxDBSender
+from freifunk_telemetry.instrumentation import Instrumentation, Profiler
+from freifunk_telemetry.monitor import close_monitor
+from freifunk_telemetry.plugins import get_plugin_specs, parse_plugin_target, LazyPlugin
+from freifunk_telemetry.prometheus import get_exporter, release_exporter
+from freifunk_telemetry.rates import RateCalculator
+from freifunk_telemetry.relay import RelaySender, get_aggregator, close_aggregator, DEFAULT_SUMS, DEFAULT_URL
+from freifunk_telemetry.sample import SampleFilter, normalize_key
+from freifunk_telemetry.sampler import get_sampler, close_sampler
+from freifunk_telemetry.scheduler import Plugin, Scheduler
+from freifunk_telemetry.spool import get_spool, release_spool
+from freifunk_telemetry.statsd import StatsDSender
+from freifunk_telemetry.store import TimeSeriesStore, get_store, release_store, query
 
 logger = logging.getLogger(__name__)
 
 
-def main():
-    parser = argparse.ArgumentParser()
+def lazy_function(module_name, name):
+    "returns a function that imports `module_name` on the first call and calls its `name`"
+    def call(*args, **kwargs):
+        return getattr(importlib.import_module(module_name), name)(*args, **kwargs)
+    call.__name__ = name
+    return call
+
+
+# the plugins pull in psutil and pyroute2, they are only imported when they are used
+read_dhcp_leases = lazy_function('freifunk_telemetry.dhcp', 'read_dhcp_leases')
+read_from_fastd_socket = lazy_function('freifunk_telemetry.fastd', 'read_from_fastd_socket')
+get_fastd_process_stats = lazy_function('freifunk_telemetry.fastd', 'get_fastd_process_stats')
+read_fastd = lazy_function('freifunk_telemetry.fastd', 'read_fastd')
+read_interface_counters = lazy_function('freifunk_telemetry.network', 'read_interface_counters')
+read_snmp = lazy_function('freifunk_telemetry.network', 'read_snmp')
+read_snmp6 = lazy_function('freifunk_telemetry.network', 'read_snmp6')
+read_conntrack = lazy_function('freifunk_telemetry.network', 'read_conntrack')
+read_neigh = lazy_function('freifunk_telemetry.network', 'read_neigh')
+read_context_switches = lazy_function('freifunk_telemetry.system', 'read_context_switches')
+read_load = lazy_function('freifunk_telemetry.system', 'read_load')
+
+
+def parse_plugin_option(value):
+    name, sep, seconds = value.partition('=')
+    if not sep:
+        raise argparse.ArgumentTypeError('expected NAME=SECONDS, got %r' % value)
+    try:
+        return name, float(seconds)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid number of seconds in %r' % value)
+
+
+def parse_dead_band_option(value):
+    pattern, sep, delta = value.rpartition('=')
+    if not sep:
+        raise argparse.ArgumentTypeError('expected GLOB=DELTA[%%], got %r' % value)
+    relative = delta.endswith('%')
+    try:
+        return pattern, float(delta.rstrip('%')), relative
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid dead-band in %r' % value)
+
+
+def parse_cluster_sum_option(value):
+    name, sep, pattern = value.partition('=')
+    if not sep or not name or not pattern:
+        raise argparse.ArgumentTypeError('expected NAME=GLOB, got %r' % value)
+    return name, pattern
+
+
+def parse_duration(value):
+    "seconds, or with an s, m, h or d suffix"
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    multiplier = units.get(value[-1:], None)
+    try:
+        if multiplier is None:
+            return float(value)
+        return float(value[:-1]) * multiplier
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid duration %r' % value)
+
+
+def parse_plugin_option_target(value):
+    try:
+        return parse_plugin_target(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def get_plugins(args):
+    intervals = dict(args.plugin_intervals)
+    timeouts = dict(args.plugin_timeouts)
+    only = set(name for names in args.plugins for name in names.split(',')) if args.plugins else None
+    enabled = set(args.enabled_plugins)
+    disabled = set(args.disabled_plugins)
+
+    def is_enabled(name, default):
+        if name in disabled:
+            return False
+        if only is not None:
+            return name in only
+        return default or name in enabled
+
+    specs = get_plugin_specs(args.extra_plugins, is_enabled)
+    replaced = set(name for spec in specs.values() if is_enabled(spec.name, spec.enabled) for name in spec.replaces)
+    replaced -= enabled | (only or set())
+
+    plugins = []
+    for spec in specs.values():
+        if not is_enabled(spec.name, spec.enabled) or spec.name in replaced:
+            continue
+        plugin = Plugin(LazyPlugin(spec), spec.interval or args.interval, spec.timeout, name=spec.name)
+        plugin.interval = intervals.pop(plugin.name, plugin.interval)
+        plugin.timeout = timeouts.pop(plugin.name, plugin.timeout)
+        plugins.append(plugin)
+
+    for name in (set(intervals) | set(timeouts) | enabled | (only or set())) - set(specs) - disabled:
+        logger.warning('unknown plugin %s', name)
+
+    return plugins
+
+
+def get_backends(args, spool=None, interval=None):
+    "`interval` is how often the backends are sent to, --interval by default"
+    if interval is None:
+        interval = args.interval
+    backends = []
+
+    for output in args.outputs or ['graphite']:
+        if output == 'graphite':
+            kwargs = dict(spool=spool, drain_rate=args.spool_drain_rate, interval=interval)
+            if args.graphite_port is not None:
+                kwargs['port'] = args.graphite_port
+            if args.protocol == 'pickle':
+                backends.append(PickleSender(args.graphite_host, prefix=args.prefix, hostname=args.hostname,
+                                             batch_size=args.pickle_batch_size, **kwargs))
+            else:
+                backends.append(GraphiteSender(args.graphite_host, prefix=args.prefix, hostname=args.hostname,
+                                               **kwargs))
+        elif output == 'influxdb':
+            backends.append(InfluxDBSender(args.influxdb_url, hostname=args.hostname))
+        elif output == 'prometheus':
+            host, _, port = args.prometheus_listen.rpartition(':')
+            backends.append(get_exporter(host.strip('[]'), int(port), prefix=args.prefix))
+        elif output == 'statsd':
+            backends.append(StatsDSender(args.statsd_host, args.statsd_port, prefix=args.prefix,
+                                         hostname=args.hostname))
+        elif output == 'relay':
+            backends.append(RelaySender(args.relay_url, hostname=args.hostname, spool=spool,
+                                        drain_rate=args.spool_drain_rate, interval=interval))
+
+    if args.store:
+        slots = math.ceil(args.store_hours * 3600 / interval)
+        backends.append(get_store(args.store, slots, args.store_series))
+
+    return backends
+
+
+class Collector:
+    def __init__(self, args):
+        stages = []
+        if args.rates != 'off':
+            stages.append(RateCalculator(args.rates))
+        self.filter = SampleFilter(args.include, args.exclude, args.skip_zero, args.skip_unchanged,
+                                   args.dead_bands, args.heartbeat)
+        stages.append(self.filter)
+        self.instrumentation = Instrumentation()
+        self.profiler = None
+        if args.profile_dir:
+            self.profiler = Profiler(args.profile_dir)
+        plugins = get_plugins(args)
+        if not any(plugin.name == 'netlink_events' for plugin in plugins):
+            # e.g. switched off by a reload, stop following the events
+            close_monitor()
+        self.scheduler = Scheduler(plugins, stages, self.instrumentation, self.profiler)
+        # e.g. only relaying the metrics of other gateways
+        self.interval = self.scheduler.interval or args.interval
+        self.jitter = args.jitter
+        self.test = args.test
+        self.aggregator = None
+        if args.aggregate:
+            host, _, port = args.aggregate.rpartition(':')
+            self.aggregator = get_aggregator(host.strip('[]'), int(port))
+        self.cluster_sums = args.cluster_sums or DEFAULT_SUMS
+        self.cluster_max_age = args.cluster_max_age
+        if self.cluster_max_age is None:
+            # assuming the gateways run with the same settings, every series is sent at least every longest
+            # plugin interval, or every heartbeat'th of those if unchanged values are held back. The
+            # aggregator itself may not run the plugins, e.g. dhcp_leases, so all known ones count.
+            intervals = dict(args.plugin_intervals)
+            longest = max([intervals.get(spec.name, spec.interval or args.interval)
+                           for spec in get_plugin_specs(args.extra_plugins, entry_points=False).values()] +
+                          [self.interval])
+            if (args.skip_unchanged or args.dead_bands) and args.heartbeat:
+                longest *= args.heartbeat
+            self.cluster_max_age = 3 * longest
+        self.cluster_hostname = args.cluster_hostname
+        self.sampler = None
+        if args.fast_interfaces:
+            # room for two reporting intervals, in case a collection is late
+            capacity = int(2 * self.interval / args.fast_interval) + 1
+            self.sampler = get_sampler(args.fast_interfaces, args.fast_interval, capacity)
+        self.spool = None
+        self.backends = []
+        if not self.test:
+            if args.spool:
+                self.spool = get_spool(args.spool, args.spool_size)
+            self.backends = get_backends(args, self.spool, self.interval)
+
+    def run(self, force=False):
+        if self.profiler is not None:
+            self.profiler.poll()
+
+        batches = self.scheduler.run(force=force)
+        relayed = []
+        if self.aggregator is not None:
+            relayed = self.aggregator.drain()
+            sums = self.aggregator.sums(self.cluster_sums, self.cluster_max_age)
+            relayed.append((self.cluster_hostname, time.time(), sums))
+        if not batches and not relayed:
+            return
+
+        now = time.monotonic()
+        # what other gateways sent is checked like the local samples, they may send anything
+        relayed = [(normalize_key(hostname), timestamp, self.filter.process(data, now, hostname))
+                   for hostname, timestamp, data in relayed if hostname]
+        if self.sampler is not None:
+            batches.append((time.time(), self.filter.process(self.sampler.report(), now)))
+        if self.spool is not None:
+            batches.append((time.time(), self.filter.process(self.spool.stats(), now)))
+        if self.aggregator is not None:
+            batches.append((time.time(), self.filter.process(self.aggregator.stats(), now)))
+        batches.append((time.time(), self.filter.process(self.instrumentation.stats(self.backends), now)))
+
+        if self.test:
+            update = {}
+            for timestamp, data in batches:
+                update.update(data)
+            for hostname, timestamp, data in relayed:
+                update.update(('%s.%s' % (hostname, key), value) for key, value in data.items())
+            pprint.pprint(update)
+            return
+
+        for backend in self.backends:
+            try:
+                if self.profiler is not None:
+                    sent = self.profiler.call(self._send, backend, batches, relayed)
+                else:
+                    sent = self._send(backend, batches, relayed)
+            except Exception as e:
+                logger.exception(e)
+                sent = False
+            if not sent:
+                self.instrumentation.backend_failed(backend.name)
+
+    def _send(self, backend, batches, relayed=()):
+        for timestamp, data in batches:
+            backend.send(data, timestamp)
+        for hostname, timestamp, data in relayed:
+            backend.send(data, timestamp, hostname=hostname)
+        return backend.flush()
+
+    def close(self):
+        if self.profiler is not None:
+            self.profiler.uninstall()
+        self.scheduler.close()
+        # what is shared with the collector of a reload is only released, the senders spool into it on close
+        for backend in self.backends:
+            if backend.name == 'prometheus':
+                release_exporter(backend)
+            elif backend.name == 'store':
+                release_store(backend)
+            else:
+                backend.close()
+        if self.spool is not None:
+            release_spool(self.spool)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
     parser.add_argument('--test', dest='test', action='store_true', default=False,
                         help='run in test mode (echoes output)')
+    parser.add_argument('--daemon', dest='daemon', action='store_true', default=False,
+                        help='keep running and collect every --interval seconds, SIGHUP re-reads @argument files')
+    parser.add_argument('--interval', dest='interval', type=float, default=60,
+                        help='collection interval in seconds in daemon mode (default: %(default)s)')
+    parser.add_argument('--jitter', dest='jitter', type=float, default=5,
+                        help='random delay in seconds before the first collection in daemon mode (default: %(default)s)')
+    parser.add_argument('--plugins', dest='plugins', action='append', default=[], metavar='NAME[,NAME...]',
+                        help='only run these plugins')
+    parser.add_argument('--enable-plugin', dest='enabled_plugins', action='append', default=[], metavar='NAME',
+                        help='run this plugin, which is off by default, e.g. netlink_events, can be given multiple '
+                             'times')
+    parser.add_argument('--disable-plugin', dest='disabled_plugins', action='append', default=[], metavar='NAME',
+                        help='do not run this plugin, can be given multiple times')
+    parser.add_argument('--add-plugin', dest='extra_plugins', type=parse_plugin_option_target, action='append',
+                        default=[], metavar='NAME=MODULE:FUNCTION',
+                        help='run FUNCTION(update) from MODULE as an additional plugin')
+    parser.add_argument('--plugin-interval', dest='plugin_intervals', type=parse_plugin_option, action='append',
+                        default=[], metavar='NAME=SECONDS',
+                        help='collection interval of a single plugin in daemon mode, e.g. dhcp_leases=300')
+    parser.add_argument('--plugin-timeout', dest='plugin_timeouts', type=parse_plugin_option, action='append',
+                        default=[], metavar='NAME=SECONDS',
+                        help='time after which the results of a plugin are given up on, e.g. fastd=5')
+    parser.add_argument('--rates', dest='rates', choices=['off', 'add', 'replace'], default='off',
+                        help='compute per-second rates of counters in daemon mode, and send them as KEY.rate next to '
+                             'the counters (add) or instead of them (replace) (default: %(default)s)')
+    parser.add_argument('--include', dest='include', action='append', default=[], metavar='GLOB',
+                        help='only send metrics matching this pattern, e.g. "ffda-*", can be given multiple times')
+    parser.add_argument('--exclude', dest='exclude', action='append', default=[], metavar='GLOB',
+                        help='do not send metrics matching this pattern, e.g. "ipv6.Icmp6*", can be given multiple '
+                             'times')
+    parser.add_argument('--skip-zero', dest='skip_zero', action='store_true', default=False,
+                        help='do not send series that have never been anything but zero')
+    parser.add_argument('--skip-unchanged', dest='skip_unchanged', action='store_true', default=False,
+                        help='do not send values that did not change since they were last sent')
+    parser.add_argument('--dead-band', dest='dead_bands', type=parse_dead_band_option, action='append', default=[],
+                        metavar='GLOB=DELTA[%]',
+                        help='do not send values of matching series that moved at most DELTA (or DELTA percent) '
+                             'from the last value sent, e.g. "load.*=0.05", can be given multiple times')
+    parser.add_argument('--heartbeat', dest='heartbeat', type=int, default=10, metavar='N',
+                        help='with --skip-unchanged or --dead-band, send every Nth value of a series regardless, '
+                             '0 for never (default: %(default)s)')
+    parser.add_argument('--fast-interface', dest='fast_interfaces', action='append', default=[], metavar='GLOB',
+                        help='sample the byte and packet counters of matching interfaces every --fast-interval '
+                             'seconds and send the min, max, mean and 95th percentile of their rates, e.g. '
+                             '"tun-ffrl-*", can be given multiple times')
+    parser.add_argument('--fast-interval', dest='fast_interval', type=float, default=1, metavar='SECONDS',
+                        help='sampling interval of --fast-interface (default: %(default)s)')
+    parser.add_argument('--output', dest='outputs', action='append',
+                        choices=['graphite', 'influxdb', 'prometheus', 'statsd', 'relay'],
+                        help='where to send the metrics to, can be given multiple times (default: graphite)')
+    parser.add_argument('--graphite-host', dest='graphite_host', default=DEFAULT_HOST,
+                        help='carbon host to send the metrics to (default: %(default)s)')
+    parser.add_argument('--graphite-port', dest='graphite_port', type=int, default=None,
+                        help='carbon port (default: 2013 for plaintext, 2004 for pickle)')
+    parser.add_argument('--protocol', dest='protocol', choices=['plaintext', 'pickle'], default='plaintext',
+                        help='carbon protocol to send the metrics with (default: %(default)s)')
+    parser.add_argument('--pickle-batch-size', dest='pickle_batch_size', type=int, default=500,
+                        help='maximum number of metrics per pickled batch (default: %(default)s)')
+    parser.add_argument('--prefix', dest='prefix', default=DEFAULT_PREFIX,
+                        help='metric prefix, the metrics are sent as PREFIX.HOSTNAME.KEY (default: %(default)s)')
+    parser.add_argument('--hostname', dest='hostname', default=None,
+                        help='hostname used in the metric names (default: short hostname of this machine)')
+    parser.add_argument('--spool', dest='spool', default=None, metavar='FILE',
+                        help='keep samples in this file while graphite or the aggregator is unreachable, only '
+                             'with one of them as --output')
+    parser.add_argument('--spool-size', dest='spool_size', type=int, default=16 * 1024 * 1024, metavar='BYTES',
+                        help='size of the spool file, the oldest samples are dropped when it is full '
+                             '(default: %(default)s)')
+    parser.add_argument('--spool-drain-rate', dest='spool_drain_rate', type=int, default=64 * 1024,
+                        metavar='BYTES', help='bytes per second sent from the spool once graphite is reachable again '
+                                              '(default: %(default)s)')
+    parser.add_argument('--store', dest='store', default=None, metavar='FILE',
+                        help='also keep the recent values of every series in this file, for "query"')
+    parser.add_argument('--store-hours', dest='store_hours', type=float, default=6, metavar='HOURS',
+                        help='how long the values are kept in --store (default: %(default)s)')
+    parser.add_argument('--store-series', dest='store_series', type=int, default=4096, metavar='N',
+                        help='maximum number of series in --store, further ones are dropped (default: %(default)s)')
+    parser.add_argument('--influxdb-url', dest='influxdb_url', default='udp://localhost:8089',
+                        help='udp://HOST:PORT or the http write endpoint, e.g. http://localhost:8086/write?db=freifunk '
+                             '(default: %(default)s)')
+    parser.add_argument('--prometheus-listen', dest='prometheus_listen', default=':9185', metavar='[HOST]:PORT',
+                        help='address to serve /metrics on (default: %(default)s)')
+    parser.add_argument('--statsd-host', dest='statsd_host', default='localhost',
+                        help='statsd host (default: %(default)s)')
+    parser.add_argument('--statsd-port', dest='statsd_port', type=int, default=8125,
+                        help='statsd port (default: %(default)s)')
+    parser.add_argument('--relay-url', dest='relay_url', default=DEFAULT_URL,
+                        help='tcp://HOST:PORT or udp://HOST:PORT of the aggregator to relay the metrics through '
+                             '(default: %(default)s)')
+    parser.add_argument('--aggregate', dest='aggregate', default=None, metavar='[HOST]:PORT',
+                        help='receive the metrics of other gateways relayed to this address over tcp and udp, and '
+                             'send them on to the outputs')
+    parser.add_argument('--cluster-sum', dest='cluster_sums', type=parse_cluster_sum_option, action='append',
+                        default=[], metavar='NAME=GLOB',
+                        help='with --aggregate, send the sum of the latest values matching GLOB of all gateways as '
+                             'NAME, e.g. "fastd.peers.online=fastd.*.peers.online", can be given multiple times '
+                             '(default: fastd peers and dhcp leases)')
+    parser.add_argument('--cluster-max-age', dest='cluster_max_age', type=float, default=None, metavar='SECONDS',
+                        help='leave values out of the --cluster-sum once a gateway hasn\'t sent them for this long '
+                             '(default: three times the longest plugin interval, e.g. of dhcp_leases, times '
+                             '--heartbeat with --skip-unchanged or --dead-band)')
+    parser.add_argument('--cluster-hostname', dest='cluster_hostname', default='cluster',
+                        help='hostname the --cluster-sum metrics are sent under (default: %(default)s)')
+    parser.add_argument('--profile-dir', dest='profile_dir', default=None, metavar='DIR',
+                        help='on SIGUSR1 start/stop cpu profiling, on SIGUSR2 start/stop tracing allocations, '
+                             'and write the results to DIR')
+    return parser
+
+
+def get_query_parser():
+    parser = argparse.ArgumentParser(prog='freifunk-telemetry query',
+                                     description='print recent values from a --store file')
+    parser.add_argument('store', metavar='FILE', help='the --store file of the collector')
+    parser.add_argument('patterns', nargs='*', default=['*'], metavar='GLOB',
+                        help='series to print, relayed series start with the hostname (default: all)')
+    parser.add_argument('--since', dest='since', type=parse_duration, default=None, metavar='DURATION',
+                        help='only values from the last DURATION, e.g. 30m or 2h (default: all)')
+    parser.add_argument('--until', dest='until', type=parse_duration, default=None, metavar='DURATION',
+                        help='only values older than DURATION (default: up to now)')
+    parser.add_argument('--rate', dest='rate', action='store_true', default=False,
+                        help='print the per-second increase instead of the values, for counters')
+    return parser
+
+
+def run_query(argv, out=None):
+    args = get_query_parser().parse_args(argv)
+    out = out or sys.stdout
+    now = time.time()
+    store = TimeSeriesStore(args.store, readonly=True)
+    try:
+        since = None if args.since is None else now - args.since
+        until = None if args.until is None else now - args.until
+        for key, timestamp, value in query(store, args.patterns, since, until, args.rate):
+            out.write('%s %s %d\n' % (key, value, timestamp))
+    finally:
+        store.close()
+
+
+def parse_args(parser, argv):
+    args = parser.parse_args(argv)
+    outputs = args.outputs or ['graphite']
+    if args.spool and 'graphite' in outputs and 'relay' in outputs:
+        # each would drain the other's records, in its own wire format
+        parser.error('--spool can only be used with one of --output graphite and --output relay')
+    return args
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv[:1] == ['query']:
+        run_query(argv[1:])
+        return
+
+    parser = get_parser()
+    args = parse_args(parser, argv)
 
-    args = parser.parse_args()
-
-    update = {}
-
-    for plugin in [read_interface_counters,
-                   read_load,
-                   read_neigh,
-                   read_conntrack,
-                   read_snmp,
-                   read_snmp6,
-                   read_context_switches,
-                   read_fastd,
-                   read_dhcp_leases]:
-        try:
-            plugin(update)
-        except Exception as e:
-            logger.exception(e)
-
-    if args.test:
-        pprint.pprint(update)
-    else:
-        write_to_graphite(update)
+    try:
+        if args.daemon:
+            logging.basicConfig(level=logging.INFO)
+            Daemon(lambda: Collector(parse_args(parser, argv))).run()
+        else:
+            collector = Collector(args)
+            try:
+                collector.run(force=True)
+            finally:
+                collector.close()
+    finally:
+        close_aggregator()
+        close_sampler()
+        close_monitor()
 
 
 if __name__ == "__main__":
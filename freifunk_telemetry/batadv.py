@@ -0,0 +1,367 @@
+import os
+import socket
+import struct
+import time
+
+from freifunk_telemetry.netlink import NLA, NLA_TYPE_MASK, NLMSG_DONE, NLMSG_ERROR, request, dump_request, \
+    iter_messages, check_error, iter_attrs, pack_attr
+from freifunk_telemetry.network import DEVICE_NAME_MAPPING
+from freifunk_telemetry.util import read_proc
+
+NETLINK_GENERIC = 16
+GENL_ID_CTRL = 0x10
+CTRL_CMD_GETFAMILY = 3
+CTRL_ATTR_FAMILY_ID = 1
+CTRL_ATTR_FAMILY_NAME = 2
+GENLMSGHDR = struct.Struct('=BBH')
+U16 = struct.Struct('=H')
+U32 = struct.Struct('=I')
+
+# from linux/batman_adv.h
+BATADV_FAMILY = b'batadv'
+CMD_GET_MESH = 1
+CMD_GET_HARDIF = 5
+CMD_GET_TRANSTABLE_LOCAL = 6
+CMD_GET_TRANSTABLE_GLOBAL = 7
+CMD_GET_ORIGINATORS = 8
+CMD_GET_NEIGHBORS = 9
+CMD_GET_GATEWAYS = 10
+
+ATTR_MESH_IFINDEX = 3
+ATTR_HARD_IFINDEX = 6
+ATTR_HARD_IFNAME = 7
+ATTR_ORIG_ADDRESS = 9
+ATTR_ACTIVE = 15
+ATTR_TT_ADDRESS = 16
+ATTR_TT_TTVN = 17
+ATTR_TT_LAST_TTVN = 18
+ATTR_TT_CRC32 = 19
+ATTR_TT_VID = 20
+ATTR_TT_FLAGS = 21
+ATTR_FLAG_BEST = 22
+ATTR_LAST_SEEN_MSECS = 23
+ATTR_NEIGH_ADDRESS = 24
+ATTR_TQ = 25
+ATTR_THROUGHPUT = 26
+ATTR_BANDWIDTH_UP = 27
+ATTR_BANDWIDTH_DOWN = 28
+ATTR_GW_MODE = 51
+
+TT_CLIENT_ROAM = 0x2
+TT_CLIENT_WIFI = 0x10
+TT_CLIENT_NOPURGE = 0x100
+
+# the global translation table is dumped again after this many seconds,
+# or as soon as the number of originators changes
+GLOBAL_TT_MAX_AGE = 300
+
+
+def find_attrs(buffer, offset, end, wanted):
+    """
+    Returns {type: offset of the payload} of the `wanted` attributes.
+
+    Like `conntrack.parse_entry()` this runs for every entry of the tables,
+    so the attributes are walked inline.
+    """
+    found = {}
+    while offset < end:
+        length, attr_type = NLA.unpack_from(buffer, offset)
+        if length < NLA.size:
+            break
+        attr_type &= NLA_TYPE_MASK
+        if attr_type in wanted:
+            found[attr_type] = offset + NLA.size
+        offset += (length + 3) & ~3
+    return found
+
+
+def read_string(buffer, offset, end):
+    return bytes(buffer[offset:end]).split(b'\0', 1)[0].decode('latin-1')
+
+
+class BatadvNetlink:
+    """
+    Dumps the tables of batman-adv over its generic netlink family.
+
+    Like `ConntrackNetlink`, the dumps are read into one reused buffer and
+    only the attributes that are counted are picked out of each entry, no
+    per-entry objects are kept.
+    """
+
+    def __init__(self, buffer_size=1024 * 1024, sock=None):
+        if sock is None:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_GENERIC)
+            sock.bind((0, 0))
+        self._sock = sock
+        self._buffer = bytearray(buffer_size)
+        self._seq = 0
+        self._family = None
+
+    def close(self):
+        self._sock.close()
+
+    def _request(self, msg_type, cmd, attrs, dump=True):
+        "yields (offset, end) of the attributes of every reply, valid until the next one"
+        self._seq += 1
+        seq = self._seq
+        payload = GENLMSGHDR.pack(cmd, 1, 0) + attrs
+        self._sock.send(dump_request(msg_type, seq, payload) if dump else request(msg_type, seq, payload))
+
+        buffer = self._buffer
+        while True:
+            size = self._sock.recv_into(buffer)
+            for nl_type, nl_seq, offset, end in iter_messages(buffer, size):
+                if nl_seq != seq:
+                    continue
+                if nl_type == NLMSG_DONE:
+                    return
+                if nl_type == NLMSG_ERROR:
+                    # an ack ends a request that isn't a dump
+                    check_error(buffer, offset)
+                    return
+                yield offset + GENLMSGHDR.size, end
+
+    @property
+    def family(self):
+        if self._family is None:
+            attrs = pack_attr(CTRL_ATTR_FAMILY_NAME, BATADV_FAMILY + b'\0')
+            for offset, end in self._request(GENL_ID_CTRL, CTRL_CMD_GETFAMILY, attrs, dump=False):
+                for attr_type, payload, _ in iter_attrs(self._buffer, offset, end):
+                    if attr_type == CTRL_ATTR_FAMILY_ID:
+                        self._family = U16.unpack_from(self._buffer, payload)[0]
+            if self._family is None:
+                raise OSError('batman-adv netlink family not found')
+        return self._family
+
+    def _dump(self, cmd, mesh_ifindex, wanted, dump=True):
+        "yields {type: offset of the payload} of the `wanted` attributes of every entry"
+        buffer = self._buffer
+        attrs = pack_attr(ATTR_MESH_IFINDEX, U32.pack(mesh_ifindex))
+        for offset, end in self._request(self.family, cmd, attrs, dump):
+            yield find_attrs(buffer, offset, end, wanted)
+
+    def _u8(self, offset):
+        return self._buffer[offset]
+
+    def _u32(self, offset):
+        return U32.unpack_from(self._buffer, offset)[0]
+
+    def mesh_info(self, mesh_ifindex):
+        "returns (own translation table version, gateway mode), either is None if the kernel doesn't report it"
+        ttvn = gw_mode = None
+        for attrs in self._dump(CMD_GET_MESH, mesh_ifindex, (ATTR_TT_TTVN, ATTR_GW_MODE), dump=False):
+            if ATTR_TT_TTVN in attrs:
+                ttvn = self._u8(attrs[ATTR_TT_TTVN])
+            # only kernels since 5.2 report the configuration
+            if ATTR_GW_MODE in attrs:
+                gw_mode = self._u8(attrs[ATTR_GW_MODE])
+        return ttvn, gw_mode
+
+    def hardifs(self, mesh_ifindex):
+        "returns {ifindex: [name, active]} of the interfaces the mesh runs on"
+        hardifs = {}
+        buffer = self._buffer
+        for attrs in self._dump(CMD_GET_HARDIF, mesh_ifindex, (ATTR_HARD_IFINDEX, ATTR_HARD_IFNAME, ATTR_ACTIVE)):
+            offset = attrs[ATTR_HARD_IFNAME]
+            hardifs[self._u32(attrs[ATTR_HARD_IFINDEX])] = [read_string(buffer, offset, offset + 16),
+                                                            ATTR_ACTIVE in attrs]
+        return hardifs
+
+    def originators(self, mesh_ifindex):
+        "returns {hard ifindex: [best routes, sum of their TQ or throughput]}, and whether it is throughput"
+        routes = {}
+        throughput = False
+        for attrs in self._dump(CMD_GET_ORIGINATORS, mesh_ifindex,
+                                (ATTR_FLAG_BEST, ATTR_HARD_IFINDEX, ATTR_TQ, ATTR_THROUGHPUT)):
+            if ATTR_FLAG_BEST not in attrs:
+                continue
+            if ATTR_THROUGHPUT in attrs:
+                throughput = True
+                metric = self._u32(attrs[ATTR_THROUGHPUT])
+            else:
+                metric = self._u8(attrs[ATTR_TQ]) if ATTR_TQ in attrs else 0
+            route = routes.setdefault(self._u32(attrs[ATTR_HARD_IFINDEX]), [0, 0])
+            route[0] += 1
+            route[1] += metric
+        return routes, throughput
+
+    def neighbours(self, mesh_ifindex):
+        "returns {hard ifindex: number of neighbours}"
+        counts = {}
+        for attrs in self._dump(CMD_GET_NEIGHBORS, mesh_ifindex, (ATTR_HARD_IFINDEX,)):
+            ifindex = self._u32(attrs[ATTR_HARD_IFINDEX])
+            counts[ifindex] = counts.get(ifindex, 0) + 1
+        return counts
+
+    def gateways(self, mesh_ifindex):
+        "returns (number of gateways, (address, TQ or throughput, down, up) of the selected one or None)"
+        count = 0
+        selected = None
+        buffer = self._buffer
+        wanted = (ATTR_FLAG_BEST, ATTR_ORIG_ADDRESS, ATTR_TQ, ATTR_THROUGHPUT, ATTR_BANDWIDTH_DOWN,
+                  ATTR_BANDWIDTH_UP)
+        for attrs in self._dump(CMD_GET_GATEWAYS, mesh_ifindex, wanted):
+            count += 1
+            if ATTR_FLAG_BEST not in attrs:
+                continue
+            offset = attrs[ATTR_ORIG_ADDRESS]
+            if ATTR_THROUGHPUT in attrs:
+                metric = self._u32(attrs[ATTR_THROUGHPUT])
+            else:
+                metric = self._u8(attrs[ATTR_TQ]) if ATTR_TQ in attrs else 0
+            # the bandwidths are announced in 100 kbit/s
+            selected = (bytes(buffer[offset:offset + 6]), metric,
+                        self._u32(attrs[ATTR_BANDWIDTH_DOWN]) * 100 if ATTR_BANDWIDTH_DOWN in attrs else 0,
+                        self._u32(attrs[ATTR_BANDWIDTH_UP]) * 100 if ATTR_BANDWIDTH_UP in attrs else 0)
+        return count, selected
+
+    def local_clients(self, mesh_ifindex):
+        "returns (clients, wifi clients) of the local translation table"
+        clients = wifi = 0
+        for attrs in self._dump(CMD_GET_TRANSTABLE_LOCAL, mesh_ifindex, (ATTR_TT_FLAGS,)):
+            flags = self._u32(attrs[ATTR_TT_FLAGS]) if ATTR_TT_FLAGS in attrs else 0
+            # the mesh interface's own address
+            if flags & TT_CLIENT_NOPURGE:
+                continue
+            clients += 1
+            if flags & TT_CLIENT_WIFI:
+                wifi += 1
+        return clients, wifi
+
+    def global_clients(self, mesh_ifindex):
+        "returns (clients, entries, roaming, wifi) of the global translation table"
+        clients = entries = roaming = wifi = 0
+        for attrs in self._dump(CMD_GET_TRANSTABLE_GLOBAL, mesh_ifindex, (ATTR_FLAG_BEST, ATTR_TT_FLAGS)):
+            entries += 1
+            # a client announced by several originators has an entry for each, one of them the best
+            if ATTR_FLAG_BEST not in attrs:
+                continue
+            clients += 1
+            flags = self._u32(attrs[ATTR_TT_FLAGS]) if ATTR_TT_FLAGS in attrs else 0
+            if flags & TT_CLIENT_ROAM:
+                roaming += 1
+            if flags & TT_CLIENT_WIFI:
+                wifi += 1
+        return clients, entries, roaming, wifi
+
+
+class MeshState:
+    """
+    What is kept of a mesh interface between runs.
+
+    The translation tables are the largest by far, but batman-adv doesn't
+    send events when they change. The local one is only dumped again when
+    the mesh's own table version changed, the global one when the number
+    of originators changed or after GLOBAL_TT_MAX_AGE seconds.
+    """
+
+    def __init__(self):
+        self.ttvn = None
+        self.local_clients = None
+        self.originators = None
+        self.global_clients = None
+        self.global_dumped = 0
+        self.gateway = None
+        self.gateway_changes = 0
+
+
+def is_mesh_interface(name):
+    try:
+        return b'DEVTYPE=batadv\n' in read_proc('/sys/class/net/%s/uevent' % name)
+    except OSError:
+        return False
+
+
+_batadv = None
+# interface name -> MeshState, or None if it isn't a mesh interface
+_meshes = {}
+
+
+def get_batadv():
+    global _batadv
+    if _batadv is None:
+        _batadv = BatadvNetlink()
+    return _batadv
+
+
+def close_batadv():
+    global _batadv
+    if _batadv is not None:
+        _batadv.close()
+        _batadv = None
+
+
+def get_meshes():
+    "returns {name: MeshState} of the mesh interfaces, new interfaces are checked once"
+    names = set(os.listdir('/sys/class/net'))
+    for name in set(_meshes) - names:
+        del _meshes[name]
+    for name in names - set(_meshes):
+        _meshes[name] = MeshState() if is_mesh_interface(name) else None
+    return {name: state for name, state in _meshes.items() if state is not None}
+
+
+def read_mesh(batadv, name, ifindex, state, update, now):
+    prefix = 'batadv.%s' % DEVICE_NAME_MAPPING.get(name, name)
+
+    ttvn, gw_mode = batadv.mesh_info(ifindex)
+    if gw_mode is not None:
+        update['%s.gateways.mode' % prefix] = gw_mode
+
+    hardifs = batadv.hardifs(ifindex)
+    routes, throughput = batadv.originators(ifindex)
+    neighbours = batadv.neighbours(ifindex)
+    originators = sum(count for count, _ in routes.values())
+    update['%s.originators' % prefix] = originators
+    update['%s.neighbours' % prefix] = sum(neighbours.values())
+    metric = 'throughput' if throughput else 'tq'
+    for hard_ifindex, (hard_name, active) in hardifs.items():
+        hardif_prefix = '%s.hardif.%s' % (prefix, hard_name)
+        count, total = routes.get(hard_ifindex, (0, 0))
+        update['%s.active' % hardif_prefix] = int(active)
+        update['%s.neighbours' % hardif_prefix] = neighbours.get(hard_ifindex, 0)
+        update['%s.originators' % hardif_prefix] = count
+        if count:
+            update['%s.%s.mean' % (hardif_prefix, metric)] = total / count
+
+    count, selected = batadv.gateways(ifindex)
+    update['%s.gateways.count' % prefix] = count
+    update['%s.gateways.selected' % prefix] = int(selected is not None)
+    address = selected[0] if selected is not None else None
+    if address != state.gateway:
+        if state.gateway is not None:
+            state.gateway_changes += 1
+        state.gateway = address
+    update['%s.gateways.changes' % prefix] = state.gateway_changes
+    if selected is not None:
+        update['%s.gateways.selected.%s' % (prefix, metric)] = selected[1]
+        update['%s.gateways.selected.bandwidth_down' % prefix] = selected[2]
+        update['%s.gateways.selected.bandwidth_up' % prefix] = selected[3]
+
+    if ttvn is None or ttvn != state.ttvn:
+        state.local_clients = batadv.local_clients(ifindex)
+        state.ttvn = ttvn
+    if originators != state.originators or now - state.global_dumped >= GLOBAL_TT_MAX_AGE:
+        state.global_clients = batadv.global_clients(ifindex)
+        state.originators = originators
+        state.global_dumped = now
+
+    update['%s.clients.local' % prefix], update['%s.clients.local_wifi' % prefix] = state.local_clients
+    (update['%s.clients.global' % prefix], update['%s.clients.global_entries' % prefix],
+     update['%s.clients.roaming' % prefix], update['%s.clients.wifi' % prefix]) = state.global_clients
+
+
+def read_batadv(update):
+    batadv = get_batadv()
+    now = time.monotonic()
+    try:
+        for name, state in get_meshes().items():
+            try:
+                ifindex = socket.if_nametoindex(name)
+            except OSError:
+                continue
+            read_mesh(batadv, name, ifindex, state, update, now)
+    except Exception:
+        # start over with a fresh netlink socket next time
+        close_batadv()
+        raise
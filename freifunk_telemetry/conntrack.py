@@ -0,0 +1,241 @@
+import socket
+import struct
+
+from freifunk_telemetry.netlink import NLA, NLA_TYPE_MASK, NLMSG_DONE, NLMSG_ERROR, dump_request, iter_messages, \
+    check_error, iter_attrs
+
+NETLINK_NETFILTER = 12
+NFNL_SUBSYS_CTNETLINK = 1
+IPCTNL_MSG_CT_GET = 1
+IPCTNL_MSG_CT_GET_STATS_CPU = 4
+
+NFGENMSG = struct.Struct('=BBH')
+BE16 = struct.Struct('>H')
+BE32 = struct.Struct('>I')
+
+# the attributes the table is broken down by, as paths of nested attribute types
+CTA_TUPLE_ORIG = 1
+CTA_TUPLE_PROTO = 2
+CTA_PROTO_NUM = 1
+CTA_PROTOINFO = 4
+CTA_PROTOINFO_TCP = 1
+CTA_PROTOINFO_TCP_STATE = 1
+CTA_ZONE = 18
+
+FAMILIES = {
+    socket.AF_INET: 'ipv4',
+    socket.AF_INET6: 'ipv6',
+}
+PROTOCOLS = {
+    socket.IPPROTO_ICMP: 'icmp',
+    socket.IPPROTO_TCP: 'tcp',
+    socket.IPPROTO_UDP: 'udp',
+    socket.IPPROTO_GRE: 'gre',
+    socket.IPPROTO_ICMPV6: 'icmpv6',
+    socket.IPPROTO_SCTP: 'sctp',
+    33: 'dccp',
+    136: 'udplite',
+}
+TCP_STATES = {
+    0: 'none',
+    1: 'syn_sent',
+    2: 'syn_recv',
+    3: 'established',
+    4: 'fin_wait',
+    5: 'close_wait',
+    6: 'last_ack',
+    7: 'time_wait',
+    8: 'close',
+    9: 'listen',
+}
+# always reported, as 0 if there are no such connections, so the series don't have gaps
+COMMON_PROTOCOLS = [
+    (socket.AF_INET, socket.IPPROTO_TCP),
+    (socket.AF_INET, socket.IPPROTO_UDP),
+    (socket.AF_INET, socket.IPPROTO_ICMP),
+    (socket.AF_INET6, socket.IPPROTO_TCP),
+    (socket.AF_INET6, socket.IPPROTO_UDP),
+    (socket.AF_INET6, socket.IPPROTO_ICMPV6),
+]
+# per-cpu counters of the conntrack subsystem (CTA_STATS_*), summed up
+CPU_STATS = {
+    2: 'found',
+    4: 'invalid',
+    8: 'insert',
+    9: 'insert_failed',
+    10: 'drop',
+    11: 'early_drop',
+    12: 'error',
+    13: 'search_restart',
+}
+
+
+def find_u8(buffer, offset, end, path):
+    "returns the u8 value of the nested attribute at `path` in the attributes at offset:end"
+    for attr_type in path:
+        while offset < end:
+            length, found = NLA.unpack_from(buffer, offset)
+            if length < NLA.size:
+                return None
+            if found & NLA_TYPE_MASK == attr_type:
+                end = offset + length
+                offset += NLA.size
+                break
+            offset += (length + 3) & ~3
+        else:
+            return None
+    return buffer[offset]
+
+
+def parse_entry(buffer, offset, end):
+    """
+    Returns (proto, tcp state or None, zone) of a conntrack entry's attributes.
+
+    This runs for every connection, so unlike elsewhere the attributes are
+    walked inline instead of with `iter_attrs()`, which is about twice as
+    fast.
+    """
+    proto = state = None
+    zone = 0
+    while offset < end:
+        length, attr_type = NLA.unpack_from(buffer, offset)
+        if length < NLA.size:
+            break
+        attr_type &= NLA_TYPE_MASK
+        if attr_type == CTA_TUPLE_ORIG:
+            proto = find_u8(buffer, offset + NLA.size, offset + length, (CTA_TUPLE_PROTO, CTA_PROTO_NUM))
+        elif attr_type == CTA_PROTOINFO:
+            state = find_u8(buffer, offset + NLA.size, offset + length,
+                            (CTA_PROTOINFO_TCP, CTA_PROTOINFO_TCP_STATE))
+        elif attr_type == CTA_ZONE:
+            zone = BE16.unpack_from(buffer, offset + NLA.size)[0]
+        offset += (length + 3) & ~3
+    return proto, state, zone
+
+
+class ConntrackNetlink:
+    """
+    Dumps the conntrack table over ctnetlink.
+
+    Decoding every entry with pyroute2 takes a few hundred microseconds,
+    which doesn't scale to tables of hundreds of thousands of entries. The
+    dump is read into a single reused buffer instead and only the protocol,
+    TCP state and zone attributes are picked out of each entry.
+    """
+
+    def __init__(self, buffer_size=1024 * 1024, sock=None):
+        if sock is None:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_NETFILTER)
+            sock.bind((0, 0))
+        self._sock = sock
+        self._buffer = bytearray(buffer_size)
+        self._seq = 0
+
+    def close(self):
+        self._sock.close()
+
+    def _dump(self, msg_type):
+        "yields (family, offset, end) of the payload of every message, valid until the next one"
+        self._seq += 1
+        seq = self._seq
+        # AF_UNSPEC dumps the ipv4 and ipv6 tables in one go
+        self._sock.send(dump_request((NFNL_SUBSYS_CTNETLINK << 8) | msg_type, seq,
+                                     NFGENMSG.pack(socket.AF_UNSPEC, 0, 0)))
+
+        buffer = self._buffer
+        while True:
+            size = self._sock.recv_into(buffer)
+            for nl_type, nl_seq, offset, end in iter_messages(buffer, size):
+                if nl_seq != seq:
+                    continue
+                if nl_type == NLMSG_DONE:
+                    return
+                if nl_type == NLMSG_ERROR:
+                    check_error(buffer, offset)
+                    return
+                yield buffer[offset], offset + NFGENMSG.size, end
+
+    def entries(self):
+        "yields (family, proto, tcp state or None, zone) of every connection"
+        buffer = self._buffer
+        for family, offset, end in self._dump(IPCTNL_MSG_CT_GET):
+            yield (family,) + parse_entry(buffer, offset, end)
+
+    def cpu_stats(self):
+        stats = dict.fromkeys(CPU_STATS.values(), 0)
+        buffer = self._buffer
+        for _, offset, end in self._dump(IPCTNL_MSG_CT_GET_STATS_CPU):
+            for attr_type, payload, _ in iter_attrs(buffer, offset, end):
+                name = CPU_STATS.get(attr_type)
+                if name is not None:
+                    stats[name] += BE32.unpack_from(buffer, payload)[0]
+        return stats
+
+
+def count_entries(entries):
+    "returns {(family, proto, tcp state or None, zone): count}, without keeping the entries around"
+    counts = {}
+    for key in entries:
+        counts[key] = counts.get(key, 0) + 1
+    return counts
+
+
+_conntrack = None
+# zones that had connections, they are reported as 0 once they have none
+_zones = {0}
+
+
+def get_conntrack():
+    global _conntrack
+    if _conntrack is None:
+        _conntrack = ConntrackNetlink()
+    return _conntrack
+
+
+def close_conntrack():
+    global _conntrack
+    if _conntrack is not None:
+        _conntrack.close()
+        _conntrack = None
+# zones that had connections, they are reported as 0 once they have none
+_zones = {0}
+
+
+def protocol_prefix(family, proto):
+    return 'netfilter.conntrack.%s.%s' % (FAMILIES.get(family) or 'family_%d' % family,
+                                          PROTOCOLS.get(proto) or 'proto_%s' % proto)
+
+
+def read_conntrack_table(update):
+    conntrack = get_conntrack()
+    try:
+        counts = count_entries(conntrack.entries())
+        cpu_stats = conntrack.cpu_stats()
+    except Exception:
+        # start over with a fresh netlink socket next time
+        close_conntrack()
+        raise
+
+    protocols = {}
+    for family, proto in COMMON_PROTOCOLS:
+        prefix = protocol_prefix(family, proto)
+        protocols[prefix] = 0
+        if proto == socket.IPPROTO_TCP:
+            for state in TCP_STATES.values():
+                update['%s.%s' % (prefix, state)] = 0
+    zones = dict.fromkeys(_zones, 0)
+    for (family, proto, state, zone), count in counts.items():
+        prefix = protocol_prefix(family, proto)
+        protocols[prefix] = protocols.get(prefix, 0) + count
+        if state is not None and proto == socket.IPPROTO_TCP:
+            key = '%s.%s' % (prefix, TCP_STATES.get(state) or 'state_%d' % state)
+            update[key] = update.get(key, 0) + count
+        zones[zone] = zones.get(zone, 0) + count
+
+    for prefix, count in protocols.items():
+        update['%s.count' % prefix] = count
+    _zones.update(zones)
+    for zone, count in zones.items():
+        update['netfilter.conntrack.zone.%d.count' % zone] = count
+    for key, value in cpu_stats.items():
+        update['netfilter.conntrack.%s' % key] = value
@@ -0,0 +1,102 @@
+import logging
+import random
+import signal
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Daemon:
+    """
+    Runs a collector on a fixed interval until SIGTERM/SIGINT.
+
+    `factory` is called to build the collector, which has to provide
+    `interval`, `jitter`, `run()` and `close()`. On SIGHUP the collector is
+    rebuilt through `factory` and the old one closed, so configuration is
+    re-read without restarting the process.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.collector = None
+        self._running = False
+        self._reload_pending = False
+        self._wakeup = threading.Event()
+
+    def stop(self, *args):
+        self._running = False
+        self._wakeup.set()
+
+    def reload(self, *args):
+        self._reload_pending = True
+        self._wakeup.set()
+
+    def _install_signal_handlers(self):
+        handlers = {
+            signal.SIGTERM: self.stop,
+            signal.SIGINT: self.stop,
+            signal.SIGHUP: self.reload,
+        }
+        return {signum: signal.signal(signum, handler) for signum, handler in handlers.items()}
+
+    def _do_reload(self):
+        logger.info('reloading configuration')
+        try:
+            collector = self.factory()
+        except (Exception, SystemExit):
+            logger.exception('reload failed, keeping old configuration')
+            return False
+        self.collector.close()
+        self.collector = collector
+        return True
+
+    def _splay(self):
+        # spread the gateways over the interval, so they don't all talk to carbon in the same second
+        return random.uniform(0, min(self.collector.jitter, self.collector.interval))
+
+    def run(self):
+        previous_handlers = {}
+        if threading.current_thread() is threading.main_thread():
+            previous_handlers = self._install_signal_handlers()
+
+        self.collector = self.factory()
+        self._running = True
+
+        # the schedule is anchored at `next_run` and advanced by whole intervals,
+        # so the time spent collecting does not add up to drift
+        next_run = time.monotonic() + self._splay()
+        try:
+            while self._running:
+                timeout = next_run - time.monotonic()
+                if timeout > 0:
+                    self._wakeup.wait(timeout)
+                    self._wakeup.clear()
+
+                if not self._running:
+                    break
+
+                if self._reload_pending:
+                    self._reload_pending = False
+                    if self._do_reload():
+                        next_run = time.monotonic() + self._splay()
+                    continue
+
+                if time.monotonic() < next_run:
+                    continue
+
+                try:
+                    self.collector.run()
+                except Exception as e:
+                    logger.exception(e)
+
+                next_run += self.collector.interval
+                now = time.monotonic()
+                if next_run <= now:
+                    skipped = int((now - next_run) // self.collector.interval) + 1
+                    logger.warning('collection took longer than the interval, skipping %d run(s)', skipped)
+                    next_run += skipped * self.collector.interval
+        finally:
+            self.collector.close()
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
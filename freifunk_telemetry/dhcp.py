@@ -1,13 +1,116 @@
-import isc_dhcp_filter
+import calendar
+import os
+import re
+import time
+
+LEASES_FILE = '/var/lib/dhcp/dhcpd.leases'
+
+LEASE_BLOCK = re.compile(r'^lease (\d+\.\d+\.\d+\.\d+) \{(.*?)\n\}', re.M | re.S)
+LEASE_PROPERTY = re.compile(r'^\s*(starts|ends|binding state|hardware ethernet) ([^;]*);', re.M)
+
+
+def parse_lease_time(value):
+    # "2 2013/12/10 12:57:04" (UTC), "epoch 1386680224 # ..." or "never"
+    if value == 'never':
+        return None
+    if value.startswith('epoch '):
+        return int(value.split(' ')[1])
+    _, date, clock = value.split(' ')
+    return calendar.timegm(tuple(map(int, date.split('/') + clock.split(':'))))
+
+
+class LeaseFile:
+    """
+    Incrementally follows a dhcpd.leases file.
+
+    dhcpd only ever appends lease blocks to the file, the last block for an
+    address supersedes all earlier ones. Only the blocks appended since the
+    last call are parsed, into an index of ip -> (ethernet, binding state,
+    starts, ends). When dhcpd rewrites the file (new inode, or it shrank)
+    the index is rebuilt from scratch.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.leases = {}
+        self._inode = None
+        self._offset = 0
+
+    def update(self):
+        with open(self.filename, 'rb') as fh:
+            st = os.fstat(fh.fileno())
+            inode = (st.st_dev, st.st_ino)
+            if inode != self._inode or st.st_size < self._offset:
+                self.leases = {}
+                self._inode = inode
+                self._offset = 0
+
+            if st.st_size == self._offset:
+                return
+
+            fh.seek(self._offset)
+            data = fh.read()
+
+        # don't consume a block dhcpd is still in the middle of writing
+        end = data.rfind(b'\n}')
+        if end == -1:
+            return
+        end += 2
+
+        self._parse(data[:end].decode('latin-1'))
+        self._offset += end
+
+    def _parse(self, data):
+        for match in LEASE_BLOCK.finditer(data):
+            ip, config = match.groups()
+            properties = dict(LEASE_PROPERTY.findall(config))
+
+            if 'hardware ethernet' not in properties:
+                # e.g. abandoned or backup leases
+                self.leases.pop(ip, None)
+                continue
+
+            starts = properties.get('starts')
+            ends = properties.get('ends')
+            self.leases[ip] = (
+                properties['hardware ethernet'],
+                properties.get('binding state'),
+                parse_lease_time(starts) if starts else None,
+                parse_lease_time(ends) if ends else None,
+            )
+
+    def counts(self, now=None):
+        if now is None:
+            now = time.time()
+
+        count = active = valid = current = 0
+        for ethernet, state, starts, ends in self.leases.values():
+            is_active = state == 'active'
+            is_valid = (starts is None or starts <= now) and (ends is None or now <= ends)
+            count += 1
+            active += is_active
+            valid += is_valid
+            current += is_active and is_valid
+
+        return {
+            'dhcpd.count': count,
+            'dhcpd.active': active,
+            'dhcpd.valid': valid,
+            'dhcpd.current': current,
+        }
+
+
+_lease_files = {}
 
 
 def read_dhcp_leases(update):
+    lease_file = _lease_files.get(LEASES_FILE)
+    if lease_file is None:
+        lease_file = _lease_files[LEASES_FILE] = LeaseFile(LEASES_FILE)
+
     try:
-        leases = isc_dhcp_filter.parse('/var/lib/dhcp/dhcpd.leases')
+        lease_file.update()
     except FileNotFoundError:
         return
     else:
-        update['dhcpd.count'] = leases.count()
-        update['dhcpd.active'] = leases.active.count()
-        update['dhcpd.valid'] = leases.valid.count()
-        update['dhcpd.current'] = leases.current.count()
+        update.update(lease_file.counts())
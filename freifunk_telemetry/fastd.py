@@ -1,75 +1,472 @@
+import codecs
+import glob
+import heapq
 import json
+import logging
 import os
+import re
+import socket
+import struct
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 import psutil
+from pyroute2 import DiagSocket
 from freifunk_telemetry.util import get_unix_socket
 
+logger = logging.getLogger(__name__)
 
-def read_from_fastd_socket(filename):
-    with get_unix_socket(filename) as client:
-        strings = []
+SOCKET_GLOB = '/run/fastd-*.sock'
+PIDFILE = '/run/fastd-%s.pid'
+# the metric names of the instances that used to be hard-coded
+LEGACY_INSTANCE_NAMES = {
+    'ffda-vpn': '0',
+    'ffda-vpn1': '1',
+}
+# /etc/fastd/INSTANCE/fastd.conf, fastd@INSTANCE (systemd) or /run/fastd-INSTANCE.{sock,pid}
+CMDLINE_INSTANCE = re.compile(r'/etc/fastd/([^/]+)/|^fastd@(\S+)$|/fastd-([^/]+)\.(?:sock|pid)$')
+PROCESS_RESCAN_INTERVAL = 300
+
+FAMILIES = {
+    socket.AF_INET: 'udp',
+    socket.AF_INET6: 'udp6',
+}
+# idiag_ext flag for INET_DIAG_SKMEMINFO (7), the socket's sk_meminfo counters
+INET_DIAG_SKMEMINFO = 1 << (7 - 1)
+SK_MEMINFO = struct.Struct('=9I')
+SK_MEMINFO_DROPS = 8
+MAX_PARALLEL_SOCKETS = 8
+
+# number of peers with the most traffic that are exported by rank
+TOP_PEERS = 5
+
+# upper bounds (in ms) of the connection age buckets
+AGE_BUCKETS = (
+    ('lt_1m', 60 * 1000),
+    ('lt_1h', 60 * 60 * 1000),
+    ('lt_1d', 24 * 60 * 60 * 1000),
+    ('lt_1w', 7 * 24 * 60 * 60 * 1000),
+    ('ge_1w', None),
+)
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+Peer = namedtuple('Peer', ['name', 'connection'])
+Connection = namedtuple('Connection', ['established', 'rx_bytes', 'tx_bytes'])
+
+
+def compact_status(obj):
+    """
+    object_hook for the status JSON, which is called for every object
+    bottom-up while parsing. Peers and their connections are reduced to
+    small tuples right away, so the full document never exists as dicts.
+    """
+    if 'established' in obj:
+        statistics = obj.get('statistics', {})
+        return Connection(obj['established'],
+                          statistics.get('rx', {}).get('bytes', 0),
+                          statistics.get('tx', {}).get('bytes', 0))
+    if 'connection' in obj:
+        return Peer(obj.get('name'), obj['connection'])
+    return obj
+
+
+class StatusReader:
+    """
+    Parses the status JSON while it is received.
+
+    The top-level object and its peers are walked member by member, every
+    member is parsed with `raw_decode` as soon as it is complete, and only
+    the part of a chunk that wasn't parsed yet is kept. So neither the
+    received bytes nor the decoded document are ever held as a whole, only
+    the compact peers.
+    """
+
+    def __init__(self, client, chunk_size=64 * 1024):
+        self.client = client
+        self.chunk_size = chunk_size
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._json = json.JSONDecoder(object_hook=compact_status)
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        "appends the next chunk to what is left of the buffer, returns False at the end"
+        if self._eof:
+            return False
+        chunk = self.client.recv(self.chunk_size)
+        self._eof = not chunk
+        self._buffer = self._buffer[self._pos:] + self._utf8.decode(chunk, final=self._eof)
+        self._pos = 0
+        return True
+
+    def _peek(self):
+        "skips whitespace and returns the next character"
+        while True:
+            self._pos = WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                raise ValueError('fastd status ended early')
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ValueError('expected %r in the fastd status, got %r' % (char, self._buffer[self._pos]))
+        self._pos += 1
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self._json.raw_decode(self._buffer, self._pos)
+            except ValueError:
+                # incomplete, unless there is nothing more to come
+                if not self._fill():
+                    raise
+                continue
+            # a number may go on in the next chunk
+            if end < len(self._buffer) or not self._fill():
+                self._pos = end
+                return value
+
+    def _keys(self):
+        "yields the keys of an object, the caller has to read each value before the next key"
+        self._expect('{')
+        if self._peek() == '}':
+            self._pos += 1
+            return
         while True:
-            s = client.recv(8096)
-            if not s:
+            key = self._value()
+            self._expect(':')
+            yield key
+            if self._peek() == '}':
+                self._pos += 1
+                return
+            self._expect(',')
+
+    def read(self):
+        data = {}
+        for key in self._keys():
+            if key == 'peers':
+                data[key] = {peer: self._value() for peer in self._keys()}
+            else:
+                data[key] = self._value()
+        return data
+
+
+def peer_stats(peers):
+    online = 0
+    ages = dict.fromkeys([bucket for bucket, _ in AGE_BUCKETS], 0)
+    connected = []
+
+    for peer in peers.values():
+        connection = peer.connection
+        if not connection:
+            continue
+        online += 1
+        for bucket, limit in AGE_BUCKETS:
+            if limit is None or connection.established < limit:
+                ages[bucket] += 1
                 break
-            strings.append(s.decode('utf-8'))
-
-        data = json.loads(''.join(strings))
-        # pprint.pprint(data['statistics'])
-
-        online_peers = len([None for name, d in data['peers'].items() if d['connection']])
-
-        return {
-            'peers.count': len(data['peers']),
-            'peers.online': online_peers,
-            'rx.packets': data['statistics']['rx']['packets'],
-            'rx.bytes': data['statistics']['rx']['bytes'],
-            'rx.reordered.bytes': data['statistics']['rx_reordered']['bytes'],
-            'rx.reordered.packets': data['statistics']['rx_reordered']['packets'],
-            'tx.bytes': data['statistics']['tx']['bytes'],
-            'tx.packets': data['statistics']['tx']['packets'],
-            'tx.dropped.bytes': data['statistics']['tx_dropped']['bytes'],
-            'tx.dropped.packets': data['statistics']['tx_dropped']['packets'],
-        }
-
-
-def get_fastd_process_stats():
-    for proc in psutil.process_iter():
-        if proc.name() == 'fastd':
-            # 11905: 00000000000000000000000001000000:0035 00000000000000000000000000000000:0000 07 00000000:00000000 00:00000000 00000000     0        0 4469598 2 ffff880519be5100 0
-            drop_count = 0
-            for proto in ['udp', 'udp6']:
-                with open('/proc/{}/net/{}'.format(proc.pid, proto), 'r') as fh:
-                    for line in (line.strip() for line in fh.read().split('\n')):
-                        if not line:
-                            continue
+        connected.append((connection.rx_bytes + connection.tx_bytes, connection))
+
+    stats = {
+        'peers.count': len(peers),
+        'peers.online': online,
+    }
+    for bucket, count in ages.items():
+        stats['peers.age.%s' % bucket] = count
+    # by rank rather than by name, so a change in the ranking doesn't create new series
+    top = heapq.nlargest(TOP_PEERS, connected, key=lambda peer: peer[0])
+    for rank, (_, connection) in enumerate(top, 1):
+        stats['peers.top.%d.rx.bytes' % rank] = connection.rx_bytes
+        stats['peers.top.%d.tx.bytes' % rank] = connection.tx_bytes
+
+    return stats
 
-                        if line.startswith('sl'):
-                            continue
 
-                        parts = line.split(' ')
+def read_from_fastd_socket(filename):
+    with get_unix_socket(filename) as client:
+        data = StatusReader(client).read()
 
-                        drop_count += int(parts[-1])
+    statistics = data['statistics']
+    stats = peer_stats(data['peers'])
+    stats.update({
+        'rx.packets': statistics['rx']['packets'],
+        'rx.bytes': statistics['rx']['bytes'],
+        'rx.reordered.bytes': statistics['rx_reordered']['bytes'],
+        'rx.reordered.packets': statistics['rx_reordered']['packets'],
+        'tx.bytes': statistics['tx']['bytes'],
+        'tx.packets': statistics['tx']['packets'],
+        'tx.dropped.bytes': statistics['tx_dropped']['bytes'],
+        'tx.dropped.packets': statistics['tx_dropped']['packets'],
+    })
+    return stats
 
-            return drop_count
 
+def discover_sockets():
+    "returns {instance: status socket} for every /run/fastd-INSTANCE.sock"
+    sockets = {}
+    for filename in glob.glob(SOCKET_GLOB):
+        instance = os.path.basename(filename)[len('fastd-'):-len('.sock')]
+        sockets[instance] = filename
+    return sockets
+
+
+def instance_metric_name(instance):
+    return LEGACY_INSTANCE_NAMES.get(instance, instance.replace('.', '_'))
+
+
+def instance_from_cmdline(cmdline):
+    for arg in cmdline:
+        m = CMDLINE_INSTANCE.search(arg)
+        if m:
+            return next(group for group in m.groups() if group)
     return None
 
 
+def instance_from_pidfile(pid, instances):
+    for instance in instances:
+        try:
+            with open(PIDFILE % instance, 'r') as fh:
+                if int(fh.read().strip()) == pid:
+                    return instance
+        except (OSError, ValueError):
+            continue
+    return None
+
+
+class ProcessCache:
+    """
+    Maps fastd PIDs to instance names.
+
+    The process list is only walked when a cached process went away (or
+    its PID got reused), a new instance showed up or every
+    PROCESS_RESCAN_INTERVAL seconds.
+    """
+
+    def __init__(self):
+        self.processes = {}
+        self._instances = set()
+        self._next_scan = 0
+
+    def _is_alive(self, pid, create_time):
+        try:
+            return psutil.Process(pid).create_time() == create_time
+        except psutil.Error:
+            return False
+
+    def scan(self, instances):
+        processes = {}
+        for proc in psutil.process_iter():
+            try:
+                if proc.name() != 'fastd':
+                    continue
+                instance = instance_from_pidfile(proc.pid, instances) or instance_from_cmdline(proc.cmdline())
+                processes[proc.pid] = (instance, proc.create_time())
+            except psutil.Error:
+                continue
+        self.processes = processes
+
+    def get(self, instances):
+        "returns {pid: instance}, instance is None if it couldn't be determined"
+        now = time.monotonic()
+        if now >= self._next_scan or not set(instances) <= self._instances or \
+                not all(self._is_alive(pid, create_time) for pid, (_, create_time) in self.processes.items()):
+            self.scan(instances)
+            self._instances = set(instances)
+            self._next_scan = now + PROCESS_RESCAN_INTERVAL
+        return {pid: instance for pid, (instance, _) in self.processes.items()}
+
+
+_processes = ProcessCache()
+
+
+def get_socket_inodes(pid):
+    inodes = set()
+    fd_dir = '/proc/%d/fd' % pid
+    for fd in os.listdir(fd_dir):
+        try:
+            link = os.readlink(os.path.join(fd_dir, fd))
+        except OSError:
+            continue
+        if link.startswith('socket:['):
+            inodes.add(int(link[len('socket:['):-1]))
+    return inodes
+
+
+class UDPSocketDiag:
+    """
+    Reads the drop counters of udp sockets over sock_diag netlink.
+
+    The ports of the sockets are remembered, as are the inodes a full dump
+    didn't find (e.g. fastd's status socket), so once all requested sockets
+    are known the kernel is only asked for sockets on those ports instead
+    of dumping every udp socket. The sockets of all processes should be
+    asked for at once, the others are forgotten.
+    """
+
+    def __init__(self):
+        self._diag = None
+        self._ports = {}
+        self._not_udp = set()
+
+    def _get_diag(self):
+        if self._diag is None:
+            self._diag = DiagSocket()
+            self._diag.bind()
+        return self._diag
+
+    def close(self):
+        if self._diag is not None:
+            self._diag.close()
+            self._diag = None
+
+    def _dump(self, family, sport=0):
+        return self._get_diag().get_sock_stats(family=family, protocol=socket.IPPROTO_UDP,
+                                               extensions=INET_DIAG_SKMEMINFO, sport=sport)
+
+    def stats(self, inodes):
+        "returns {inode: (proto, port, drops)} of the sockets it found"
+        ports = {self._ports.get(inode) for inode in inodes - self._not_udp}
+        full = None in ports
+        if full:
+            # at least one new socket, look at all of them
+            ports = {(family, 0) for family in FAMILIES}
+
+        result = {}
+        try:
+            for family, sport in ports:
+                for msg in self._dump(family, sport):
+                    inode = msg['idiag_inode']
+                    if inode not in inodes:
+                        continue
+                    meminfo = bytes.fromhex(msg.get_attr('INET_DIAG_SKMEMINFO').replace(':', ''))
+                    drops = SK_MEMINFO.unpack_from(meminfo)[SK_MEMINFO_DROPS]
+                    result[inode] = (FAMILIES[family], msg['idiag_sport'], drops)
+                    self._ports[inode] = (family, msg['idiag_sport'])
+        except Exception:
+            self.close()
+            raise
+
+        for inode in set(self._ports) - set(result):
+            del self._ports[inode]
+        if full:
+            self._not_udp = inodes - set(result)
+        else:
+            self._not_udp &= inodes
+        return result
+
+
+_udp_diag = UDPSocketDiag()
+
+
+def read_udp_drops(pid, inodes=None):
+    """
+    Reads the drops of the udp sockets with the given inodes from /proc,
+    as {(proto, port): drops}. Without inodes all sockets in the process'
+    namespace are summed up as {(None, None): drops}.
+    """
+    drops = {}
+    for proto in ['udp', 'udp6']:
+        with open('/proc/{}/net/{}'.format(pid, proto), 'r') as fh:
+            # 11905: 00000000000000000000000001000000:0035 00000000000000000000000000000000:0000 07 00000000:00000000 00:00000000 00000000     0        0 4469598 2 ffff880519be5100 0
+            for line in fh.read().split('\n'):
+                parts = line.split()
+                if not parts or parts[0] == 'sl':
+                    continue
+                if inodes is None:
+                    key = (None, None)
+                elif int(parts[9]) in inodes:
+                    key = (proto, int(parts[1].rsplit(':', 1)[1], 16))
+                else:
+                    continue
+                drops[key] = drops.get(key, 0) + int(parts[-1])
+    return drops
+
+
+def get_process_drops(pids):
+    "returns {pid: {(proto, port): drops}}, with one sock_diag query for all processes"
+    drops = {}
+    inodes = {}
+    for pid in pids:
+        try:
+            inodes[pid] = get_socket_inodes(pid)
+        except OSError:
+            # not allowed to look at the process' file descriptors, count the whole namespace
+            try:
+                drops[pid] = read_udp_drops(pid)
+            except OSError:
+                pass
+
+    try:
+        sockets = _udp_diag.stats(set().union(*inodes.values()))
+    except Exception as e:
+        logger.debug('sock_diag failed, falling back to /proc: %s', e)
+        sockets = {}
+
+    for pid, pid_inodes in inodes.items():
+        found = [sockets[inode] for inode in pid_inodes if inode in sockets]
+        if not found and pid_inodes:
+            # e.g. fastd runs in a different network namespace than we do
+            try:
+                drops[pid] = read_udp_drops(pid, pid_inodes)
+            except OSError:
+                pass
+            continue
+        pid_drops = drops[pid] = {}
+        for proto, port, count in found:
+            pid_drops[proto, port] = pid_drops.get((proto, port), 0) + count
+    return drops
+
+
+def get_fastd_process_stats(instances=()):
+    "returns {instance: {(proto, port): udp drops}} of all running fastd processes"
+    stats = {}
+    processes = _processes.get(instances)
+    for pid, drops in get_process_drops(processes).items():
+        instance = processes[pid]
+        instance_drops = stats.setdefault(instance, {})
+        for key, count in drops.items():
+            instance_drops[key] = instance_drops.get(key, 0) + count
+    return stats
+
+
+_executor = None
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=MAX_PARALLEL_SOCKETS)
+    return _executor
+
+
 def read_fastd(update):
-    fastd_sockets = (
-        ('0', '/run/fastd-ffda-vpn.sock'),
-        ('1', '/run/fastd-ffda-vpn1.sock'),
-    )
+    sockets = discover_sockets()
 
-    for name, filename in fastd_sockets:
-        if not os.path.exists(filename):
+    futures = {instance: get_executor().submit(read_from_fastd_socket, filename)
+               for instance, filename in sockets.items()}
+    for instance, future in sorted(futures.items()):
+        try:
+            data = future.result()
+        except Exception as e:
+            logger.warning('reading fastd status from %s failed: %s', sockets[instance], e)
             continue
 
-        data = read_from_fastd_socket(filename)
-        if len(data) > 0:
-            update.update({'fastd.%s.%s' % (name, key): value for (key, value) in data.items()})
+        name = instance_metric_name(instance)
+        update.update({'fastd.%s.%s' % (name, key): value for (key, value) in data.items()})
 
-    fastd_drops = get_fastd_process_stats()
-    if fastd_drops:
-        update['fastd.drops'] = fastd_drops
+    stats = get_fastd_process_stats(sockets)
+    for instance, drops in stats.items():
+        if instance is None:
+            continue
+        name = instance_metric_name(instance)
+        update['fastd.%s.drops' % name] = sum(drops.values())
+        for (proto, port), count in drops.items():
+            if port is not None:
+                update['fastd.%s.sockets.%s_%d.drops' % (name, proto, port)] = count
+    if stats:
+        update['fastd.drops'] = sum(sum(drops.values()) for drops in stats.values())
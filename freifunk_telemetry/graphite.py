@@ -1,16 +1,207 @@
+import logging
+import pickle
+import random
+import select
 import socket
+import struct
 import time
 
-from freifunk_telemetry.util import get_socket
+from freifunk_telemetry.util import get_socket, get_hostname
 
+logger = logging.getLogger(__name__)
 
-def write_to_graphite(data, prefix='freifunk', hostname=None):
-    if hostname is None:
-        hostname = socket.gethostname()
-    if '.' in hostname:
-        hostname = hostname.split('.')[0]
+DEFAULT_HOST = 'stats.darmstadt.freifunk.net'
+DEFAULT_PORT = 2013
+DEFAULT_PICKLE_PORT = 2004
+DEFAULT_PREFIX = 'freifunk'
+
+
+def get_metric_prefix(prefix=DEFAULT_PREFIX, hostname=None):
+    return '%s.%s' % (prefix, get_hostname(hostname))
+
+
+def format_lines(data, prefix, timestamp):
+    return ["%s.%s %s %s\n" % (prefix, key, value, timestamp) for key, value in data.items()]
+
+
+def write_to_graphite(data, prefix=DEFAULT_PREFIX, hostname=None, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    metric_prefix = get_metric_prefix(prefix, hostname)
     now = time.time()
-    with get_socket('stats.darmstadt.freifunk.net', 2013) as s:
-        for key, value in data.items():
-            line = "%s.%s.%s %s %s\n" % (prefix, hostname, key, value, now)
-            s.sendall(line.encode('latin-1'))
+    payload = ''.join(format_lines(data, metric_prefix, now)).encode('latin-1')
+    with get_socket(host, port) as s:
+        s.sendall(payload)
+
+
+class GraphiteSender:
+    """
+    Keeps a connection to carbon open across runs.
+
+    `send()` only buffers the plaintext lines, `flush()` writes the whole
+    buffer with a single `sendall`. If carbon can't be reached the lines stay
+    buffered (up to `max_metrics`, oldest are dropped first) and reconnects
+    are attempted with exponential backoff.
+
+    With a `spool` the buffer is moved to disk instead when sending fails,
+    and sent again at `drain_rate` bytes per second once carbon is back.
+    `flush()` is expected every `interval` seconds and sends up to that many
+    seconds' worth of the spool at once.
+
+    Metrics sent with a `hostname` (relayed for another gateway) are named
+    after that host instead of this one.
+    """
+
+    name = 'graphite'
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, prefix=DEFAULT_PREFIX, hostname=None,
+                 timeout=1, max_backoff=300, max_metrics=100000, spool=None, drain_rate=64 * 1024, interval=1):
+        self.host = host
+        self.port = port
+        self.base_prefix = prefix
+        self.prefix = get_metric_prefix(prefix, hostname)
+        self.timeout = timeout
+        self.max_backoff = max_backoff
+        self.max_metrics = max_metrics
+        self._metrics = []
+        self._sock = None
+        self._backoff = 0
+        self._next_attempt = 0
+        self.spool = spool
+        self.drain_rate = drain_rate
+        self.interval = interval
+        self._drain_budget = drain_rate * interval
+        self._last_drain = time.monotonic()
+        self.sent_bytes = 0
+        self.sent_metrics = 0
+
+    def send(self, data, timestamp=None, hostname=None):
+        if timestamp is None:
+            timestamp = time.time()
+        self._metrics.extend(self._format(data, self._get_prefix(hostname), timestamp))
+
+        overflow = len(self._metrics) - self.max_metrics
+        if overflow > 0:
+            logger.warning('graphite buffer full, dropping %d metrics', overflow)
+            del self._metrics[:overflow]
+
+    def _get_prefix(self, hostname):
+        return self.prefix if hostname is None else get_metric_prefix(self.base_prefix, hostname)
+
+    def _format(self, data, prefix, timestamp):
+        return format_lines(data, prefix, timestamp)
+
+    def _encode(self, metrics):
+        return ''.join(metrics).encode('latin-1')
+
+    def _write(self, payload):
+        self._sock.sendall(payload)
+
+    def _is_connected(self):
+        if self._sock is None:
+            return False
+        # carbon never talks back, so a readable socket means it was closed on the other side
+        readable, _, _ = select.select([self._sock], [], [], 0)
+        if readable:
+            self._disconnect()
+            return False
+        return True
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        return sock
+
+    def _failed(self, e):
+        self._disconnect()
+        self._backoff = min(max(self._backoff * 2, 1), self.max_backoff)
+        self._next_attempt = time.monotonic() + random.uniform(self._backoff / 2, self._backoff)
+        logger.warning('sending to graphite %s:%s failed (%s), retrying in at most %ss',
+                       self.host, self.port, e, self._backoff)
+
+    def _spool_metrics(self):
+        if self.spool is not None and self._metrics:
+            self.spool.append(self._encode(self._metrics))
+            del self._metrics[:]
+
+    def _drain_spool(self):
+        now = time.monotonic()
+        # allow bursts of at most one interval worth of data, flush() isn't called more often
+        self._drain_budget = min(self._drain_budget + (now - self._last_drain) * self.drain_rate,
+                                 self.drain_rate * self.interval)
+        self._last_drain = now
+
+        while self._drain_budget > 0:
+            record = self.spool.peek()
+            if record is None:
+                break
+            _, payload = record
+            self._write(payload)
+            self.spool.pop()
+            self._drain_budget -= len(payload)
+            self.sent_bytes += len(payload)
+
+    def flush(self):
+        if not self._metrics and not self.spool:
+            return True
+
+        if not self._is_connected():
+            if time.monotonic() < self._next_attempt:
+                self._spool_metrics()
+                return False
+            try:
+                self._sock = self._connect()
+            except OSError as e:
+                self._failed(e)
+                self._spool_metrics()
+                return False
+
+        try:
+            if self._metrics:
+                payload = self._encode(self._metrics)
+                self._write(payload)
+                self.sent_bytes += len(payload)
+                self.sent_metrics += len(self._metrics)
+                del self._metrics[:]
+            if self.spool:
+                self._drain_spool()
+        except OSError as e:
+            self._failed(e)
+            self._spool_metrics()
+            return False
+
+        self._backoff = 0
+        return True
+
+    def _disconnect(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def close(self):
+        self._disconnect()
+        self._spool_metrics()
+
+
+class PickleSender(GraphiteSender):
+    """
+    Sends the buffered metrics using carbon's pickle protocol, as
+    length-prefixed pickled lists of at most `batch_size` metrics.
+    """
+
+    name = 'pickle'
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PICKLE_PORT, prefix=DEFAULT_PREFIX, hostname=None,
+                 batch_size=500, **kwargs):
+        super().__init__(host, port, prefix, hostname, **kwargs)
+        self.batch_size = batch_size
+
+    def _format(self, data, prefix, timestamp):
+        return [('%s.%s' % (prefix, key), (timestamp, value)) for key, value in data.items()]
+
+    def _encode(self, metrics):
+        chunks = []
+        for i in range(0, len(metrics), self.batch_size):
+            # protocol 2, carbon may still be running on python 2
+            payload = pickle.dumps(metrics[i:i + self.batch_size], protocol=2)
+            chunks.append(struct.pack('!L', len(payload)))
+            chunks.append(payload)
+        return b''.join(chunks)
@@ -0,0 +1,94 @@
+import logging
+import socket
+import time
+import urllib.parse
+import urllib.request
+
+from freifunk_telemetry.util import get_hostname, to_number, pack_datagrams
+
+logger = logging.getLogger(__name__)
+
+
+def escape(value):
+    return value.replace(',', '\\,').replace(' ', '\\ ')
+
+
+def host_tag(hostname):
+    return ',host=%s' % escape(get_hostname(hostname))
+
+
+def format_line(key, value, tags, timestamp):
+    return '%s%s value=%r %d' % (escape(key), tags, float(value), timestamp * 1e9)
+
+
+class InfluxDBSender:
+    """
+    Writes the metrics in InfluxDB line protocol.
+
+    `url` is either `udp://host:port`, in which case the lines are packed
+    into datagrams of at most `max_datagram` bytes, or the HTTP write
+    endpoint, e.g. `http://influxdb:8086/write?db=freifunk`, which gets a
+    single POST per flush.
+    """
+
+    name = 'influxdb'
+
+    def __init__(self, url, hostname=None, timeout=2, max_datagram=1400, max_lines=100000):
+        self.url = url
+        self.tags = host_tag(hostname)
+        self.timeout = timeout
+        self.max_datagram = max_datagram
+        self.max_lines = max_lines
+        self._lines = []
+        self._sock = None
+        self.sent_bytes = 0
+        self.sent_metrics = 0
+
+        parsed = urllib.parse.urlsplit(url)
+        if parsed.scheme == 'udp':
+            self._address = (parsed.hostname, parsed.port or 8089)
+            self._sock = socket.socket(socket.AF_INET6 if ':' in parsed.hostname else socket.AF_INET,
+                                       socket.SOCK_DGRAM)
+        elif parsed.scheme not in ('http', 'https'):
+            raise ValueError('unsupported influxdb url %r' % url)
+
+    def send(self, data, timestamp=None, hostname=None):
+        if timestamp is None:
+            timestamp = time.time()
+        tags = self.tags if hostname is None else host_tag(hostname)
+        for key, value in data.items():
+            value = to_number(value)
+            if value is not None:
+                self._lines.append(format_line(key, value, tags, timestamp).encode('utf-8'))
+
+        overflow = len(self._lines) - self.max_lines
+        if overflow > 0:
+            logger.warning('influxdb buffer full, dropping %d lines', overflow)
+            del self._lines[:overflow]
+
+    def flush(self):
+        if not self._lines:
+            return True
+
+        try:
+            if self._sock is not None:
+                for payload in pack_datagrams(self._lines, self.max_datagram):
+                    self._sock.sendto(payload, self._address)
+                    self.sent_bytes += len(payload)
+            else:
+                payload = b'\n'.join(self._lines)
+                request = urllib.request.Request(self.url, data=payload, method='POST')
+                urllib.request.urlopen(request, timeout=self.timeout).close()
+                self.sent_bytes += len(payload)
+        except OSError as e:
+            logger.warning('writing to influxdb at %s failed: %s', self.url, e)
+            return False
+
+        self.sent_metrics += len(self._lines)
+        del self._lines[:]
+        return True
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
@@ -0,0 +1,205 @@
+import cProfile
+import logging
+import os
+import pstats
+import resource
+import signal
+import threading
+import time
+import tracemalloc
+
+from freifunk_telemetry.util import read_proc
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of the plugin duration histogram buckets, in milliseconds
+DURATION_BUCKETS = (10, 50, 100, 500, 1000, 5000, 10000, 60000)
+PAGE_SIZE = resource.getpagesize()
+
+
+class PluginStats:
+    def __init__(self):
+        self.buckets = [0] * len(DURATION_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.last = 0.0
+        self.success = 0
+        self.failure = 0
+        self.timeout = 0
+        self.skipped = 0
+
+    def observe(self, duration):
+        milliseconds = duration * 1000
+        for i, bound in enumerate(DURATION_BUCKETS):
+            if milliseconds <= bound:
+                self.buckets[i] += 1
+        self.count += 1
+        self.sum += duration
+        self.last = duration
+
+
+class Instrumentation:
+    """
+    Collects metrics about the collector itself.
+
+    The scheduler reports how long every plugin ran and whether it succeeded,
+    failed, timed out or had to be skipped because it was still running, the
+    collector reports what every backend sent. `stats()` returns all of it
+    as `telemetry.*` metrics, together with the process' CPU time and memory
+    usage. The duration histogram is cumulative, like Prometheus' `le`
+    buckets, and counts the runs that finished in time; runs that timed out
+    are only counted as timeouts.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._plugins = {}
+        self._backend_failures = {}
+
+    def _plugin(self, name):
+        stats = self._plugins.get(name)
+        if stats is None:
+            stats = self._plugins[name] = PluginStats()
+        return stats
+
+    def plugin_finished(self, name, duration, success):
+        with self._lock:
+            stats = self._plugin(name)
+            stats.observe(duration)
+            if success:
+                stats.success += 1
+            else:
+                stats.failure += 1
+
+    def plugin_timed_out(self, name):
+        with self._lock:
+            self._plugin(name).timeout += 1
+
+    def plugin_skipped(self, name):
+        with self._lock:
+            self._plugin(name).skipped += 1
+
+    def backend_failed(self, name):
+        self._backend_failures[name] = self._backend_failures.get(name, 0) + 1
+
+    def stats(self, backends=()):
+        update = {}
+        with self._lock:
+            for name, stats in self._plugins.items():
+                prefix = 'telemetry.plugins.%s' % name
+                for bound, count in zip(DURATION_BUCKETS, stats.buckets):
+                    update['%s.duration.le_%dms' % (prefix, bound)] = count
+                update['%s.duration.count' % prefix] = stats.count
+                update['%s.duration.sum' % prefix] = round(stats.sum, 6)
+                update['%s.duration.last' % prefix] = round(stats.last, 6)
+                for key in ['success', 'failure', 'timeout', 'skipped']:
+                    update['%s.%s' % (prefix, key)] = getattr(stats, key)
+
+        for backend in backends:
+            prefix = 'telemetry.backends.%s' % backend.name
+            update['%s.bytes' % prefix] = backend.sent_bytes
+            update['%s.metrics' % prefix] = backend.sent_metrics
+            update['%s.failures' % prefix] = self._backend_failures.get(backend.name, 0)
+
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        update['telemetry.process.cpu.user'] = round(usage.ru_utime, 3)
+        update['telemetry.process.cpu.system'] = round(usage.ru_stime, 3)
+        # ru_maxrss is in kilobytes on linux
+        update['telemetry.process.max_rss'] = usage.ru_maxrss * 1024
+        try:
+            update['telemetry.process.rss'] = int(read_proc('/proc/self/statm').split()[1]) * PAGE_SIZE
+        except OSError:
+            pass
+        update['telemetry.process.threads'] = threading.active_count()
+        return update
+
+
+class Profiler:
+    """
+    Profiles the collector on demand.
+
+    SIGUSR1 starts profiling every plugin run and every send with cProfile,
+    the next SIGUSR1 writes the merged profile to `directory`. SIGUSR2 does
+    the same with tracemalloc and a snapshot of the allocations. Signals
+    only set a flag, they are acted on at the start of the next collection.
+
+    The signal handlers are installed by the first `poll()`, so that a
+    collector that is built on SIGHUP only takes them over once the old one
+    was closed.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._profiles = None
+        self._toggle_cpu = False
+        self._toggle_memory = False
+        self._previous_handlers = {}
+
+    def install(self):
+        if self._previous_handlers or threading.current_thread() is not threading.main_thread():
+            return
+        for signum, handler in [(signal.SIGUSR1, self._on_sigusr1), (signal.SIGUSR2, self._on_sigusr2)]:
+            self._previous_handlers[signum] = signal.signal(signum, handler)
+
+    def uninstall(self):
+        for signum, handler in self._previous_handlers.items():
+            signal.signal(signum, handler)
+        self._previous_handlers = {}
+
+    def _on_sigusr1(self, signum, frame):
+        self._toggle_cpu = True
+
+    def _on_sigusr2(self, signum, frame):
+        self._toggle_memory = True
+
+    def _filename(self, kind):
+        return os.path.join(self.directory, '%s-%d-%d.%s' % (kind, os.getpid(), time.time(), kind))
+
+    def poll(self):
+        self.install()
+
+        if self._toggle_cpu:
+            self._toggle_cpu = False
+            with self._lock:
+                profiles = self._profiles
+                self._profiles = [] if profiles is None else None
+            if profiles is None:
+                logger.info('cpu profiling started')
+            elif profiles:
+                filename = self._filename('pstats')
+                pstats.Stats(*profiles).dump_stats(filename)
+                logger.info('cpu profile written to %s', filename)
+            else:
+                logger.info('cpu profiling stopped, nothing was profiled')
+
+        if self._toggle_memory:
+            self._toggle_memory = False
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(25)
+                logger.info('memory profiling started')
+            else:
+                filename = self._filename('tracemalloc')
+                tracemalloc.take_snapshot().dump(filename)
+                tracemalloc.stop()
+                logger.info('memory snapshot written to %s', filename)
+
+    def call(self, func, *args):
+        "calls func(*args), with cpu profiling if it is switched on"
+        if self._profiles is None:
+            return func(*args)
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # newer pythons only allow one active profiler at a time, this run goes unprofiled
+            return func(*args)
+        try:
+            return func(*args)
+        finally:
+            profile.disable()
+            profile.create_stats()
+            with self._lock:
+                if self._profiles is not None:
+                    self._profiles.append(profile)
@@ -0,0 +1,260 @@
+import errno
+import logging
+import select
+import socket
+import struct
+import threading
+
+from freifunk_telemetry.netlink import NLMSG_DONE, NLMSG_ERROR, dump_request, iter_messages, check_error, \
+    iter_attrs
+from freifunk_telemetry.util import read_proc
+
+logger = logging.getLogger(__name__)
+
+RTMGRP_LINK = 0x1
+RTMGRP_NEIGH = 0x4
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_GETLINK = 18
+RTM_NEWNEIGH = 28
+RTM_DELNEIGH = 29
+RTM_GETNEIGH = 30
+IFLA_IFNAME = 3
+NDA_DST = 1
+IFF_RUNNING = 0x40
+
+IFINFOMSG = struct.Struct('=BxHiII')
+NDMSG = struct.Struct('=BxxxiHBB')
+
+NUD_REACHABLE = 0x02
+NUD_STALE = 0x04
+NUD_FAILED = 0x20
+NEIGH_STATES = [
+    ('reachable', NUD_REACHABLE),
+    ('stale', NUD_STALE),
+    ('failed', NUD_FAILED),
+]
+NEIGH_KEYS = ['count'] + [key for key, _ in NEIGH_STATES]
+FAMILIES = {
+    socket.AF_INET: 'ipv4',
+    socket.AF_INET6: 'ipv6',
+}
+
+
+def neigh_vector(state):
+    "the contribution of a neighbour in `state` to the counts, in the order of NEIGH_KEYS"
+    return [1] + [1 if state & flag else 0 for _, flag in NEIGH_STATES]
+
+
+class NetlinkMonitor:
+    """
+    Keeps the links and neighbour tables up to date from rtnetlink events.
+
+    The socket is subscribed to the link and neighbour groups before the
+    tables are dumped once, after that every RTM_NEWLINK/RTM_DELLINK and
+    RTM_NEWNEIGH/RTM_DELNEIGH is applied as it comes in, on a thread of its
+    own. The per-interface neighbour counts are updated with every event,
+    so reading them never walks the tables. Link state changes are counted
+    per interface, including flaps that happen between two collections.
+
+    If the kernel dropped events because the socket buffer ran over, the
+    tables are dumped again.
+
+    The messages are parsed in place with the helpers in
+    `freifunk_telemetry.netlink` instead of pyroute2's IPRoute, which turns every message into
+    nested objects and is about ten times slower on a full dump.
+    """
+
+    def __init__(self, sock=None, buffer_size=256 * 1024):
+        if sock is None:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+            sock.bind((0, RTMGRP_LINK | RTMGRP_NEIGH))
+        self._sock = sock
+        self._buffer = bytearray(buffer_size)
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._running = True
+        self.synced = threading.Event()
+
+        # ifindex -> [name, running]
+        self.links = {}
+        # name -> [up events, down events]
+        self.link_events = {}
+        # (family, ifindex, address) -> state
+        self.neighbours = {}
+        # (family, ifindex) -> counts in the order of NEIGH_KEYS
+        self.neigh_counts = {}
+        self.events = 0
+        self.resyncs = 0
+
+        self._thread = threading.Thread(target=self._run, name='netlink-monitor')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        self._running = False
+        self._thread.join()
+        self._sock.close()
+
+    def _run(self):
+        try:
+            self._sync()
+            while self._running:
+                readable, _, _ = select.select([self._sock], [], [], 0.5)
+                if not readable:
+                    continue
+                try:
+                    self._receive()
+                except OSError as e:
+                    if e.errno != errno.ENOBUFS:
+                        raise
+                    logger.warning('netlink events were lost, dumping the tables again')
+                    self.resyncs += 1
+                    self._sync()
+        except Exception:
+            if self._running:
+                logger.exception('netlink monitor failed')
+            self._running = False
+            # readers fall back to nothing instead of waiting
+            self.synced.set()
+
+    @property
+    def alive(self):
+        return self._running
+
+    def _receive(self, dump_seq=None):
+        "handles the messages of one recv, returns True once the dump with dump_seq is done"
+        size = self._sock.recv_into(self._buffer)
+        buffer = self._buffer
+        done = False
+        with self._lock:
+            for msg_type, seq, offset, end in iter_messages(buffer, size):
+                if msg_type == NLMSG_DONE:
+                    done = done or seq == dump_seq
+                elif msg_type == NLMSG_ERROR:
+                    if seq == dump_seq:
+                        check_error(buffer, offset)
+                        done = True
+                elif msg_type in (RTM_NEWLINK, RTM_DELLINK):
+                    self._link_event(msg_type, buffer, offset, end)
+                elif msg_type in (RTM_NEWNEIGH, RTM_DELNEIGH):
+                    self._neigh_event(msg_type, buffer, offset, end)
+                if seq == 0:
+                    self.events += 1
+        return done
+
+    def _dump(self, msg_type, payload):
+        self._seq += 1
+        seq = self._seq
+        self._sock.send(dump_request(msg_type, seq, payload))
+        while not self._receive(seq):
+            pass
+
+    def _sync(self):
+        with self._lock:
+            self.links.clear()
+            self.neighbours.clear()
+            self.neigh_counts.clear()
+        self._dump(RTM_GETLINK, IFINFOMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0))
+        # one dump per family, AF_UNSPEC would include the bridge fdb
+        for family in FAMILIES:
+            self._dump(RTM_GETNEIGH, NDMSG.pack(family, 0, 0, 0, 0))
+        self.synced.set()
+
+    def _link_event(self, msg_type, buffer, offset, end):
+        _, _, ifindex, flags, _ = IFINFOMSG.unpack_from(buffer, offset)
+        if msg_type == RTM_DELLINK:
+            self.links.pop(ifindex, None)
+            for key in [key for key in self.neighbours if key[1] == ifindex]:
+                self._remove_neighbour(key)
+            return
+
+        name = None
+        for attr_type, payload, payload_end in iter_attrs(buffer, offset + IFINFOMSG.size, end):
+            if attr_type == IFLA_IFNAME:
+                name = bytes(buffer[payload:payload_end]).rstrip(b'\0').decode('latin-1')
+                break
+        running = bool(flags & IFF_RUNNING)
+
+        link = self.links.get(ifindex)
+        if link is None:
+            self.links[ifindex] = [name, running]
+            return
+        if name is not None:
+            link[0] = name
+        if link[1] != running:
+            events = self.link_events.setdefault(link[0], [0, 0])
+            events[0 if running else 1] += 1
+            link[1] = running
+
+    def _remove_neighbour(self, key):
+        state = self.neighbours.pop(key, None)
+        if state is not None:
+            counts = self.neigh_counts[key[:2]]
+            for i, value in enumerate(neigh_vector(state)):
+                counts[i] -= value
+
+    def _neigh_event(self, msg_type, buffer, offset, end):
+        family, ifindex, state, _, _ = NDMSG.unpack_from(buffer, offset)
+        if family not in FAMILIES:
+            return
+        address = None
+        for attr_type, payload, payload_end in iter_attrs(buffer, offset + NDMSG.size, end):
+            if attr_type == NDA_DST:
+                address = bytes(buffer[payload:payload_end])
+                break
+        key = (family, ifindex, address)
+
+        self._remove_neighbour(key)
+        if msg_type == RTM_NEWNEIGH:
+            self.neighbours[key] = state
+            counts = self.neigh_counts.setdefault(key[:2], [0] * len(NEIGH_KEYS))
+            for i, value in enumerate(neigh_vector(state)):
+                counts[i] += value
+
+    def stats(self):
+        update = {}
+        with self._lock:
+            for ifindex, (name, running) in self.links.items():
+                update['%s.link.up' % name] = int(running)
+                for family, label in FAMILIES.items():
+                    counts = self.neigh_counts.get((family, ifindex))
+                    for i, key in enumerate(NEIGH_KEYS):
+                        update['%s.neigh.%s.%s' % (label, name, key)] = counts[i] if counts else 0
+            for name, (up, down) in self.link_events.items():
+                update['%s.link.up_events' % name] = up
+                update['%s.link.down_events' % name] = down
+            update['netlink.events'] = self.events
+            update['netlink.resyncs'] = self.resyncs
+        return update
+
+
+_monitor = None
+
+
+def get_monitor():
+    global _monitor
+    if _monitor is not None and not _monitor.alive:
+        close_monitor()
+    if _monitor is None:
+        _monitor = NetlinkMonitor()
+    return _monitor
+
+
+def close_monitor():
+    global _monitor
+    if _monitor is not None:
+        _monitor.close()
+        _monitor = None
+
+
+def read_netlink_events(update):
+    monitor = get_monitor()
+    if not monitor.synced.wait(5):
+        return
+    update.update(monitor.stats())
+
+    for label in FAMILIES.values():
+        for key in ['gc_thresh1', 'gc_thresh2', 'gc_thresh3']:
+            update['%s.neigh.%s' % (label, key)] = int(read_proc('/proc/sys/net/%s/neigh/default/%s' % (label, key)))
@@ -0,0 +1,68 @@
+import errno
+import os
+import struct
+
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+NLM_F_DUMP = 0x300
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLA_TYPE_MASK = 0x3fff
+
+NLMSGHDR = struct.Struct('=IHHII')
+NLA = struct.Struct('=HH')
+NLERR = struct.Struct('=i')
+
+
+def request(msg_type, seq, payload, flags=NLM_F_REQUEST | NLM_F_ACK):
+    return NLMSGHDR.pack(NLMSGHDR.size + len(payload), msg_type, flags, seq, 0) + payload
+
+
+def dump_request(msg_type, seq, payload):
+    return request(msg_type, seq, payload, NLM_F_REQUEST | NLM_F_DUMP)
+
+
+def pack_attr(attr_type, payload):
+    "returns the attribute, padded to 4 bytes"
+    length = NLA.size + len(payload)
+    return NLA.pack(length, attr_type) + payload + bytes(-length % 4)
+
+
+def iter_messages(buffer, size):
+    "yields (type, seq, offset of the payload, end) of every message in buffer[:size]"
+    offset = 0
+    while offset + NLMSGHDR.size <= size:
+        length, msg_type, _, seq, _ = NLMSGHDR.unpack_from(buffer, offset)
+        if length < NLMSGHDR.size or offset + length > size:
+            raise OSError(errno.EIO, 'malformed netlink message')
+        yield msg_type, seq, offset + NLMSGHDR.size, offset + length
+        offset += (length + 3) & ~3
+
+
+def check_error(buffer, offset):
+    "raises the error of an NLMSG_ERROR message, an error of 0 is an ack"
+    error = -NLERR.unpack_from(buffer, offset)[0]
+    if error:
+        raise OSError(error, os.strerror(error))
+
+
+def iter_attrs(buffer, offset, end):
+    "yields (type, offset of the payload, end) of every attribute in buffer[offset:end]"
+    while offset + NLA.size <= end:
+        length, attr_type = NLA.unpack_from(buffer, offset)
+        if length < NLA.size:
+            return
+        yield attr_type & NLA_TYPE_MASK, offset + NLA.size, offset + length
+        offset += (length + 3) & ~3
+
+
+def find_attr(buffer, offset, end, path):
+    "returns (offset, end) of the payload of the nested attribute at `path`, or None"
+    for attr_type in path:
+        for found, payload, payload_end in iter_attrs(buffer, offset, end):
+            if found == attr_type:
+                offset, end = payload, payload_end
+                break
+        else:
+            return None
+    return offset, end
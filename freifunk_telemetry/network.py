@@ -1,101 +1,169 @@
-import itertools
-import re
 import socket
 
 import pyroute2
-
-from freifunk_telemetry.util import pairwise
+from pyroute2.netlink.rtnl import ndmsg
+
+from freifunk_telemetry.util import pairwise, read_proc
+
+
+DEVICE_NAME_MAPPING = {
+    'freifunk': 'ffda-br',
+    'bat0': 'ffda-bat',
+    'mesh-vpn': 'ffda-vpn'
+}
+DEVICE_WHITELIST = frozenset([
+    'eth0',
+    'tun-ffrl-ber',
+    'tun-ffrl-dus',
+    'tun-ffrl-fra',
+    'tun-ffda-gw01',
+    'tun-ffda-gw02',
+    'tun-ffda-gw03',
+    'tun-ffda-gw04',
+    'ffda-vpn',
+    'ffda-bat',
+    'ffda-br',
+    'icvpn',
+    'ffda-transport',
+    'services',
+])
+DEVICE_SUFFIXES = ('-vpn', '-bat', '-br', '-transport')
+
+# the layout of a /proc/net/dev line after the colon
+DEV_FIELDS = [
+    'bytes', 'packets', 'errs', 'drop', 'fifo',
+    'frame', 'compressed', 'multicast',
+]
+DEV_COLUMNS = [(direction, field) for direction in ['rx', 'tx'] for field in DEV_FIELDS]
+
+# the sets of devices and counters hardly ever change, so the metric keys are
+# only formatted once: raw name -> keys (or None if the device isn't exported)
+_device_keys = {}
+_snmp_keys = {}
+_snmp6_keys = {}
+MAX_CACHED_KEYS = 4096
+
+
+def is_exported_device(device_name):
+    return device_name in DEVICE_WHITELIST or device_name.endswith(DEVICE_SUFFIXES)
+
+
+def get_device_keys(raw_name):
+    try:
+        return _device_keys[raw_name]
+    except KeyError:
+        pass
+
+    device_name = raw_name.decode('latin-1')
+    device_name = DEVICE_NAME_MAPPING.get(device_name, device_name)
+    keys = None
+    if is_exported_device(device_name):
+        keys = tuple('%s.%s.%s' % (device_name, direction, field) for direction, field in DEV_COLUMNS)
+
+    if len(_device_keys) >= MAX_CACHED_KEYS:
+        _device_keys.clear()
+    _device_keys[raw_name] = keys
+    return keys
 
 
 def read_interface_counters(update):
-    device_name_mapping = {
-        'freifunk': 'ffda-br',
-        'bat0': 'ffda-bat',
-        'mesh-vpn': 'ffda-vpn'
-    }
-    device_whitelist = [
-        'eth0',
-        'tun-ffrl-ber',
-        'tun-ffrl-dus',
-        'tun-ffrl-fra',
-        'tun-ffda-gw01',
-        'tun-ffda-gw02',
-        'tun-ffda-gw03',
-        'tun-ffda-gw04',
-        'ffda-vpn',
-        'ffda-bat',
-        'ffda-br',
-        'icvpn',
-        'ffda-transport',
-        'services',
-    ]
-
-    fields = [
-        'bytes', 'packets', 'errs', 'drop', 'fifo',
-        'frame', 'compressed', 'multicast',
-    ]
-    field_format = '(?P<{direction}_{field}>\d+)'
-
-    pattern = re.compile(
-        '^\s*(?P<device_name>[\w-]+):\s+' + '\s+'.join(
-            itertools.chain.from_iterable((field_format.format(direction=direction, field=field)
-                                           for field in fields) for direction in ['rx', 'tx'])
-        )
-    )
-
-    with open('/proc/net/dev') as fh:
-        lines = fh.readlines()
-        for line in lines:
-            m = pattern.match(line)
-            if m:
-                groupdict = m.groupdict()
-                device_name = groupdict.pop('device_name')
-                device_name = device_name_mapping.get(device_name, device_name)
-                if device_name in device_whitelist or device_name.endswith('-vpn') or \
-                        device_name.endswith('-bat') or \
-                        device_name.endswith('-br') or \
-                        device_name.endswith('-transport'):
-                    for key, value in groupdict.items():
-                        direction, metric = key.split('_')
-                        update['%s.%s.%s' % (device_name, direction, metric)] = value
+    data = read_proc('/proc/net/dev')
+    # skip the two header lines
+    for line in data.split(b'\n')[2:]:
+        raw_name, sep, counters = line.partition(b':')
+        if not sep:
+            continue
+        keys = get_device_keys(raw_name.strip())
+        if keys is not None:
+            update.update(zip(keys, map(int, counters.split())))
 
 
 def read_conntrack(update):
     for key in ['count', 'max']:
-        with open('/proc/sys/net/netfilter/nf_conntrack_%s' % key, 'r') as fh:
-            update['netfilter.%s' % key] = fh.read().strip()
+        update['netfilter.%s' % key] = int(read_proc('/proc/sys/net/netfilter/nf_conntrack_%s' % key))
 
 
 def read_snmp6(update):
-    with open('/proc/net/snmp6', 'r') as fh:
-        for line in fh.readlines():
-            key, value = line.split(' ', 1)
-            value = value.strip()
-            update['ipv6.%s' % key] = value
+    for line in read_proc('/proc/net/snmp6').splitlines():
+        name, value = line.split(None, 1)
+        key = _snmp6_keys.get(name)
+        if key is None:
+            if len(_snmp6_keys) >= MAX_CACHED_KEYS:
+                _snmp6_keys.clear()
+            key = _snmp6_keys[name] = 'ipv6.%s' % name.decode('latin-1')
+        update[key] = int(value)
 
 
 def read_snmp(update):
-    with open('/proc/net/snmp', 'r') as fh:
-        for heading, values in pairwise(fh.readlines()):
-            section, headings = heading.split(':')
-            headings = headings.strip().split(' ')
-            _, values = values.split(':')
-            values = values.strip().split(' ')
-            for key, value in zip(headings, values):
-                update['ipv4.%s.%s' % (section, key)] = value
+    for heading, values in pairwise(read_proc('/proc/net/snmp').splitlines()):
+        keys = _snmp_keys.get(heading)
+        if keys is None:
+            section, headings = heading.decode('latin-1').split(':')
+            if len(_snmp_keys) >= MAX_CACHED_KEYS:
+                _snmp_keys.clear()
+            keys = _snmp_keys[heading] = tuple('ipv4.%s.%s' % (section, key) for key in headings.split())
+        update.update(zip(keys, map(int, values.split(b':', 1)[1].split())))
+
+
+NEIGH_STATES = {
+    'reachable': ndmsg.NUD_REACHABLE,
+    'stale': ndmsg.NUD_STALE,
+    'failed': ndmsg.NUD_FAILED,
+}
+
+_ip_route = None
+
+
+def get_ip_route():
+    global _ip_route
+    if _ip_route is None:
+        _ip_route = pyroute2.IPRoute()
+    return _ip_route
+
+
+def close_ip_route():
+    global _ip_route
+    if _ip_route is not None:
+        _ip_route.close()
+        _ip_route = None
+
+
+def count_neighbours(neighbours):
+    "returns {ifindex: {'count': n, 'reachable': n, 'stale': n, 'failed': n}}"
+    counts = {}
+    for neigh in neighbours:
+        ifindex = neigh['ifindex']
+        c = counts.get(ifindex)
+        if c is None:
+            c = counts[ifindex] = dict.fromkeys(['count'] + list(NEIGH_STATES), 0)
+        c['count'] += 1
+        state = neigh['state']
+        for key, flag in NEIGH_STATES.items():
+            if state & flag:
+                c[key] += 1
+    return counts
 
 
 def read_neigh(update):
-    ip_route = pyroute2.IPRoute()
+    ip_route = get_ip_route()
     families = {
         'ipv4': socket.AF_INET,
         'ipv6': socket.AF_INET6,
     }
+    interfaces = socket.if_nameindex()
+    empty = dict.fromkeys(['count'] + list(NEIGH_STATES), 0)
     for label, family in families.items():
-        for idx, ifname in socket.if_nameindex():
-            neigh = ip_route.get_neighbours(family=family, ifindex=idx)
-            update['%s.neigh.%s.count' % (label, ifname)] = len(neigh)
+        # one dump of the whole table instead of a request per interface
+        try:
+            counts = count_neighbours(ip_route.get_neighbours(family=family))
+        except Exception:
+            # start over with a fresh netlink socket next time
+            close_ip_route()
+            raise
+
+        for idx, ifname in interfaces:
+            for key, value in counts.get(idx, empty).items():
+                update['%s.neigh.%s.%s' % (label, ifname, key)] = value
 
         for key in ['gc_thresh1', 'gc_thresh2', 'gc_thresh3']:
-            with open('/proc/sys/net/%s/neigh/default/%s' % (label, key), 'r') as fh:
-                update['%s.neigh.%s' % (label, key)] = fh.read().strip()
\ No newline at end of file
+            update['%s.neigh.%s' % (label, key)] = int(read_proc('/proc/sys/net/%s/neigh/default/%s' % (label, key)))
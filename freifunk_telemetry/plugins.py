@@ -0,0 +1,122 @@
+import glob
+import importlib
+import logging
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+ENTRY_POINT_GROUP = 'freifunk_telemetry.plugins'
+
+# `target` is "module:function", the module is only imported once one of the
+# `sources` (glob patterns) exists, a plugin without sources is always loaded.
+# An interval of None means --interval. Plugins that aren't `enabled` by
+# default have to be switched on with --enable-plugin or --plugins. A plugin
+# that is switched on turns off the plugins it `replaces`, unless they were
+# asked for by name too.
+PluginSpec = namedtuple('PluginSpec', ['name', 'target', 'sources', 'interval', 'timeout', 'enabled', 'replaces'])
+PluginSpec.__new__.__defaults__ = (True, ())
+
+BUILTIN_PLUGINS = [
+    PluginSpec('interface_counters', 'freifunk_telemetry.network:read_interface_counters', ['/proc/net/dev'],
+               None, 5),
+    PluginSpec('load', 'freifunk_telemetry.system:read_load', ['/proc/loadavg'], None, 5),
+    PluginSpec('neigh', 'freifunk_telemetry.network:read_neigh', ['/proc/sys/net/ipv4/neigh/default'], None, 10),
+    # keeps the neighbour tables from events instead of dumping them
+    PluginSpec('netlink_events', 'freifunk_telemetry.monitor:read_netlink_events', ['/proc/net/netlink'], None, 10,
+               enabled=False, replaces=('neigh',)),
+    PluginSpec('conntrack', 'freifunk_telemetry.network:read_conntrack',
+               ['/proc/sys/net/netfilter/nf_conntrack_count'], None, 5),
+    # dumps the whole conntrack table, about 0.9s per 100000 connections
+    PluginSpec('conntrack_table', 'freifunk_telemetry.conntrack:read_conntrack_table',
+               ['/proc/sys/net/netfilter/nf_conntrack_count'], None, 30, enabled=False),
+    PluginSpec('batadv', 'freifunk_telemetry.batadv:read_batadv', ['/sys/module/batman_adv'], None, 30),
+    PluginSpec('snmp', 'freifunk_telemetry.network:read_snmp', ['/proc/net/snmp'], None, 5),
+    PluginSpec('snmp6', 'freifunk_telemetry.network:read_snmp6', ['/proc/net/snmp6'], None, 5),
+    PluginSpec('context_switches', 'freifunk_telemetry.system:read_context_switches', ['/proc/stat'], None, 5),
+    # keep in sync with fastd.SOCKET_GLOB and dhcp.LEASES_FILE, which aren't imported here
+    PluginSpec('fastd', 'freifunk_telemetry.fastd:read_fastd', ['/run/fastd-*.sock'], None, 10),
+    PluginSpec('dhcp_leases', 'freifunk_telemetry.dhcp:read_dhcp_leases', ['/var/lib/dhcp/dhcpd.leases'], 300, 60),
+]
+
+
+def import_target(target):
+    module_name, _, attribute = target.partition(':')
+    return getattr(importlib.import_module(module_name), attribute)
+
+
+def iter_entry_points():
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        import pkg_resources
+        return list(pkg_resources.iter_entry_points(ENTRY_POINT_GROUP))
+
+    eps = entry_points()
+    if hasattr(eps, 'select'):
+        return list(eps.select(group=ENTRY_POINT_GROUP))
+    return list(eps.get(ENTRY_POINT_GROUP, []))
+
+
+def entry_point_spec(entry_point):
+    """
+    An entry point either refers to a `PluginSpec`, so the plugin can be
+    loaded lazily from a lightweight module, or directly to the function.
+    """
+    obj = entry_point.load()
+    if isinstance(obj, PluginSpec):
+        return obj._replace(name=entry_point.name)
+    return PluginSpec(entry_point.name, obj, [], None, 10)
+
+
+def parse_plugin_target(value):
+    name, sep, target = value.partition('=')
+    if not sep or ':' not in target:
+        raise ValueError('expected NAME=MODULE:FUNCTION, got %r' % value)
+    return PluginSpec(name, target, [], None, 10)
+
+
+def sources_exist(sources):
+    return not sources or any(glob.glob(source) for source in sources)
+
+
+class LazyPlugin:
+    """
+    Imports the plugin's function on the first run that finds its data sources.
+
+    Until then every run only checks the sources, so a gateway without
+    dhcpd never imports the dhcp plugin, and fastd being started after the
+    collector is still picked up.
+    """
+
+    def __init__(self, spec):
+        self.spec = spec
+        self._func = spec.target if callable(spec.target) else None
+
+    def __call__(self, update):
+        if self._func is None:
+            if not sources_exist(self.spec.sources):
+                return
+            logger.info('loading plugin %s from %s', self.spec.name, self.spec.target)
+            self._func = import_target(self.spec.target)
+        self._func(update)
+
+
+def get_plugin_specs(extra=(), is_enabled=lambda name, default: default, entry_points=True):
+    """
+    Returns {name: spec} of the builtin, installed and configured plugins.
+
+    Entry points are only loaded if `is_enabled(name, True)`, the specs
+    that are returned have to be checked by the caller.
+    """
+    specs = {spec.name: spec for spec in BUILTIN_PLUGINS}
+    if entry_points:
+        for entry_point in iter_entry_points():
+            if not is_enabled(entry_point.name, True):
+                continue
+            try:
+                specs[entry_point.name] = entry_point_spec(entry_point)
+            except Exception as e:
+                logger.warning('loading plugin %s failed: %s', entry_point.name, e)
+    for spec in extra:
+        specs[spec.name] = spec
+    return specs
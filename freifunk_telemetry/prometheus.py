@@ -0,0 +1,118 @@
+import logging
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from freifunk_telemetry.util import SharedResources, get_hostname, to_number
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+INVALID_CHARS = re.compile(r'[^a-zA-Z0-9_:]')
+
+
+def metric_name(prefix, key):
+    return INVALID_CHARS.sub('_', '%s_%s' % (prefix, key))
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        exporter = self.server.exporter
+        body, count = exporter.body, exporter.count
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        exporter.sent_bytes += len(body)
+        exporter.sent_metrics += count
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class PrometheusExporter:
+    """
+    Serves the latest value of every metric on `/metrics`.
+
+    The exposition text is rendered once per flush, scrapes only ever get
+    the cached body and never trigger a collection. What was sent counts
+    as sent once it was scraped.
+
+    Metrics relayed for other gateways get a `host` label.
+    """
+
+    name = 'prometheus'
+
+    def __init__(self, host='', port=9185, prefix='freifunk'):
+        self.prefix = prefix
+        self.body = b''
+        self.count = 0
+        self.sent_bytes = 0
+        self.sent_metrics = 0
+        self._values = {}
+        self._names = {}
+        self.server = ThreadingHTTPServer((host, port), MetricsHandler)
+        self.server.exporter = self
+        self._thread = threading.Thread(target=self.server.serve_forever, name='prometheus')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def send(self, data, timestamp=None, hostname=None):
+        labels = '' if hostname is None else '{host="%s"}' % get_hostname(hostname).replace('"', '')
+        for key, value in data.items():
+            value = to_number(value)
+            if value is None:
+                continue
+            if key not in self._names:
+                self._names[key] = metric_name(self.prefix, key)
+            self._values[self._names[key], labels] = value
+
+    def flush(self):
+        lines = []
+        previous = None
+        for (name, labels), value in sorted(self._values.items()):
+            # all series of a metric have to follow its TYPE line
+            if name != previous:
+                lines.append('# TYPE %s untyped\n' % name)
+                previous = name
+            lines.append('%s%s %s\n' % (name, labels, value))
+        self.body = ''.join(lines).encode('utf-8')
+        self.count = len(self._values)
+        return True
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self._thread.join()
+
+
+_exporters = SharedResources()
+
+
+def get_exporter(host='', port=9185, prefix='freifunk'):
+    """
+    Returns an exporter listening on (host, port).
+
+    A reload gets the exporter of the old collector, which still listens on
+    the port, instead of failing to bind it a second time.
+    """
+    exporter = _exporters.acquire((host, port), lambda: PrometheusExporter(host, port, prefix))
+    if exporter.prefix != prefix:
+        exporter.prefix = prefix
+        exporter._names = {}
+        exporter._values = {}
+    return exporter
+
+
+def release_exporter(exporter):
+    _exporters.release(exporter)
@@ -0,0 +1,119 @@
+import fnmatch
+import logging
+
+logger = logging.getLogger(__name__)
+
+# metrics that are monotonic counters
+DEFAULT_COUNTERS = [
+    '*.rx.*',
+    '*.tx.*',
+    'context_switches',
+    'ipv4.*',
+    'ipv6.*',
+    'fastd.drops',
+    'fastd.*.drops',
+    '*.link.up_events',
+    '*.link.down_events',
+    'netlink.events',
+    'batadv.*.gateways.changes',
+    'netfilter.conntrack.found',
+    'netfilter.conntrack.invalid',
+    'netfilter.conntrack.insert',
+    'netfilter.conntrack.insert_failed',
+    'netfilter.conntrack.drop',
+    'netfilter.conntrack.early_drop',
+    'netfilter.conntrack.error',
+    'netfilter.conntrack.search_restart',
+]
+# ... except for these, which are gauges or settings
+DEFAULT_GAUGES = [
+    '*.neigh.*',
+    # ranked by traffic, the peer at a rank changes between samples
+    'fastd.*.peers.top.*',
+    'ipv4.Ip.Forwarding',
+    'ipv4.Ip.DefaultTTL',
+    'ipv4.Tcp.RtoAlgorithm',
+    'ipv4.Tcp.RtoMin',
+    'ipv4.Tcp.RtoMax',
+    'ipv4.Tcp.MaxConn',
+    'ipv4.Tcp.CurrEstab',
+]
+
+COUNTER_WIDTHS = (2 ** 32, 2 ** 64)
+
+
+def counter_delta(previous, value):
+    """
+    Returns the increase of a counter, or None if it was reset.
+
+    A decrease is taken as a wrap-around if the previous value was in the
+    upper quarter and the new one is in the lower quarter of the counter's
+    range, anything else (e.g. fastd restarted) as a reset.
+    """
+    if value >= previous:
+        return value - previous
+    for width in COUNTER_WIDTHS:
+        if previous < width:
+            if previous >= width * 3 // 4 and value < width // 4:
+                return width - previous + value
+            return None
+    return None
+
+
+class RateCalculator:
+    """
+    Turns monotonic counters into per-second rates.
+
+    The previous value of every counter is kept together with the
+    monotonic time it was read at. In `add` mode the rate is emitted as
+    `KEY.rate` next to the raw counter, in `replace` mode instead of it.
+    The first sample of a counter and samples after a reset don't get a
+    rate.
+    """
+
+    def __init__(self, mode='add', counters=DEFAULT_COUNTERS, gauges=DEFAULT_GAUGES):
+        if mode not in ('add', 'replace'):
+            raise ValueError('unknown mode %r' % mode)
+        self.mode = mode
+        self.counters = counters
+        self.gauges = gauges
+        self._previous = {}
+        self._is_counter = {}
+
+    def is_counter(self, key):
+        try:
+            return self._is_counter[key]
+        except KeyError:
+            result = self._is_counter[key] = (
+                any(fnmatch.fnmatchcase(key, pattern) for pattern in self.counters) and
+                not any(fnmatch.fnmatchcase(key, pattern) for pattern in self.gauges)
+            )
+            return result
+
+    def process(self, data, now):
+        result = {}
+        for key, value in data.items():
+            if not self.is_counter(key) or not isinstance(value, int):
+                result[key] = value
+                continue
+
+            if self.mode == 'add':
+                result[key] = value
+
+            previous = self._previous.get(key)
+            self._previous[key] = (value, now)
+            if previous is None or now <= previous[1]:
+                continue
+
+            delta = counter_delta(previous[0], value)
+            if delta is None:
+                logger.info('counter %s was reset', key)
+                continue
+
+            rate = delta / (now - previous[1])
+            if self.mode == 'add':
+                result['%s.rate' % key] = rate
+            else:
+                result[key] = rate
+
+        return result
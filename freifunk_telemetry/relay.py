@@ -0,0 +1,379 @@
+import fnmatch
+import logging
+import select
+import socket
+import struct
+import threading
+import time
+import urllib.parse
+
+from freifunk_telemetry.graphite import GraphiteSender
+from freifunk_telemetry.util import get_hostname, to_number
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORT = 2103
+DEFAULT_URL = 'tcp://localhost:%d' % DEFAULT_PORT
+
+# magic, version, length of the frame, timestamp, length of the hostname, number of ints, number of floats,
+# followed by the hostname, the keys (each prefixed with its length) and the int64 and double values
+MAGIC = b'FT'
+VERSION = 1
+HEADER = struct.Struct('!2sBIdBHH')
+MAX_KEY = 255
+MAX_VALUES = 65535
+MAX_FRAME = 1024 * 1024
+INT64 = (-2 ** 63, 2 ** 63 - 1)
+
+# cluster-wide sums sent by the aggregator, NAME=GLOB summed over the latest values of all gateways
+DEFAULT_SUMS = [
+    ('fastd.peers.count', 'fastd.*.peers.count'),
+    ('fastd.peers.online', 'fastd.*.peers.online'),
+    ('dhcpd.active', 'dhcpd.active'),
+    ('dhcpd.current', 'dhcpd.current'),
+]
+
+
+def _pack_frame(hostname, timestamp, ints, floats):
+    keys = b''.join(bytes((len(key),)) + key for key, _ in ints + floats)
+    values = struct.pack('!%dq%dd' % (len(ints), len(floats)), *[value for _, value in ints + floats])
+    length = HEADER.size + len(hostname) + len(keys) + len(values)
+    return HEADER.pack(MAGIC, VERSION, length, timestamp, len(hostname), len(ints), len(floats)) + hostname + \
+        keys + values
+
+
+def encode_frames(hostname, timestamp, items, max_size=MAX_FRAME):
+    """
+    Encodes (key, value) items as frames of at most `max_size` bytes.
+
+    Integers are sent as int64 and everything else as double, so a metric
+    takes its key plus 9 bytes. Every frame is self-contained, it can be
+    sent as a datagram of its own.
+    """
+    hostname = hostname.encode('utf-8')[:255]
+    frames = []
+    ints = []
+    floats = []
+    size = HEADER.size + len(hostname)
+    for key, value in items:
+        key = key.encode('utf-8')
+        value = to_number(value)
+        if value is None or len(key) > MAX_KEY:
+            continue
+        item_size = len(key) + 9
+        if size + item_size > max_size or len(ints) + len(floats) >= MAX_VALUES:
+            if ints or floats:
+                frames.append(_pack_frame(hostname, timestamp, ints, floats))
+            ints = []
+            floats = []
+            size = HEADER.size + len(hostname)
+        if isinstance(value, int) and INT64[0] <= value <= INT64[1]:
+            ints.append((key, value))
+        else:
+            floats.append((key, float(value)))
+        size += item_size
+    if ints or floats:
+        frames.append(_pack_frame(hostname, timestamp, ints, floats))
+    return frames
+
+
+def frame_length(buffer, offset=0):
+    "returns the length of the frame at `offset`, or None if the header isn't complete yet"
+    if len(buffer) - offset < HEADER.size:
+        return None
+    magic, version, length = HEADER.unpack_from(buffer, offset)[:3]
+    if magic != MAGIC or version != VERSION or not HEADER.size <= length <= MAX_FRAME:
+        raise ValueError('not a relay frame')
+    return length
+
+
+def decode_frame(buffer, offset=0):
+    "returns (hostname, timestamp, {key: value}) of the frame at `offset`"
+    try:
+        return _decode_frame(buffer, offset)
+    except (struct.error, IndexError):
+        raise ValueError('malformed relay frame')
+
+
+def _decode_frame(buffer, offset):
+    _, _, length, timestamp, hostname_length, int_count, float_count = HEADER.unpack_from(buffer, offset)
+    end = offset + length
+    if end > len(buffer):
+        raise ValueError('truncated relay frame')
+    offset += HEADER.size
+    hostname = bytes(buffer[offset:offset + hostname_length]).decode('utf-8', 'replace')
+    offset += hostname_length
+
+    keys = []
+    for _ in range(int_count + float_count):
+        key_length = buffer[offset]
+        keys.append(bytes(buffer[offset + 1:offset + 1 + key_length]).decode('utf-8', 'replace'))
+        offset += 1 + key_length
+    values = struct.unpack_from('!%dq%dd' % (int_count, float_count), buffer, offset)
+    if offset + 8 * len(values) != end:
+        raise ValueError('malformed relay frame')
+    return hostname, timestamp, dict(zip(keys, values))
+
+
+def parse_url(url):
+    "returns (scheme, host, port) of a udp:// or tcp:// url"
+    parsed = urllib.parse.urlsplit(url)
+    if parsed.scheme not in ('udp', 'tcp') or not parsed.hostname:
+        raise ValueError('expected udp://HOST:PORT or tcp://HOST:PORT, got %r' % url)
+    return parsed.scheme, parsed.hostname, parsed.port or DEFAULT_PORT
+
+
+class RelaySender(GraphiteSender):
+    """
+    Sends the metrics to an aggregator as binary frames.
+
+    Over TCP the connection is kept open like the one to carbon, including
+    backoff and spooling. Over UDP every frame is a datagram of at most
+    `max_datagram` bytes, frames that get lost are not sent again.
+    """
+
+    name = 'relay'
+
+    def __init__(self, url=DEFAULT_URL, hostname=None, max_datagram=1432, **kwargs):
+        self.scheme, host, port = parse_url(url)
+        super().__init__(host, port, hostname=hostname, **kwargs)
+        self.hostname = get_hostname(hostname)
+        self.max_frame = max_datagram if self.scheme == 'udp' else 64 * 1024
+
+    def _get_prefix(self, hostname):
+        # the aggregator adds the prefix, only the hostname goes into the frames
+        return self.hostname if hostname is None else get_hostname(hostname)
+
+    def _format(self, data, hostname, timestamp):
+        return [(hostname, timestamp, key, value) for key, value in data.items()]
+
+    def _encode(self, metrics):
+        frames = []
+        start = 0
+        for i in range(1, len(metrics) + 1):
+            if i == len(metrics) or metrics[i][:2] != metrics[start][:2]:
+                hostname, timestamp = metrics[start][:2]
+                frames.extend(encode_frames(hostname, timestamp,
+                                            [metric[2:] for metric in metrics[start:i]], self.max_frame))
+                start = i
+        return b''.join(frames)
+
+    def _connect(self):
+        if self.scheme == 'tcp':
+            return super()._connect()
+        sock = socket.socket(socket.AF_INET6 if ':' in self.host else socket.AF_INET, socket.SOCK_DGRAM)
+        sock.connect((self.host, self.port))
+        return sock
+
+    def _is_connected(self):
+        if self.scheme == 'tcp':
+            return super()._is_connected()
+        return self._sock is not None
+
+    def _write(self, payload):
+        if self.scheme == 'tcp':
+            self._sock.sendall(payload)
+            return
+        offset = 0
+        while offset < len(payload):
+            length = frame_length(payload, offset)
+            self._sock.send(payload[offset:offset + length])
+            offset += length
+
+
+class Aggregator:
+    """
+    Receives the frames of `RelaySender`s over UDP and TCP on (host, port).
+
+    Frames are merged into one sample per gateway and timestamp until they
+    are taken with `drain()`, at most `max_metrics` are kept, the oldest
+    samples are dropped first. The latest value of every metric of every
+    gateway is kept for `sums()`.
+    """
+
+    def __init__(self, host='', port=DEFAULT_PORT, max_metrics=1000000):
+        self.listen = (host, port)
+        family = socket.AF_INET6 if ':' in host else socket.AF_INET
+        self._udp = socket.socket(family, socket.SOCK_DGRAM)
+        self._udp.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        self._udp.bind((host, port))
+        self._tcp = socket.socket(family, socket.SOCK_STREAM)
+        self._tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._tcp.bind((host, self._udp.getsockname()[1]))
+        self._tcp.listen(64)
+        self.address = self._tcp.getsockname()[:2]
+        self.max_metrics = max_metrics
+
+        self._lock = threading.Lock()
+        self._running = True
+        # connection -> received bytes that don't make a whole frame yet
+        self._clients = {}
+        # (hostname, timestamp) -> {key: value}, in the order they were received
+        self._pending = {}
+        self._pending_metrics = 0
+        # hostname -> {key: (value, time received)}
+        self._latest = {}
+        # key -> the names of the sums it is part of
+        self._sum_keys = {}
+        self._sums = None
+
+        self.frames = 0
+        self.received_bytes = 0
+        self.errors = 0
+        self.dropped = 0
+
+        self._thread = threading.Thread(target=self._run, name='relay-aggregator')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        self._running = False
+        self._thread.join()
+        for sock in list(self._clients) + [self._udp, self._tcp]:
+            sock.close()
+
+    def _run(self):
+        while self._running:
+            readable, _, _ = select.select([self._udp, self._tcp] + list(self._clients), [], [], 0.5)
+            for sock in readable:
+                try:
+                    if sock is self._udp:
+                        self._receive_datagram()
+                    elif sock is self._tcp:
+                        conn, _ = self._tcp.accept()
+                        self._clients[conn] = bytearray()
+                    else:
+                        self._receive_stream(sock)
+                except Exception as e:
+                    logger.warning('receiving relayed metrics failed: %s', e)
+                    self.errors += 1
+
+    def _receive_datagram(self):
+        payload = self._udp.recv(65536)
+        self.received_bytes += len(payload)
+        offset = 0
+        while offset < len(payload):
+            length = frame_length(payload, offset)
+            if length is None:
+                raise ValueError('truncated relay frame')
+            self._add(*decode_frame(payload, offset))
+            offset += length
+
+    def _receive_stream(self, conn):
+        buffer = self._clients[conn]
+        try:
+            data = conn.recv(256 * 1024)
+        except OSError:
+            data = b''
+        if not data:
+            del self._clients[conn]
+            conn.close()
+            return
+        self.received_bytes += len(data)
+        buffer.extend(data)
+
+        offset = 0
+        try:
+            while True:
+                length = frame_length(buffer, offset)
+                if length is None or offset + length > len(buffer):
+                    break
+                self._add(*decode_frame(buffer, offset))
+                offset += length
+        except ValueError:
+            # the stream can't be resynchronized, the sender reconnects
+            del self._clients[conn]
+            conn.close()
+            raise
+        del buffer[:offset]
+
+    def _add(self, hostname, timestamp, data):
+        now = time.monotonic()
+        with self._lock:
+            self.frames += 1
+            self._pending.setdefault((hostname, timestamp), {}).update(data)
+            self._pending_metrics += len(data)
+            while self._pending_metrics > self.max_metrics and len(self._pending) > 1:
+                dropped = self._pending.pop(next(iter(self._pending)))
+                self._pending_metrics -= len(dropped)
+                self.dropped += len(dropped)
+
+            latest = self._latest.setdefault(hostname, {})
+            for key, value in data.items():
+                latest[key] = (value, now)
+
+    def drain(self):
+        "returns [(hostname, timestamp, data)] of everything received since the last call"
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+            self._pending_metrics = 0
+        return [(hostname, timestamp, data) for (hostname, timestamp), data in pending.items()]
+
+    def _sum_names(self, key, sums):
+        try:
+            return self._sum_keys[key]
+        except KeyError:
+            pass
+        names = self._sum_keys[key] = [name for name, pattern in sums if fnmatch.fnmatchcase(key, pattern)]
+        return names
+
+    def sums(self, sums=DEFAULT_SUMS, max_age=300):
+        """
+        Returns {NAME: sum} of the latest values matching GLOB of all
+        gateways, for each (NAME, GLOB) in `sums`, and the number of
+        gateways heard from. Values older than `max_age` seconds are
+        forgotten.
+        """
+        if sums is not self._sums:
+            self._sum_keys = {}
+            self._sums = sums
+        result = dict.fromkeys([name for name, _ in sums], 0)
+        deadline = time.monotonic() - max_age
+        with self._lock:
+            for hostname in list(self._latest):
+                latest = self._latest[hostname]
+                for key in [key for key, (_, received) in latest.items() if received < deadline]:
+                    del latest[key]
+                if not latest:
+                    del self._latest[hostname]
+                    continue
+                for key, (value, _) in latest.items():
+                    for name in self._sum_names(key, sums):
+                        result[name] += value
+            result['gateways'] = len(self._latest)
+        return result
+
+    def stats(self):
+        return {
+            'telemetry.relay.frames': self.frames,
+            'telemetry.relay.bytes': self.received_bytes,
+            'telemetry.relay.errors': self.errors,
+            'telemetry.relay.dropped': self.dropped,
+            'telemetry.relay.connections': len(self._clients),
+        }
+
+
+_aggregator = None
+
+
+def get_aggregator(host='', port=DEFAULT_PORT):
+    """
+    Returns the aggregator listening on (host, port).
+
+    It outlives the collector, so a reload doesn't drop what was received
+    in between or fail to bind the port that is still in use.
+    """
+    global _aggregator
+    if _aggregator is not None and _aggregator.listen != (host, port):
+        close_aggregator()
+    if _aggregator is None:
+        _aggregator = Aggregator(host, port)
+    return _aggregator
+
+
+def close_aggregator():
+    global _aggregator
+    if _aggregator is not None:
+        _aggregator.close()
+        _aggregator = None
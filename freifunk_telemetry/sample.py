@@ -0,0 +1,195 @@
+import fnmatch
+import re
+import sys
+from array import array
+from collections.abc import Mapping
+
+from freifunk_telemetry.util import to_number
+
+INVALID_KEY_CHARS = re.compile(r'[^A-Za-z0-9_.:-]')
+INT64 = (-2 ** 63, 2 ** 63 - 1)
+
+# key tuple -> (the same tuple, {key: index}), shared by all samples with the same keys
+_key_tables = {}
+MAX_KEY_TABLES = 256
+MAX_CACHED_KEYS = 65536
+
+
+def normalize_key(key):
+    return sys.intern(INVALID_KEY_CHARS.sub('_', key))
+
+
+def _key_table(keys, shared=True):
+    if not shared:
+        return keys, {key: i for i, key in enumerate(keys)}
+    try:
+        return _key_tables[keys]
+    except KeyError:
+        pass
+    if len(_key_tables) >= MAX_KEY_TABLES:
+        _key_tables.clear()
+    table = _key_tables[keys] = (keys, {key: i for i, key in enumerate(keys)})
+    return table
+
+
+class Sample(Mapping):
+    """
+    A read-only, compact mapping of metric keys to numbers.
+
+    Integers are kept in an array of int64, everything else (floats, and
+    counters beyond int64) in an array of doubles. A plugin produces the
+    same keys every run, so the key tuples and their index are shared
+    between all samples with the same set of keys. Samples whose keys
+    change from run to run, e.g. because unchanged values were left out,
+    are created with `shared_keys=False` and get tables of their own,
+    instead of pushing the stable ones out of the cache.
+    """
+
+    __slots__ = ('_int_keys', '_int_index', '_ints', '_float_keys', '_float_index', '_floats')
+
+    def __init__(self, data=(), shared_keys=True):
+        int_keys = []
+        ints = array('q')
+        float_keys = []
+        floats = array('d')
+        for key, value in data.items():
+            if isinstance(value, int) and INT64[0] <= value <= INT64[1]:
+                int_keys.append(key)
+                ints.append(value)
+            else:
+                float_keys.append(key)
+                floats.append(value)
+        self._int_keys, self._int_index = _key_table(tuple(int_keys), shared_keys)
+        self._ints = ints
+        self._float_keys, self._float_index = _key_table(tuple(float_keys), shared_keys)
+        self._floats = floats
+
+    def __getitem__(self, key):
+        i = self._int_index.get(key)
+        if i is not None:
+            return self._ints[i]
+        return self._floats[self._float_index[key]]
+
+    def __iter__(self):
+        yield from self._int_keys
+        yield from self._float_keys
+
+    def __len__(self):
+        return len(self._int_keys) + len(self._float_keys)
+
+    def items(self):
+        yield from zip(self._int_keys, self._ints)
+        yield from zip(self._float_keys, self._floats)
+
+    def __repr__(self):
+        return 'Sample(%r)' % dict(self.items())
+
+
+class SampleFilter:
+    """
+    Turns an update into a `Sample`.
+
+    Keys are normalized to characters every backend can take, values that
+    aren't numbers are dropped. Only keys matching one of the `include`
+    globs (if any are given) and none of the `exclude` globs are kept.
+    With `skip_zero` series that have never been anything but zero, like
+    most of the SNMP error counters, are not sent.
+
+    `dead_bands` is a list of `(glob, delta, relative)`: a value of a
+    matching series is not sent if it differs from the last value sent by
+    at most `delta` (percent of the last value if `relative`). The first
+    matching glob wins, with `skip_unchanged` all other series get a
+    dead-band of zero, i.e. only changed values are sent. Every
+    `heartbeat`th value of a series is sent regardless, so graphite
+    doesn't show it as a gap.
+
+    Updates relayed for other gateways are passed with their `hostname`,
+    the globs match their keys as they are, but each gateway's series are
+    suppressed on their own.
+    """
+
+    def __init__(self, include=(), exclude=(), skip_zero=False, skip_unchanged=False, dead_bands=(), heartbeat=10):
+        self.include = include
+        self.exclude = exclude
+        self.skip_zero = skip_zero
+        self.skip_unchanged = skip_unchanged
+        self.dead_bands = dead_bands
+        self.heartbeat = heartbeat
+        self._keys = {}
+        self._bands = {}
+        self._nonzero = set()
+        # key -> [last value sent, number of values skipped since]
+        self._last = {}
+
+    def _key(self, key):
+        try:
+            return self._keys[key]
+        except KeyError:
+            pass
+        if len(self._keys) >= MAX_CACHED_KEYS:
+            self._keys.clear()
+        normalized = normalize_key(key)
+        if self.include and not any(fnmatch.fnmatchcase(normalized, pattern) for pattern in self.include):
+            normalized = None
+        elif any(fnmatch.fnmatchcase(normalized, pattern) for pattern in self.exclude):
+            normalized = None
+        self._keys[key] = normalized
+        return normalized
+
+    def _band(self, key):
+        try:
+            return self._bands[key]
+        except KeyError:
+            pass
+        if len(self._bands) >= MAX_CACHED_KEYS:
+            self._bands.clear()
+        band = (0, False) if self.skip_unchanged else None
+        for pattern, delta, relative in self.dead_bands:
+            if fnmatch.fnmatchcase(key, pattern):
+                band = (delta, relative)
+                break
+        self._bands[key] = band
+        return band
+
+    def _suppress(self, key, value, series):
+        band = self._band(key)
+        if band is None:
+            return False
+
+        last = self._last.get(series)
+        if last is not None and (not self.heartbeat or last[1] + 1 < self.heartbeat):
+            delta, relative = band
+            if relative:
+                delta = abs(last[0]) * delta / 100
+            if abs(value - last[0]) <= delta:
+                last[1] += 1
+                return True
+
+        self._last[series] = [value, 0]
+        return False
+
+    def process(self, data, now, hostname=None):
+        result = {}
+        # whether values were left out that may be sent next time
+        varying = False
+        for key, value in data.items():
+            key = self._key(key)
+            if key is None:
+                continue
+            value = to_number(value)
+            if value is None:
+                continue
+
+            series = key if hostname is None else (hostname, key)
+            if self.skip_zero:
+                if value:
+                    self._nonzero.add(series)
+                elif series not in self._nonzero:
+                    varying = True
+                    continue
+            if self._suppress(key, value, series):
+                varying = True
+                continue
+
+            result[key] = value
+        return Sample(result, shared_keys=not varying)
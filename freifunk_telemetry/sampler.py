@@ -0,0 +1,188 @@
+import fnmatch
+import logging
+import math
+import os
+import threading
+import time
+from array import array
+
+from freifunk_telemetry.rates import counter_delta
+
+logger = logging.getLogger(__name__)
+
+SYSFS_NET = '/sys/class/net'
+COUNTERS = [(direction, field) for direction in ['rx', 'tx'] for field in ['bytes', 'packets']]
+# the interfaces are looked up again every this many samples, e.g. for tunnels that came up
+DISCOVER_EVERY = 60
+
+
+def summarize(rates):
+    "returns (min, max, mean, p95) of the rates, p95 by nearest rank"
+    rates = sorted(rates)
+    return rates[0], rates[-1], sum(rates) / len(rates), rates[math.ceil(len(rates) * 0.95) - 1]
+
+
+class InterfaceSampler:
+    """
+    Samples the byte and packet counters of some interfaces at a high rate.
+
+    Only the interfaces matching one of `patterns` are read, from their
+    sysfs statistics files, which are kept open and re-read with one
+    pread() each, instead of parsing all of /proc/net/dev. The rates
+    between two samples go into a ring buffer preallocated for `capacity`
+    samples, which `report()` summarizes and empties, so bursts shorter
+    than the reporting interval are visible without sending every sample.
+
+    `start()` runs `sample()` every `interval` seconds on a thread of its
+    own.
+    """
+
+    def __init__(self, patterns, interval=1, capacity=120, sysfs=SYSFS_NET):
+        self.patterns = patterns
+        self.interval = interval
+        self.capacity = capacity
+        self.sysfs = sysfs
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        self._interfaces = []
+        self._keys = []
+        self._fds = []
+        self._last = None
+        self._last_time = None
+        # capacity rows of one rate per series, NaN where a counter was reset
+        self._rates = array('d')
+        self._slot = 0
+        self._count = 0
+        self._samples = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='interface-sampler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._reset()
+
+    def _reset(self):
+        for fd in self._fds:
+            os.close(fd)
+        self._fds = []
+        self._interfaces = []
+        self._keys = []
+        self._rates = array('d')
+        self._slot = self._count = 0
+        self._last = None
+
+    def _run(self):
+        next_run = time.monotonic()
+        while not self._stop.is_set():
+            try:
+                self.sample(time.monotonic())
+            except Exception:
+                logger.exception('sampling interface counters failed')
+            next_run += self.interval
+            now = time.monotonic()
+            if next_run <= now:
+                next_run = now + self.interval
+            self._stop.wait(next_run - now)
+
+    def _discover(self):
+        from freifunk_telemetry.network import DEVICE_NAME_MAPPING
+
+        interfaces = sorted(name for name in os.listdir(self.sysfs)
+                            if any(fnmatch.fnmatchcase(name, pattern) for pattern in self.patterns))
+        if interfaces == self._interfaces:
+            return
+
+        self._reset()
+        keys = []
+        for name in interfaces:
+            device_name = DEVICE_NAME_MAPPING.get(name, name)
+            for direction, field in COUNTERS:
+                try:
+                    self._fds.append(os.open(os.path.join(self.sysfs, name, 'statistics', '%s_%s' % (direction, field)),
+                                             os.O_RDONLY))
+                except OSError:
+                    # gone already, try again with the next discovery
+                    self._reset()
+                    return
+                keys.append('%s.%s.%s.rate' % (device_name, direction, field))
+        self._interfaces = interfaces
+        self._keys = keys
+        self._rates = array('d', bytes(8 * len(keys) * self.capacity))
+
+    def sample(self, now):
+        with self._lock:
+            if self._samples % DISCOVER_EVERY == 0:
+                self._discover()
+            self._samples += 1
+
+            try:
+                values = [int(os.pread(fd, 32, 0)) for fd in self._fds]
+            except OSError:
+                # an interface went away, look them up again with the next sample
+                self._reset()
+                self._samples = 0
+                return
+
+            if self._last is not None and now > self._last_time:
+                elapsed = now - self._last_time
+                rates = self._rates
+                row = self._slot * len(values)
+                for i, (previous, value) in enumerate(zip(self._last, values)):
+                    delta = counter_delta(previous, value)
+                    rates[row + i] = math.nan if delta is None else delta / elapsed
+                self._slot = (self._slot + 1) % self.capacity
+                self._count = min(self._count + 1, self.capacity)
+            self._last = values
+            self._last_time = now
+
+    def report(self):
+        "returns min, max, mean and p95 of every series' rates since the last report"
+        update = {}
+        with self._lock:
+            count = self._count
+            self._count = 0
+            if not count:
+                return update
+            columns = len(self._keys)
+            rows = [(self._slot - count + i) % self.capacity for i in range(count)]
+            for i, key in enumerate(self._keys):
+                rates = [rate for rate in (self._rates[row * columns + i] for row in rows) if rate == rate]
+                if not rates:
+                    continue
+                (update['%s.min' % key], update['%s.max' % key], update['%s.mean' % key],
+                 update['%s.p95' % key]) = summarize(rates)
+        return update
+
+
+_sampler = None
+
+
+def get_sampler(patterns, interval=1, capacity=120):
+    """
+    Returns the running sampler for these settings.
+
+    Like the aggregator it outlives the collector, so a reload doesn't lose
+    the samples taken so far.
+    """
+    global _sampler
+    if _sampler is not None and (_sampler.patterns, _sampler.interval, _sampler.capacity) != \
+            (patterns, interval, capacity):
+        close_sampler()
+    if _sampler is None:
+        _sampler = InterfaceSampler(patterns, interval, capacity)
+        _sampler.start()
+    return _sampler
+
+
+def close_sampler():
+    global _sampler
+    if _sampler is not None:
+        _sampler.close()
+        _sampler = None
@@ -0,0 +1,173 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+logger = logging.getLogger(__name__)
+
+# a plugin counts as due if it is at most this many seconds early, so it doesn't
+# slip a whole tick because the daemon woke up a few milliseconds "too early"
+SLACK = 0.5
+
+
+class Plugin:
+    def __init__(self, func, interval, timeout, name=None):
+        if name is None:
+            name = func.__name__
+            if name.startswith('read_'):
+                name = name[len('read_'):]
+        self.func = func
+        self.name = name
+        self.interval = interval
+        self.timeout = timeout
+        self.next_run = None
+        self.running = False
+        self.finished = False
+        self.timed_out = False
+
+    def is_due(self, now):
+        return self.next_run is None or self.next_run - SLACK <= now
+
+    def schedule_next(self, now):
+        if self.next_run is None:
+            self.next_run = now
+        self.next_run += self.interval
+        if self.next_run <= now:
+            self.next_run = now + self.interval
+
+    def __call__(self):
+        timestamp = time.time()
+        update = {}
+        self.func(update)
+        return timestamp, update
+
+    def __repr__(self):
+        return '<Plugin %s interval=%s timeout=%s>' % (self.name, self.interval, self.timeout)
+
+
+class Scheduler:
+    """
+    Runs every due plugin concurrently on a thread pool.
+
+    `run()` returns a list of `(timestamp, update)` batches, one for every
+    plugin that finished in time, stamped with the time the plugin started.
+    Every batch is passed through the `process(update, monotonic_time)` of
+    each stage, in the plugin's thread.
+
+    Each plugin has its own interval and timeout. `run()` returns once the
+    plugins it started are done, or after the shortest timeout of all
+    plugins. Plugins that are still running then are handed in by a later
+    `run()` if they finish within their own timeout. `run(force=True)`, used
+    when collecting only once, starts every plugin and waits for each up to
+    its own timeout instead. A plugin that misses its
+    timeout is dropped and is not started again until its thread returned,
+    so a stalled or slow data source never holds back the others and never
+    eats up the pool.
+
+    Durations and outcomes of the plugins are reported to `instrumentation`,
+    plugins run through `profiler.call()` if one is given.
+    """
+
+    def __init__(self, plugins, stages=(), instrumentation=None, profiler=None):
+        self.plugins = plugins
+        self.stages = stages
+        self.instrumentation = instrumentation
+        self.profiler = profiler
+        self.executor = ThreadPoolExecutor(max_workers=max(len(plugins), 1))
+        # {future: (plugin, deadline)} of the plugins that were started and not handed in yet
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def _process(self, plugin, now):
+        timestamp, update = plugin()
+        for stage in self.stages:
+            update = stage.process(update, now)
+        return timestamp, update
+
+    def _collect(self, plugin):
+        now = time.monotonic()
+        success = False
+        try:
+            if self.profiler is not None:
+                result = self.profiler.call(self._process, plugin, now)
+            else:
+                result = self._process(plugin, now)
+            success = True
+            return result
+        finally:
+            with self._lock:
+                # a run that timed out was counted as that already
+                if not plugin.timed_out:
+                    plugin.finished = True
+                    if self.instrumentation is not None:
+                        self.instrumentation.plugin_finished(plugin.name, time.monotonic() - now, success)
+
+    @property
+    def interval(self):
+        "the shortest interval of the plugins, None without plugins"
+        if not self.plugins:
+            return None
+        return min(plugin.interval for plugin in self.plugins)
+
+    def _time_out(self, future):
+        plugin = self._pending[future][0]
+        with self._lock:
+            if plugin.finished:
+                # its result is about to be handed in
+                return
+            plugin.timed_out = True
+        logger.warning('plugin %s timed out after %ss', plugin.name, plugin.timeout)
+        if self.instrumentation is not None:
+            self.instrumentation.plugin_timed_out(plugin.name)
+        del self._pending[future]
+
+    def run(self, force=False):
+        now = time.monotonic()
+
+        started = False
+        for plugin in self.plugins:
+            if plugin.running:
+                logger.warning('plugin %s is still running, skipping it', plugin.name)
+                if self.instrumentation is not None:
+                    self.instrumentation.plugin_skipped(plugin.name)
+                continue
+            if not (force or plugin.is_due(now)):
+                continue
+
+            plugin.schedule_next(now)
+            plugin.running = True
+            plugin.finished = plugin.timed_out = False
+            future = self.executor.submit(self._collect, plugin)
+            future.add_done_callback(lambda f, plugin=plugin: setattr(plugin, 'running', False))
+            self._pending[future] = (plugin, now + plugin.timeout)
+            started = True
+
+        if force:
+            # there is no later run, wait for every plugin up to its own deadline
+            tick_deadline = max([now] + [deadline for _, deadline in self._pending.values()])
+        elif started:
+            tick_deadline = now + min(plugin.timeout for plugin in self.plugins)
+        else:
+            # without new plugins only what finished since the last run is handed in
+            tick_deadline = now
+        batches = []
+        while self._pending:
+            timeout = min([tick_deadline] + [deadline for _, deadline in self._pending.values()]) - time.monotonic()
+            done, _ = wait(list(self._pending), timeout=max(timeout, 0), return_when=FIRST_COMPLETED)
+            for future in done:
+                plugin = self._pending.pop(future)[0]
+                try:
+                    batches.append(future.result())
+                except Exception as e:
+                    logger.exception('plugin %s failed: %s', plugin.name, e)
+
+            now = time.monotonic()
+            for future in [f for f, (_, deadline) in self._pending.items() if deadline <= now]:
+                self._time_out(future)
+            if now >= tick_deadline:
+                break
+
+        return batches
+
+    def close(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,157 @@
+import logging
+import mmap
+import os
+import struct
+import time
+
+from freifunk_telemetry.util import SharedResources
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'FFTS'
+
+# magic, number of records, head (next write), tail (oldest record), dropped records
+HEADER = struct.Struct('<4sIQQQ')
+# payload length, time the record was spooled at
+RECORD = struct.Struct('<Id')
+WRAP = 0xffffffff
+
+
+class Spool:
+    """
+    Bounded on-disk ring buffer of length-prefixed records.
+
+    The file is memory-mapped, appends and pops only touch the header and
+    the record itself. When the ring is full the oldest records are dropped.
+    """
+
+    def __init__(self, filename, size=16 * 1024 * 1024):
+        if size <= HEADER.size + RECORD.size:
+            raise ValueError('spool size too small: %d' % size)
+
+        self.filename = filename
+        self.capacity = size - HEADER.size
+
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fresh = os.fstat(fd).st_size != size
+            if fresh:
+                os.ftruncate(fd, size)
+            self._mmap = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        magic, self.count, self.head, self.tail, self.dropped = HEADER.unpack_from(self._mmap, 0)
+        if not fresh and magic != MAGIC:
+            logger.warning('spool %s is corrupt, starting over', filename)
+        if fresh or magic != MAGIC:
+            self.count = self.head = self.tail = self.dropped = 0
+            self._write_header()
+
+    def _write_header(self):
+        HEADER.pack_into(self._mmap, 0, MAGIC, self.count, self.head, self.tail, self.dropped)
+
+    def _record_at(self, offset):
+        # returns the offset the record really starts at, taking wrap-arounds into account
+        if self.capacity - offset < RECORD.size:
+            return 0
+        length, _ = RECORD.unpack_from(self._mmap, HEADER.size + offset)
+        if length == WRAP:
+            return 0
+        return offset
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def used(self):
+        if self.count == 0:
+            return 0
+        if self.head > self.tail:
+            return self.head - self.tail
+        return self.capacity - self.tail + self.head
+
+    def _drop_oldest(self):
+        self._pop()
+        self.dropped += 1
+
+    def _pop(self):
+        length, _ = RECORD.unpack_from(self._mmap, HEADER.size + self.tail)
+        self.count -= 1
+        if self.count == 0:
+            self.head = self.tail = 0
+        else:
+            self.tail = self._record_at(self.tail + RECORD.size + length)
+
+    def append(self, payload, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+
+        size = RECORD.size + len(payload)
+        if size > self.capacity:
+            logger.warning('record of %d bytes does not fit into spool %s', len(payload), self.filename)
+            self.dropped += 1
+            self._write_header()
+            return
+
+        while True:
+            if self.count == 0 or self.head > self.tail:
+                # free space is between head and the end, and between the start and tail
+                if self.capacity - self.head >= size:
+                    break
+                if self.tail >= size:
+                    if self.capacity - self.head >= RECORD.size:
+                        RECORD.pack_into(self._mmap, HEADER.size + self.head, WRAP, 0)
+                    self.head = 0
+                    break
+            elif self.tail - self.head >= size:
+                break
+            self._drop_oldest()
+
+        offset = HEADER.size + self.head
+        RECORD.pack_into(self._mmap, offset, len(payload), timestamp)
+        self._mmap[offset + RECORD.size:offset + size] = payload
+        self.head += size
+        self.count += 1
+        self._write_header()
+
+    def peek(self):
+        if self.count == 0:
+            return None
+        offset = HEADER.size + self.tail
+        length, timestamp = RECORD.unpack_from(self._mmap, offset)
+        return timestamp, self._mmap[offset + RECORD.size:offset + RECORD.size + length]
+
+    def pop(self):
+        if self.count:
+            self._pop()
+            self._write_header()
+
+    def stats(self):
+        oldest = self.peek()
+        return {
+            'telemetry.spool.records': self.count,
+            'telemetry.spool.bytes': self.used,
+            'telemetry.spool.dropped': self.dropped,
+            'telemetry.spool.age': round(time.time() - oldest[0], 3) if oldest else 0,
+        }
+
+    def close(self):
+        self._mmap.close()
+
+
+_spools = SharedResources()
+
+
+def get_spool(filename, size=16 * 1024 * 1024):
+    """
+    Returns the spool in `filename`.
+
+    On a reload the old sender spools what it still has into the same
+    mapping the new sender drains.
+    """
+    return _spools.acquire((filename, size), lambda: Spool(filename, size))
+
+
+def release_spool(spool):
+    _spools.release(spool)
@@ -0,0 +1,56 @@
+import logging
+import socket
+
+from freifunk_telemetry.graphite import get_metric_prefix
+from freifunk_telemetry.util import to_number, pack_datagrams
+
+logger = logging.getLogger(__name__)
+
+
+class StatsDSender:
+    """
+    Sends every metric as a statsd gauge, several per datagram.
+
+    StatsD doesn't know about timestamps, the metrics are stamped by the
+    statsd daemon when they arrive.
+    """
+
+    name = 'statsd'
+
+    def __init__(self, host='localhost', port=8125, prefix='freifunk', hostname=None, max_datagram=1432):
+        self.address = (host, port)
+        self.base_prefix = prefix
+        self.prefix = get_metric_prefix(prefix, hostname)
+        self.max_datagram = max_datagram
+        self._lines = []
+        self.sent_bytes = 0
+        self.sent_metrics = 0
+        self._sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, data, timestamp=None, hostname=None):
+        prefix = self.prefix if hostname is None else get_metric_prefix(self.base_prefix, hostname)
+        for key, value in data.items():
+            value = to_number(value)
+            if value is None:
+                continue
+            # gauges can't be set to negative values directly, they would be taken as a decrement
+            if value < 0:
+                self._lines.append(('%s.%s:0|g' % (prefix, key)).encode('utf-8'))
+            self._lines.append(('%s.%s:%s|g' % (prefix, key, value)).encode('utf-8'))
+
+    def flush(self):
+        try:
+            for payload in pack_datagrams(self._lines, self.max_datagram):
+                self._sock.sendto(payload, self.address)
+                self.sent_bytes += len(payload)
+        except OSError as e:
+            logger.warning('sending to statsd at %s:%s failed: %s', self.address[0], self.address[1], e)
+            return False
+        else:
+            self.sent_metrics += len(self._lines)
+        finally:
+            del self._lines[:]
+        return True
+
+    def close(self):
+        self._sock.close()
@@ -0,0 +1,206 @@
+import fnmatch
+import logging
+import mmap
+import os
+import struct
+import time
+
+from freifunk_telemetry.rates import counter_delta
+from freifunk_telemetry.util import SharedResources, to_number
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'FFTD'
+VERSION = 1
+
+# magic, version, slots per series, maximum number of series, series in use
+HEADER = struct.Struct('=4sIIII4x')
+# key, next slot to write, number of slots written
+KEY_SIZE = 120
+SERIES = struct.Struct('=%dsII' % KEY_SIZE)
+
+
+def file_size(slots, max_series):
+    return HEADER.size + max_series * SERIES.size + max_series * slots * 16
+
+
+class TimeSeriesStore:
+    """
+    Keeps the last `slots` values of up to `max_series` series in a file.
+
+    The file is memory-mapped and laid out in columns: a table of series
+    keys, then for every series a fixed block of `slots` timestamps followed
+    by `slots` values, both doubles in native byte order. Appending a value
+    writes one timestamp, one value and the series' position, whatever the
+    size of the store, and the file never grows. Series beyond
+    `max_series` are dropped.
+
+    As an output it stores everything sent to it, a reader can open the
+    same file `readonly` at the same time.
+    """
+
+    name = 'store'
+
+    def __init__(self, filename, slots=360, max_series=4096, readonly=False):
+        self.filename = filename
+        self.readonly = readonly
+        self.dropped = 0
+        self.sent_bytes = 0
+        self.sent_metrics = 0
+
+        if readonly:
+            with open(filename, 'rb') as fh:
+                magic, version, slots, max_series, _ = HEADER.unpack(fh.read(HEADER.size))
+            if magic != MAGIC or version != VERSION:
+                raise ValueError('%s is not a time series store' % filename)
+        elif not self._matches(filename, slots, max_series):
+            self._create(filename, slots, max_series)
+
+        self.slots = slots
+        self.max_series = max_series
+        fd = os.open(filename, os.O_RDONLY if readonly else os.O_RDWR)
+        try:
+            self._mmap = mmap.mmap(fd, file_size(slots, max_series),
+                                   access=mmap.ACCESS_READ if readonly else mmap.ACCESS_WRITE)
+        finally:
+            os.close(fd)
+        self._doubles = memoryview(self._mmap).cast('d')
+        self._uints = memoryview(self._mmap).cast('I')
+        self._data = (HEADER.size + max_series * SERIES.size) // 8
+
+        self._index = {}
+        self._load_keys()
+
+    @staticmethod
+    def _matches(filename, slots, max_series):
+        try:
+            with open(filename, 'rb') as fh:
+                header = fh.read(HEADER.size)
+                size = os.fstat(fh.fileno()).st_size
+        except FileNotFoundError:
+            return False
+        if len(header) == HEADER.size and HEADER.unpack(header)[:4] == (MAGIC, VERSION, slots, max_series) and \
+                size == file_size(slots, max_series):
+            return True
+        logger.warning('time series store %s has a different size, starting over', filename)
+        return False
+
+    @staticmethod
+    def _create(filename, slots, max_series):
+        # replaced as a whole, so readers that still have the old one mapped don't crash
+        tmp = '%s.tmp' % filename
+        fd = os.open(tmp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, file_size(slots, max_series))
+            os.pwrite(fd, HEADER.pack(MAGIC, VERSION, slots, max_series, 0), 0)
+        finally:
+            os.close(fd)
+        os.replace(tmp, filename)
+
+    def _load_keys(self):
+        count = HEADER.unpack_from(self._mmap, 0)[4]
+        for i in range(len(self._index), count):
+            key = SERIES.unpack_from(self._mmap, HEADER.size + i * SERIES.size)[0]
+            self._index[key.rstrip(b'\0').decode('utf-8')] = i
+
+    def _position(self, i):
+        "returns the index of the series' next slot in the uints"
+        return (HEADER.size + i * SERIES.size + KEY_SIZE) // 4
+
+    def keys(self):
+        if self.readonly:
+            # the writer may have added series since
+            self._load_keys()
+        return list(self._index)
+
+    def append(self, key, timestamp, value):
+        i = self._index.get(key)
+        if i is None:
+            encoded = key.encode('utf-8')
+            if len(self._index) >= self.max_series or len(encoded) >= KEY_SIZE:
+                if not self.dropped:
+                    logger.warning('time series store %s is full or %s is too long, dropping new series',
+                                   self.filename, key)
+                self.dropped += 1
+                return False
+            i = len(self._index)
+            SERIES.pack_into(self._mmap, HEADER.size + i * SERIES.size, encoded, 0, 0)
+            self._index[key] = i
+            HEADER.pack_into(self._mmap, 0, MAGIC, VERSION, self.slots, self.max_series, len(self._index))
+
+        position = self._position(i)
+        slot = self._uints[position]
+        base = self._data + i * 2 * self.slots
+        self._doubles[base + self.slots + slot] = value
+        self._doubles[base + slot] = timestamp
+        # the position is moved last, so a reader never sees a slot that is only half written
+        self._uints[position + 1] = min(self._uints[position + 1] + 1, self.slots)
+        self._uints[position] = (slot + 1) % self.slots
+        return True
+
+    def read(self, key, since=None, until=None):
+        "returns [(timestamp, value)] of the series, oldest first"
+        i = self._index.get(key)
+        if i is None:
+            return []
+        position = self._position(i)
+        slot, count = self._uints[position], self._uints[position + 1]
+        base = self._data + i * 2 * self.slots
+        points = []
+        for n in range(slot - count, slot):
+            n %= self.slots
+            timestamp = self._doubles[base + n]
+            if (since is None or timestamp >= since) and (until is None or timestamp <= until):
+                points.append((timestamp, self._doubles[base + self.slots + n]))
+        return points
+
+    def send(self, data, timestamp=None, hostname=None):
+        if timestamp is None:
+            timestamp = time.time()
+        prefix = '' if hostname is None else '%s.' % hostname
+        for key, value in data.items():
+            value = to_number(value)
+            if value is not None and self.append(prefix + key, timestamp, value):
+                self.sent_metrics += 1
+                self.sent_bytes += 16
+
+    def flush(self):
+        return True
+
+    def close(self):
+        self._doubles.release()
+        self._uints.release()
+        self._mmap.close()
+
+
+_stores = SharedResources()
+
+
+def get_store(filename, slots=360, max_series=4096):
+    "returns the store writing to `filename`, a reload doesn't map it a second time"
+    return _stores.acquire((filename, slots, max_series), lambda: TimeSeriesStore(filename, slots, max_series))
+
+
+def release_store(store):
+    _stores.release(store)
+
+
+def query(store, patterns, since=None, until=None, rate=False):
+    """
+    Yields (key, timestamp, value) of the series matching one of `patterns`.
+
+    With `rate` the values are the per-second increase since the previous
+    value, a counter reset leaves a gap.
+    """
+    for key in sorted(store.keys()):
+        if not any(fnmatch.fnmatchcase(key, pattern) for pattern in patterns):
+            continue
+        points = store.read(key, since, until)
+        if not rate:
+            for timestamp, value in points:
+                yield key, timestamp, value
+            continue
+        for (previous_time, previous), (timestamp, value) in zip(points, points[1:]):
+            delta = counter_delta(previous, value)
+            if delta is not None and timestamp > previous_time:
+                yield key, timestamp, delta / (timestamp - previous_time)
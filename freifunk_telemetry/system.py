@@ -1,16 +1,16 @@
+from freifunk_telemetry.util import read_proc
+
+
 def read_context_switches(update):
-    with open('/proc/stat', 'r') as fh:
-        for line in fh.readlines():
-            key, value = line.split(' ', 1)
-            if key == 'ctxt':
-                update['context_switches'] = value.strip()
-                break
+    data = read_proc('/proc/stat')
+    start = data.find(b'\nctxt ')
+    if start != -1:
+        start += len(b'\nctxt ')
+        update['context_switches'] = int(data[start:data.index(b'\n', start)])
 
 
 def read_load(update):
-    with open('/proc/loadavg', 'r') as fh:
-        line = fh.read()
-        values = line.split(' ', 3)
-        update['load.15'] = values[0]
-        update['load.5'] = values[1]
-        update['load.1'] = values[2]
+    values = read_proc('/proc/loadavg').split(b' ', 3)
+    update['load.15'] = float(values[0])
+    update['load.5'] = float(values[1])
+    update['load.1'] = float(values[2])
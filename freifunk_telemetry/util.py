@@ -1,6 +1,68 @@
 import socket
+import threading
 from contextlib import contextmanager
 
+_local = threading.local()
+
+
+def get_hostname(hostname=None):
+    if hostname is None:
+        hostname = socket.gethostname()
+    return hostname.split('.')[0]
+
+
+def to_number(value):
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def pack_datagrams(lines, max_size):
+    "joins lines (bytes) with newlines into payloads of at most max_size bytes"
+    chunk = []
+    size = 0
+    for line in lines:
+        if chunk and size + 1 + len(line) > max_size:
+            yield b'\n'.join(chunk)
+            chunk = []
+            size = 0
+        chunk.append(line)
+        size += len(line) + (1 if size else 0)
+    if chunk:
+        yield b'\n'.join(chunk)
+
+
+def read_proc(filename):
+    """
+    Reads a whole (proc) file as bytes.
+
+    The file is read unbuffered into a buffer that is kept per thread and
+    only grows, so a /proc file usually costs a single read() syscall and
+    one bytes copy.
+    """
+    buffer = getattr(_local, 'buffer', None)
+    if buffer is None:
+        buffer = _local.buffer = bytearray(64 * 1024)
+
+    size = 0
+    with open(filename, 'rb', buffering=0) as fh:
+        while True:
+            if size == len(buffer):
+                buffer.extend(bytes(len(buffer)))
+            read = fh.readinto(memoryview(buffer)[size:])
+            if not read:
+                break
+            size += read
+
+    return bytes(memoryview(buffer)[:size])
+
 
 def pairwise(iterable):
     "s -> (s0,s1), (s2,s3), (s4, s5), ..."
@@ -24,3 +86,33 @@ def get_socket(host, port):
     sock.connect((host, port))
     yield sock
     sock.close()
+
+
+class SharedResources:
+    """
+    Resources like listening sockets and mapped files, shared between collectors.
+
+    On a reload the new collector is built before the old one is closed, a
+    resource both of them acquire under the same key is only opened once,
+    and closed when the last one that acquired it released it.
+    """
+
+    def __init__(self):
+        self._resources = {}
+
+    def acquire(self, key, factory):
+        entry = self._resources.get(key)
+        if entry is None:
+            entry = self._resources[key] = [factory(), 0]
+        entry[1] += 1
+        return entry[0]
+
+    def release(self, resource):
+        for key, entry in list(self._resources.items()):
+            if entry[0] is resource:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._resources[key]
+                    resource.close()
+                return
+        resource.close()
@@ -5,7 +5,6 @@ setup(
     version='0.0.2',
     install_requires=[
         'psutil',
-        'isc-dhcp-filter>=0.0.2',
         'pyroute2'
     ],
     packages=['freifunk_telemetry'],
@@ -1,13 +1,24 @@
+import json
 import os
+import pickle
+import shutil
 import socket
+import struct
+import subprocess
+import sys
 import tempfile
 import threading
+import time
 import unittest.mock
+import urllib.request
 from collections import namedtuple
 from contextlib import contextmanager
-from io import StringIO
+from io import BytesIO, StringIO
 from unittest import TestCase
 
+from pyroute2.netlink.rtnl.ndmsg import NUD_REACHABLE, NUD_STALE
+
+import freifunk_telemetry.network
 from freifunk_telemetry import read_conntrack
 from freifunk_telemetry import read_context_switches
 from freifunk_telemetry import read_dhcp_leases
@@ -17,7 +28,29 @@ from freifunk_telemetry import read_load
 from freifunk_telemetry import read_snmp
 from freifunk_telemetry import read_snmp6
 from freifunk_telemetry import read_neigh
-from freifunk_telemetry import write_to_graphite
+from freifunk_telemetry import write_to_graphite, get_parser, get_plugins, main, run_query, Collector
+from freifunk_telemetry.daemon import Daemon
+from freifunk_telemetry.batadv import BatadvNetlink, MeshState, read_mesh
+from freifunk_telemetry.conntrack import ConntrackNetlink, parse_entry, read_conntrack_table
+from freifunk_telemetry.dhcp import LeaseFile
+from freifunk_telemetry.fastd import ProcessCache, StatusReader, UDPSocketDiag, compact_status, get_fastd_process_stats, \
+    get_process_drops
+from freifunk_telemetry.graphite import GraphiteSender, PickleSender
+from freifunk_telemetry.influxdb import InfluxDBSender
+from freifunk_telemetry.instrumentation import Instrumentation, Profiler
+from freifunk_telemetry.monitor import NetlinkMonitor
+from freifunk_telemetry.plugins import LazyPlugin, PluginSpec
+from freifunk_telemetry.prometheus import PrometheusExporter
+from freifunk_telemetry.rates import RateCalculator, counter_delta
+from freifunk_telemetry.relay import Aggregator, RelaySender, close_aggregator, decode_frame, encode_frames
+from freifunk_telemetry import monitor as monitor_module
+from freifunk_telemetry import sample as sample_module
+from freifunk_telemetry.sample import Sample, SampleFilter
+from freifunk_telemetry.sampler import InterfaceSampler, summarize
+from freifunk_telemetry.scheduler import Plugin, Scheduler
+from freifunk_telemetry.spool import Spool
+from freifunk_telemetry.statsd import StatsDSender
+from freifunk_telemetry.store import TimeSeriesStore, file_size
 from freifunk_telemetry.util import get_unix_socket
 
 
@@ -29,7 +62,9 @@ def read_test_data(filename):
 
 @contextmanager
 def mock_open_read(filename_data):
-    def _open(filename, mode='r'):
+    def _open(filename, mode='r', *args, **kwargs):
+        if 'b' in mode:
+            return BytesIO(filename_data[filename].encode('latin-1'))
         return StringIO(filename_data[filename])
 
     with unittest.mock.patch('builtins.open', _open) as m:
@@ -51,7 +86,7 @@ class SystemTest(TestCase):
         read_context_switches(update)
 
         self.assertIn('context_switches', update)
-        int(update['context_switches'])
+        self.assertIsInstance(update['context_switches'], int)
 
 
 class NetworkTest(TestCase):
@@ -67,8 +102,8 @@ class NetworkTest(TestCase):
 
         self.assertIn('netfilter.count', update)
         self.assertIn('netfilter.max', update)
-        self.assertEqual(update['netfilter.count'], '100')
-        self.assertEqual(update['netfilter.max'], '1000')
+        self.assertEqual(update['netfilter.count'], 100)
+        self.assertEqual(update['netfilter.max'], 1000)
 
     def test_read_snmp6(self):
         update = {}
@@ -80,6 +115,9 @@ class NetworkTest(TestCase):
         for key in keys.split(" "):
             self.assertIn('ipv6.%s' % key, update)
 
+        self.assertEqual(update['ipv6.Ip6InReceives'], 40608225)
+        self.assertEqual(update['ipv6.Ip6InHdrErrors'], 1367)
+
     def test_read_snmp(self):
         update = {}
 
@@ -87,10 +125,11 @@ class NetworkTest(TestCase):
             read_snmp(update)
 
         for key, value in [
-            ('Icmp.InErrors', '34'),
-            ('UdpLite.IgnoredMulti', '0'),
-            ('Ip.Forwarding', '1'),
-            ('Ip.FragCreates', '22')
+            ('Icmp.InErrors', 34),
+            ('UdpLite.IgnoredMulti', 0),
+            ('Ip.Forwarding', 1),
+            ('Ip.FragCreates', 22),
+            ('Tcp.MaxConn', -1),
         ]:
             k = 'ipv4.%s' % key
             self.assertIn(k, update)
@@ -107,8 +146,13 @@ class NetworkTest(TestCase):
             self.assertIn('{}.tx.packets'.format(interface), update)
             self.assertIn('{}.tx.bytes'.format(interface), update)
 
-            int(update['{}.rx.packets'.format(interface)])
-            int(update['{}.tx.packets'.format(interface)])
+            self.assertIsInstance(update['{}.rx.packets'.format(interface)], int)
+            self.assertIsInstance(update['{}.tx.packets'.format(interface)], int)
+
+        self.assertNotIn('lo.rx.bytes', update)
+        self.assertEqual(update['ffda-vpn.rx.bytes'], 5512833094)
+        self.assertEqual(update['ffda-vpn.tx.drop'], 7751092)
+        self.assertEqual(update['eth0.tx.compressed'], 0)
 
 
 class UnixSocketServer(threading.Thread):
@@ -152,12 +196,15 @@ class FastdTest(TestCase):
     def test_read_process_stats(self):
         update = {}
 
-        FakeProcess = namedtuple('Process', ['pid', 'name'])
+        FakeProcess = namedtuple('Process', ['pid', 'name', 'cmdline', 'create_time'])
 
         def fake_process_iter():
-            return [FakeProcess(1337, lambda: 'fastd')]
+            return [FakeProcess(1337, lambda: 'fastd', lambda: ['fastd', '-c', '/etc/fastd/ffda-vpn/fastd.conf'],
+                                lambda: 123.0)]
 
-        with unittest.mock.patch('freifunk_telemetry.fastd.psutil.process_iter', fake_process_iter):
+        with unittest.mock.patch('freifunk_telemetry.fastd.psutil.process_iter', fake_process_iter), \
+                unittest.mock.patch('freifunk_telemetry.fastd._processes', ProcessCache()), \
+                unittest.mock.patch('freifunk_telemetry.fastd.glob.glob', lambda pattern: []):
             with mock_open_read({
                 '/proc/1337/net/udp': read_test_data('udp'),
                 '/proc/1337/net/udp6': read_test_data('udp6'),
@@ -166,17 +213,123 @@ class FastdTest(TestCase):
 
         self.assertIn('fastd.drops', update)
         self.assertEqual(update['fastd.drops'], 23)
+        self.assertEqual(update['fastd.0.drops'], 23)
+
+    def test_read_process_stats_per_instance(self):
+        FakeProcess = namedtuple('Process', ['pid', 'name', 'cmdline', 'create_time'])
+        processes = [
+            FakeProcess(1, lambda: 'fastd', lambda: ['fastd', '--syslog-ident', 'fastd@ffda-vpn'], lambda: 1.0),
+            FakeProcess(2, lambda: 'fastd', lambda: ['fastd', '-c', '/etc/fastd/ffda-vpn2/fastd.conf'], lambda: 2.0),
+            FakeProcess(3, lambda: 'sshd', lambda: ['sshd'], lambda: 3.0),
+        ]
+        scans = []
+
+        def fake_process_iter():
+            scans.append(None)
+            return processes
+
+        def fake_get_socket_inodes(pid):
+            # the sockets of the udp and udp6 fixtures with 11 and 12 drops
+            return {1: {116911}, 2: {20670}}[pid]
+
+        cache = ProcessCache()
+        with unittest.mock.patch('freifunk_telemetry.fastd.psutil.process_iter', fake_process_iter), \
+                unittest.mock.patch('freifunk_telemetry.fastd._processes', cache), \
+                unittest.mock.patch.object(cache, '_is_alive', lambda pid, create_time: True), \
+                unittest.mock.patch('freifunk_telemetry.fastd.get_socket_inodes', fake_get_socket_inodes), \
+                unittest.mock.patch('freifunk_telemetry.fastd._udp_diag.stats', lambda inodes: {}):
+            with mock_open_read({
+                '/proc/1/net/udp': read_test_data('udp'),
+                '/proc/1/net/udp6': read_test_data('udp6'),
+                '/proc/2/net/udp': read_test_data('udp'),
+                '/proc/2/net/udp6': read_test_data('udp6'),
+            }):
+                first = get_fastd_process_stats()
+                second = get_fastd_process_stats()
+
+        # the process list is only walked once
+        self.assertEqual(len(scans), 1)
+        self.assertEqual(first, second)
+        self.assertEqual(first, {
+            'ffda-vpn': {('udp', 51921): 11},
+            'ffda-vpn2': {('udp6', 47500): 12},
+        })
+
+    def test_sock_diag_drops(self):
+        FakeProcess = namedtuple('Process', ['pid', 'name', 'cmdline', 'create_time'])
+
+        def fake_process_iter():
+            return [FakeProcess(1, lambda: 'fastd', lambda: ['fastd', '-c', '/etc/fastd/ffda-vpn/fastd.conf'],
+                                lambda: 1.0)]
+
+        def fake_stats(inodes):
+            self.assertEqual(inodes, {10, 11, 12})
+            return {10: ('udp', 10000, 5), 11: ('udp6', 10000, 7)}
 
-    def test_read_fastd_socket(self):
         update = {}
+        with unittest.mock.patch('freifunk_telemetry.fastd.psutil.process_iter', fake_process_iter), \
+                unittest.mock.patch('freifunk_telemetry.fastd._processes', ProcessCache()), \
+                unittest.mock.patch('freifunk_telemetry.fastd.glob.glob', lambda pattern: []), \
+                unittest.mock.patch('freifunk_telemetry.fastd.get_socket_inodes', lambda pid: {10, 11, 12}), \
+                unittest.mock.patch('freifunk_telemetry.fastd._udp_diag.stats', fake_stats):
+            read_fastd(update)
+
+        self.assertEqual(update, {
+            'fastd.drops': 12,
+            'fastd.0.drops': 12,
+            'fastd.0.sockets.udp_10000.drops': 5,
+            'fastd.0.sockets.udp6_10000.drops': 7,
+        })
+
+    def test_udp_socket_diag(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        inode = os.fstat(sock.fileno()).st_ino
+        # like fastd's status socket, which no udp dump ever finds
+        status, _ = socket.socketpair()
+        self.addCleanup(status.close)
+        self.addCleanup(_.close)
+        inodes = {inode, os.fstat(status.fileno()).st_ino}
+        diag = UDPSocketDiag()
+        try:
+            try:
+                stats = diag.stats(inodes)
+            except Exception as e:
+                self.skipTest('sock_diag not available: %s' % e)
+            self.assertEqual(stats, {inode: ('udp', port, 0)})
+
+            # the port is known now and the other socket isn't udp, only that port is asked for
+            with unittest.mock.patch.object(diag, '_dump', wraps=diag._dump) as dump:
+                self.assertEqual(diag.stats(inodes), {inode: ('udp', port, 0)})
+            dump.assert_called_once_with(socket.AF_INET, port)
+        finally:
+            diag.close()
+            sock.close()
+
+    def test_sock_diag_is_asked_once_for_all_processes(self):
+        calls = []
+
+        def fake_stats(inodes):
+            calls.append(inodes)
+            return {10: ('udp', 10000, 5), 20: ('udp', 10001, 7)}
+
+        inodes = {1: {10, 11}, 2: {20}}
+        with unittest.mock.patch('freifunk_telemetry.fastd.get_socket_inodes', inodes.get), \
+                unittest.mock.patch('freifunk_telemetry.fastd._udp_diag.stats', fake_stats):
+            drops = get_process_drops([1, 2])
+
+        self.assertEqual(calls, [{10, 11, 20}])
+        self.assertEqual(drops, {1: {('udp', 10000): 5}, 2: {('udp', 10001): 7}})
 
-        def fake_os_path_exists(path):
-            return path == '/run/fastd-ffda-vpn.sock'
+    def test_read_fastd_socket(self):
+        update = {}
 
         def fake_get_unix_socket(filename):
+            self.assertEqual(filename, '/run/fastd-ffda-vpn.sock')
             return get_unix_socket(self.fakeServer.tmpfile.name)
 
-        with unittest.mock.patch('os.path.exists', fake_os_path_exists):
+        with unittest.mock.patch('freifunk_telemetry.fastd.glob.glob', lambda pattern: ['/run/fastd-ffda-vpn.sock']):
             with unittest.mock.patch('freifunk_telemetry.fastd.get_unix_socket', fake_get_unix_socket):
                 read_fastd(update)
 
@@ -205,6 +358,33 @@ class FastdTest(TestCase):
         self.assertEqual(update['fastd.0.rx.reordered.bytes'], 15372313)
         self.assertEqual(update['fastd.0.rx.reordered.packets'], 90699)
 
+        self.assertEqual(update['fastd.0.peers.age.lt_1h'], 0)
+        self.assertEqual(update['fastd.0.peers.age.lt_1d'], 2)
+        self.assertEqual(update['fastd.0.peers.age.ge_1w'], 0)
+        # by rank, only the two online peers have traffic
+        self.assertEqual(update['fastd.0.peers.top.1.rx.bytes'], 1080088202)
+        self.assertEqual(update['fastd.0.peers.top.1.tx.bytes'], 2304797646)
+        self.assertEqual(update['fastd.0.peers.top.2.rx.bytes'], 2088247003)
+        self.assertEqual(update['fastd.0.peers.top.2.tx.bytes'], 869764239)
+        self.assertNotIn('fastd.0.peers.top.3.rx.bytes', update)
+
+    def test_status_reader_chunks(self):
+        content = read_test_data('fastd-ffda-vpn.json').encode('utf-8')
+        expected = json.loads(content.decode('utf-8'), object_hook=compact_status)
+        # chunks that end in the middle of numbers, strings and multi-byte characters
+        content = content.replace(b'"some1"', '"s\u00f6me1"'.encode('utf-8'))
+        expected['peers'] = {key: peer._replace(name='s\u00f6me1') if peer.name == 'some1' else peer
+                             for key, peer in expected['peers'].items()}
+        for chunk_size in [1, 7, 64 * 1024]:
+            client = unittest.mock.Mock()
+            client.recv.side_effect = [content[i:i + chunk_size] for i in range(0, len(content), chunk_size)] + [b'']
+            self.assertEqual(StatusReader(client, chunk_size).read(), expected)
+
+        client = unittest.mock.Mock()
+        client.recv.side_effect = [content[:-10], b'']
+        with self.assertRaises(ValueError):
+            StatusReader(client).read()
+
 
 class TestGraphite(TestCase):
     def test_write_to_graphite(self):
@@ -244,11 +424,323 @@ class TestGraphite(TestCase):
         self.assertGreater(len(socket.send_data), 0)
 
 
+class TCPServer(threading.Thread):
+    def __init__(self):
+        super().__init__()
+        self.socket = socket.socket()
+        self.socket.bind(('127.0.0.1', 0))
+        self.socket.listen(5)
+        self.socket.settimeout(0.1)
+        self.port = self.socket.getsockname()[1]
+        self.connections = 0
+        self.received = b''
+        self._run = False
+
+    def run(self):
+        self._run = True
+        conns = []
+        while self._run:
+            try:
+                conn, addr = self.socket.accept()
+            except socket.timeout:
+                pass
+            else:
+                conn.settimeout(0.1)
+                conns.append(conn)
+                self.connections += 1
+            for conn in conns:
+                try:
+                    self.received += conn.recv(65536)
+                except socket.timeout:
+                    pass
+        for conn in conns:
+            conn.close()
+
+    def join(self):
+        self._run = False
+        super().join()
+        self.socket.close()
+
+
+class TestGraphiteSender(TestCase):
+    def setUp(self):
+        self.server = TCPServer()
+        self.server.start()
+
+    def tearDown(self):
+        self.server.join()
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 2
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_persistent_connection(self):
+        sender = GraphiteSender('127.0.0.1', self.server.port, prefix='ff', hostname='gw01.example')
+        try:
+            sender.send({'foo': 1, 'bar': 2}, timestamp=100)
+            self.assertTrue(sender.flush())
+            sender.send({'foo': 3}, timestamp=110)
+            self.assertTrue(sender.flush())
+            self.assertTrue(sender.flush())
+        finally:
+            sender.close()
+
+        self.wait_for(lambda: self.server.received.count(b'\n') == 3)
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(sorted(self.server.received.decode('latin-1').splitlines()), [
+            'ff.gw01.bar 2 100',
+            'ff.gw01.foo 1 100',
+            'ff.gw01.foo 3 110',
+        ])
+
+    def test_reconnect_with_backoff(self):
+        unused = socket.socket()
+        unused.bind(('127.0.0.1', 0))
+        unused_port = unused.getsockname()[1]
+        unused.close()
+
+        sender = GraphiteSender('127.0.0.1', unused_port, hostname='gw01')
+        try:
+            sender.send({'foo': 1}, timestamp=100)
+            self.assertFalse(sender.flush())
+            # still backing off, no new connection attempt
+            with unittest.mock.patch.object(sender, '_connect') as connect:
+                self.assertFalse(sender.flush())
+                connect.assert_not_called()
+
+            sender.port = self.server.port
+            sender._next_attempt = 0
+            self.assertTrue(sender.flush())
+        finally:
+            sender.close()
+
+        self.wait_for(lambda: self.server.received)
+        self.assertEqual(self.server.received, b'freifunk.gw01.foo 1 100\n')
+
+
+class TestPickleSender(TestCase):
+    def test_batches(self):
+        server = TCPServer()
+        server.start()
+        sender = PickleSender('127.0.0.1', server.port, prefix='ff', hostname='gw01', batch_size=2)
+        try:
+            sender.send({'a': 1, 'b': 2}, timestamp=100)
+            sender.send({'c': 3}, timestamp=110)
+            self.assertTrue(sender.flush())
+        finally:
+            sender.close()
+            deadline = time.monotonic() + 2
+            while len(server.received) < 4 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            server.join()
+
+        batches = []
+        data = server.received
+        while data:
+            length, = struct.unpack('!L', data[:4])
+            batches.append(pickle.loads(data[4:4 + length]))
+            data = data[4 + length:]
+
+        self.assertEqual(batches, [
+            [('ff.gw01.a', (100, 1)), ('ff.gw01.b', (100, 2))],
+            [('ff.gw01.c', (110, 3))],
+        ])
+
+
+class TestBackends(TestCase):
+    def setUp(self):
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.bind(('127.0.0.1', 0))
+        self.udp.settimeout(2)
+        self.port = self.udp.getsockname()[1]
+
+    def tearDown(self):
+        self.udp.close()
+
+    def test_influxdb_udp(self):
+        sender = InfluxDBSender('udp://127.0.0.1:%d' % self.port, hostname='gw01.example', max_datagram=60)
+        try:
+            sender.send({'eth0.rx.bytes': '123', 'load.1': '0.5', 'broken': 'n/a'}, timestamp=100)
+            self.assertTrue(sender.flush())
+        finally:
+            sender.close()
+
+        lines = self.udp.recv(65536).split(b'\n') + self.udp.recv(65536).split(b'\n')
+        self.assertEqual(sorted(lines), [
+            b'eth0.rx.bytes,host=gw01 value=123.0 100000000000',
+            b'load.1,host=gw01 value=0.5 100000000000',
+        ])
+
+    def test_statsd(self):
+        sender = StatsDSender('127.0.0.1', self.port, prefix='ff', hostname='gw01')
+        try:
+            sender.send({'foo': 1, 'bar': '-2'}, timestamp=100)
+            self.assertTrue(sender.flush())
+        finally:
+            sender.close()
+
+        self.assertEqual(sorted(self.udp.recv(65536).split(b'\n')), [
+            b'ff.gw01.bar:-2|g',
+            b'ff.gw01.bar:0|g',
+            b'ff.gw01.foo:1|g',
+        ])
+
+    def test_prometheus_serves_cached_sample(self):
+        exporter = PrometheusExporter('127.0.0.1', 0, prefix='freifunk')
+        try:
+            url = 'http://127.0.0.1:%d/metrics' % exporter.server.server_address[1]
+            exporter.send({'ffda-vpn.rx.bytes': '10', 'dhcpd.count': 5}, timestamp=100)
+            exporter.flush()
+            exporter.send({'ffda-vpn.rx.bytes': '20'}, timestamp=110)
+
+            with urllib.request.urlopen(url) as response:
+                body = response.read().decode('utf-8')
+            self.assertIn('freifunk_ffda_vpn_rx_bytes 10\n', body)
+            self.assertIn('freifunk_dhcpd_count 5\n', body)
+
+            exporter.flush()
+            with urllib.request.urlopen(url) as response:
+                body = response.read().decode('utf-8')
+            self.assertIn('freifunk_ffda_vpn_rx_bytes 20\n', body)
+            self.assertIn('freifunk_dhcpd_count 5\n', body)
+
+            exporter.send({'dhcpd.count': 6}, timestamp=110, hostname='gw02')
+            exporter.flush()
+            with urllib.request.urlopen(url) as response:
+                body = response.read().decode('utf-8')
+            self.assertIn('# TYPE freifunk_dhcpd_count untyped\nfreifunk_dhcpd_count 5\n'
+                          'freifunk_dhcpd_count{host="gw02"} 6\n', body)
+        finally:
+            exporter.close()
+
+
+class TestSpool(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, 'spool')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_fifo_and_persistence(self):
+        spool = Spool(self.filename, 4096)
+        spool.append(b'first', timestamp=100)
+        spool.append(b'second', timestamp=200)
+        spool.close()
+
+        spool = Spool(self.filename, 4096)
+        try:
+            self.assertEqual(len(spool), 2)
+            self.assertEqual(spool.peek(), (100, b'first'))
+            spool.pop()
+            self.assertEqual(spool.peek(), (200, b'second'))
+            spool.pop()
+            self.assertIsNone(spool.peek())
+            self.assertEqual(spool.used, 0)
+        finally:
+            spool.close()
+
+    def test_bounded(self):
+        # room for three 40 byte records
+        spool = Spool(self.filename, 32 + 3 * 52 + 10)
+        try:
+            for i in range(10):
+                spool.append(bytes([i]) * 40, timestamp=i)
+                self.assertLessEqual(spool.used, spool.capacity)
+
+            self.assertEqual(len(spool), 3)
+            self.assertEqual(spool.dropped, 7)
+            for i in range(7, 10):
+                self.assertEqual(spool.peek(), (i, bytes([i]) * 40))
+                spool.pop()
+
+            with unittest.mock.patch('freifunk_telemetry.spool.time.time', lambda: 1000):
+                spool.append(b'x', timestamp=990)
+                self.assertEqual(spool.stats(), {
+                    'telemetry.spool.records': 1,
+                    'telemetry.spool.bytes': 13,
+                    'telemetry.spool.dropped': 7,
+                    'telemetry.spool.age': 10,
+                })
+        finally:
+            spool.close()
+
+    def test_graphite_sender_spools_while_unreachable(self):
+        unused = socket.socket()
+        unused.bind(('127.0.0.1', 0))
+        unused_port = unused.getsockname()[1]
+        unused.close()
+
+        spool = Spool(self.filename, 4096)
+        sender = GraphiteSender('127.0.0.1', unused_port, hostname='gw01', spool=spool, drain_rate=1024)
+        server = TCPServer()
+        server.start()
+        try:
+            sender.send({'foo': 1}, timestamp=100)
+            self.assertFalse(sender.flush())
+            sender.send({'foo': 2}, timestamp=110)
+            self.assertFalse(sender.flush())
+            self.assertEqual(len(spool), 2)
+
+            sender.port = server.port
+            sender._next_attempt = 0
+            sender.send({'foo': 3}, timestamp=120)
+            self.assertTrue(sender.flush())
+            self.assertEqual(len(spool), 0)
+        finally:
+            sender.close()
+            spool.close()
+            server.join()
+
+        self.assertEqual(sorted(server.received.decode('latin-1').splitlines()), [
+            'freifunk.gw01.foo 1 100',
+            'freifunk.gw01.foo 2 110',
+            'freifunk.gw01.foo 3 120',
+        ])
+
+    def test_drain_rate_is_per_second(self):
+        spool = Spool(self.filename, 4096)
+        for i in range(10):
+            spool.append(b'foo 1 100\n' * 10, timestamp=i)
+        server = TCPServer()
+        server.start()
+        clock = [1000]
+        try:
+            with unittest.mock.patch('freifunk_telemetry.graphite.time.monotonic', lambda: clock[0]):
+                # 100 bytes per second, flushed every 5 seconds
+                sender = GraphiteSender('127.0.0.1', server.port, spool=spool, drain_rate=100, interval=5)
+                self.assertTrue(sender.flush())
+                self.assertEqual(len(spool), 5)
+                clock[0] += 1
+                self.assertTrue(sender.flush())
+                self.assertEqual(len(spool), 4)
+                # not more than one interval's worth after a longer pause
+                clock[0] += 60
+                spool.append(b'foo 1 100\n' * 10, timestamp=10)
+                spool.append(b'foo 1 100\n' * 10, timestamp=11)
+                self.assertTrue(sender.flush())
+                self.assertEqual(len(spool), 1)
+                self.assertEqual(sender.sent_bytes, 1100)
+                sender.close()
+        finally:
+            spool.close()
+            server.join()
+
+
 class TestDHCP(TestCase):
+    def setUp(self):
+        self.tmpfile = tempfile.NamedTemporaryFile(mode='w')
+        self.tmpfile.write(read_test_data('dhcpd.leases'))
+        self.tmpfile.flush()
+
+    def tearDown(self):
+        self.tmpfile.close()
+
     def test_read_dhcp_leases(self):
         update = {}
 
-        with mock_open_read({'/var/lib/dhcp/dhcpd.leases': read_test_data('dhcpd.leases')}):
+        with unittest.mock.patch('freifunk_telemetry.dhcp.LEASES_FILE', self.tmpfile.name):
             read_dhcp_leases(update)
 
         self.assertIn('dhcpd.count', update)
@@ -261,6 +753,92 @@ class TestDHCP(TestCase):
         self.assertEqual(update['dhcpd.valid'], 0)
         self.assertEqual(update['dhcpd.current'], 0)
 
+    def test_incremental_updates(self):
+        lease_file = LeaseFile(self.tmpfile.name)
+        lease_file.update()
+        self.assertEqual(len(lease_file.leases), 5)
+
+        # a renewal of an existing lease, a new lease and one that is only half written
+        self.tmpfile.write(
+            'lease 10.0.0.10 {\n'
+            '  starts 2 2013/12/10 12:57:04;\n'
+            '  ends never;\n'
+            '  binding state active;\n'
+            '  hardware ethernet 60:a4:4c:b5:6a:dd;\n'
+            '}\n'
+            'lease 10.0.0.99 {\n'
+            '  starts epoch 1386680224; # Tue Dec 10 12:57:04 2013\n'
+            '  ends epoch 1386680824; # Tue Dec 10 13:07:04 2013\n'
+            '  binding state active;\n'
+            '  hardware ethernet 60:a4:4c:b5:6a:de;\n'
+            '}\n'
+            'lease 10.0.0.100 {\n'
+            '  starts 2 2013/12/10 12:57:04;\n'
+        )
+        self.tmpfile.flush()
+
+        with unittest.mock.patch('freifunk_telemetry.dhcp.open', side_effect=open) as fake_open:
+            lease_file.update()
+        self.assertEqual(fake_open.call_count, 1)
+
+        self.assertEqual(len(lease_file.leases), 6)
+        self.assertEqual(lease_file.leases['10.0.0.10'][1:], ('active', 1386680224, None))
+        self.assertEqual(lease_file.counts(now=1386680500), {
+            'dhcpd.count': 6,
+            'dhcpd.active': 2,
+            'dhcpd.valid': 2,
+            'dhcpd.current': 2,
+        })
+        self.assertEqual(lease_file.counts(now=1386690000)['dhcpd.current'], 1)
+
+        self.tmpfile.write(
+            '  binding state active;\n'
+            '  hardware ethernet 60:a4:4c:b5:6a:df;\n'
+            '}\n'
+        )
+        self.tmpfile.flush()
+        lease_file.update()
+        self.assertEqual(len(lease_file.leases), 7)
+
+        # dhcpd rewrote the file
+        rewritten = self.tmpfile.name + '.new'
+        with open(rewritten, 'w') as fh:
+            fh.write(
+                'lease 10.0.0.99 {\n'
+                '  binding state free;\n'
+                '  hardware ethernet 60:a4:4c:b5:6a:de;\n'
+                '}\n'
+            )
+        os.rename(rewritten, self.tmpfile.name)
+        lease_file.update()
+
+        self.assertEqual(list(lease_file.leases), ['10.0.0.99'])
+
+    def test_renewals_are_counted_once(self):
+        lease_file = LeaseFile(self.tmpfile.name)
+        lease_file.update()
+        self.assertEqual(lease_file.counts(now=1386680500)['dhcpd.count'], 5)
+
+        # dhcpd appends a block for every renewal, the address is still counted once
+        for starts, ends in [(1386680224, 1386680824), (1386680524, 1386681124), (1386680824, 1386681424)]:
+            self.tmpfile.write(
+                'lease 10.0.0.99 {\n'
+                '  starts epoch %d;\n'
+                '  ends epoch %d;\n'
+                '  binding state active;\n'
+                '  hardware ethernet 60:a4:4c:b5:6a:de;\n'
+                '}\n' % (starts, ends)
+            )
+        self.tmpfile.flush()
+        lease_file.update()
+
+        self.assertEqual(lease_file.counts(now=1386681000), {
+            'dhcpd.count': 6,
+            'dhcpd.active': 1,
+            'dhcpd.valid': 1,
+            'dhcpd.current': 1,
+        })
+
 
 class TestNeigh(TestCase):
     _if_nameindex = {
@@ -273,26 +851,1108 @@ class TestNeigh(TestCase):
         def fake_if_nameindex():
             return self._if_nameindex.items()
 
+        test = self
+
         class FakeIPRoute:
-            def get_neighbours(_, family, ifindex, **kwargs):
-                self.assertIn(family, [socket.AF_INET, socket.AF_INET6])
-                self.assertLessEqual(ifindex, len(self._if_nameindex))
+            dumps = 0
+
+            def get_neighbours(self, family, **kwargs):
+                test.assertIn(family, [socket.AF_INET, socket.AF_INET6])
+                test.assertNotIn('ifindex', kwargs)
+                FakeIPRoute.dumps += 1
 
-                return [0]*(4 if family == socket.AF_INET else 6)
+                neighbours = []
+                for idx in test._if_nameindex:
+                    neighbours += [{'ifindex': idx, 'state': NUD_REACHABLE}] * (4 if family == socket.AF_INET else 3)
+                    neighbours += [{'ifindex': idx, 'state': NUD_STALE}] * (0 if family == socket.AF_INET else 3)
+                return neighbours
 
         update = {}
 
         with unittest.mock.patch('freifunk_telemetry.network.socket.if_nameindex', fake_if_nameindex):
             with unittest.mock.patch('freifunk_telemetry.network.pyroute2.IPRoute', FakeIPRoute):
-                read_neigh(update)
+                with unittest.mock.patch('freifunk_telemetry.network._ip_route', None):
+                    read_neigh(update)
+                    read_neigh(update)
+                    self.assertIsInstance(freifunk_telemetry.network._ip_route, FakeIPRoute)
+
+        # one dump per family and run
+        self.assertEqual(FakeIPRoute.dumps, 4)
 
         for idx, ifname in fake_if_nameindex():
             self.assertIn('ipv4.neigh.%s.count' % ifname, update)
             self.assertIn('ipv6.neigh.%s.count' % ifname, update)
             self.assertEqual(update['ipv4.neigh.%s.count' % ifname], 4)
             self.assertEqual(update['ipv6.neigh.%s.count' % ifname], 6)
+            self.assertEqual(update['ipv4.neigh.%s.reachable' % ifname], 4)
+            self.assertEqual(update['ipv6.neigh.%s.reachable' % ifname], 3)
+            self.assertEqual(update['ipv6.neigh.%s.stale' % ifname], 3)
+            self.assertEqual(update['ipv6.neigh.%s.failed' % ifname], 0)
 
         for proto in ['ipv4', 'ipv6']:
             self.assertIsInstance(int(update['%s.neigh.gc_thresh1' % proto]), int)
             self.assertIsInstance(int(update['%s.neigh.gc_thresh2' % proto]), int)
             self.assertIsInstance(int(update['%s.neigh.gc_thresh3' % proto]), int)
+
+
+class FakeCollector:
+    def __init__(self, daemon_ref, runs=3, interval=0.01):
+        self.daemon_ref = daemon_ref
+        self.interval = interval
+        self.jitter = 0
+        self.runs = runs
+        self.timestamps = []
+        self.closed = False
+
+    def run(self):
+        self.timestamps.append(time.monotonic())
+        if len(self.timestamps) >= self.runs:
+            self.daemon_ref[0].stop()
+
+    def close(self):
+        self.closed = True
+
+
+class DaemonTest(TestCase):
+    def test_runs_on_interval_and_stops(self):
+        daemon_ref = []
+        collectors = []
+
+        def factory():
+            collectors.append(FakeCollector(daemon_ref))
+            return collectors[-1]
+
+        daemon = Daemon(factory)
+        daemon_ref.append(daemon)
+        daemon.run()
+
+        self.assertEqual(len(collectors), 1)
+        collector = collectors[0]
+        self.assertEqual(len(collector.timestamps), 3)
+        self.assertTrue(collector.closed)
+        # runs are scheduled at fixed points, a late run makes the gap to the next one shorter
+        self.assertGreaterEqual(collector.timestamps[-1] - collector.timestamps[0], collector.interval)
+
+    def test_reload_rebuilds_collector(self):
+        daemon_ref = []
+        collectors = []
+
+        def factory():
+            collectors.append(FakeCollector(daemon_ref, runs=2))
+            if len(collectors) == 1:
+                daemon_ref[0].reload()
+            return collectors[-1]
+
+        daemon = Daemon(factory)
+        daemon_ref.append(daemon)
+        daemon.run()
+
+        self.assertEqual(len(collectors), 2)
+        self.assertTrue(collectors[0].closed)
+        self.assertEqual(len(collectors[0].timestamps), 0)
+        self.assertEqual(len(collectors[1].timestamps), 2)
+        self.assertTrue(collectors[1].closed)
+
+    def test_reload_keeps_listeners_and_files(self):
+        unused = socket.socket()
+        unused.bind(('127.0.0.1', 0))
+        port = unused.getsockname()[1]
+        unused.close()
+
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        args = ['--plugins', 'load', '--output', 'prometheus', '--prometheus-listen', '127.0.0.1:%d' % port,
+                '--spool', os.path.join(tmpdir.name, 'spool'), '--store', os.path.join(tmpdir.name, 'store')]
+        daemon = Daemon(lambda: Collector(get_parser().parse_args(args)))
+        daemon.collector = daemon.factory()
+        old = daemon.collector
+        try:
+            self.assertTrue(daemon._do_reload())
+            self.assertIsNot(daemon.collector, old)
+            self.assertIs(daemon.collector.spool, old.spool)
+            self.assertEqual([backend.name for backend in daemon.collector.backends], ['prometheus', 'store'])
+
+            daemon.collector.run(force=True)
+            with urllib.request.urlopen('http://127.0.0.1:%d/metrics' % port) as response:
+                self.assertIn('freifunk_load_1 ', response.read().decode('utf-8'))
+            self.assertIn('load.1', daemon.collector.backends[1].keys())
+        finally:
+            daemon.collector.close()
+
+        # the last collector released the port
+        sock = socket.socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('127.0.0.1', port))
+        sock.close()
+
+    def test_reload_stops_netlink_events(self):
+        monitor = unittest.mock.Mock()
+        with unittest.mock.patch('freifunk_telemetry.monitor._monitor', monitor):
+            collector = Collector(get_parser().parse_args(['--test', '--enable-plugin', 'netlink_events']))
+            collector.close()
+            self.assertFalse(monitor.close.called)
+
+            # the plugin was switched off, its socket and thread go away with the old collector
+            collector = Collector(get_parser().parse_args(['--test', '--plugins', 'load']))
+            collector.close()
+            monitor.close.assert_called_once_with()
+            self.assertIsNone(monitor_module._monitor)
+
+
+class SchedulerTest(TestCase):
+    def test_stalled_plugin_does_not_block_others(self):
+        release = threading.Event()
+
+        def read_fast(update):
+            update['fast'] = 1
+
+        def read_stalled(update):
+            release.wait(5)
+            update['stalled'] = 1
+
+        def read_broken(update):
+            raise RuntimeError('broken')
+
+        scheduler = Scheduler([
+            Plugin(read_fast, 10, 1),
+            Plugin(read_stalled, 10, 0.1),
+            Plugin(read_broken, 10, 1),
+        ])
+        try:
+            start = time.monotonic()
+            before = time.time()
+            batches = scheduler.run()
+            self.assertLess(time.monotonic() - start, 1)
+            self.assertEqual(len(batches), 1)
+            timestamp, update = batches[0]
+            self.assertEqual(update, {'fast': 1})
+            self.assertGreaterEqual(timestamp, before)
+
+            # the stalled plugin is not started a second time while its thread is still busy
+            start = time.monotonic()
+            batches = scheduler.run(force=True)
+            self.assertLess(time.monotonic() - start, 0.1)
+            self.assertEqual([update for timestamp, update in batches], [{'fast': 1}])
+        finally:
+            release.set()
+            scheduler.close()
+
+    def test_slow_plugin_is_handed_in_later(self):
+        release = threading.Event()
+
+        def read_fast(update):
+            update['fast'] = 1
+
+        def read_slow(update):
+            release.wait(5)
+            update['slow'] = 1
+
+        scheduler = Scheduler([Plugin(read_fast, 10, 0.2), Plugin(read_slow, 300, 5)])
+        try:
+            start = time.monotonic()
+            batches = scheduler.run()
+            # not held back until the slow plugin's own timeout
+            self.assertLess(time.monotonic() - start, 1)
+            self.assertEqual([update for timestamp, update in batches], [{'fast': 1}])
+
+            release.set()
+            time.sleep(0.1)
+            batches = scheduler.run()
+            self.assertEqual([update for timestamp, update in batches], [{'slow': 1}])
+        finally:
+            release.set()
+            scheduler.close()
+
+    def test_slow_plugin_is_waited_for_once(self):
+        def read_fast(update):
+            update['fast'] = 1
+
+        def read_slow(update):
+            time.sleep(0.5)
+            update['slow'] = 1
+
+        scheduler = Scheduler([Plugin(read_fast, 10, 0.1), Plugin(read_slow, 300, 5)])
+        try:
+            # collecting only once, the slow plugin is still within its own timeout
+            batches = scheduler.run(force=True)
+            self.assertEqual(sorted(key for timestamp, update in batches for key in update), ['fast', 'slow'])
+        finally:
+            scheduler.close()
+
+    def test_without_plugins(self):
+        scheduler = Scheduler([])
+        try:
+            self.assertIsNone(scheduler.interval)
+            self.assertEqual(scheduler.run(force=True), [])
+        finally:
+            scheduler.close()
+
+        args = get_parser().parse_args(['--plugins', 'nonexistent', '--interval', '30'])
+        with self.assertLogs('freifunk_telemetry', 'WARNING'):
+            collector = Collector(args)
+        try:
+            self.assertEqual(collector.interval, 30)
+        finally:
+            collector.close()
+
+    def test_plugin_intervals(self):
+        calls = []
+
+        def read_often(update):
+            calls.append('often')
+
+        def read_rarely(update):
+            calls.append('rarely')
+
+        often = Plugin(read_often, 10, 1)
+        rarely = Plugin(read_rarely, 300, 1)
+        self.assertEqual(often.name, 'often')
+
+        scheduler = Scheduler([often, rarely])
+        try:
+            self.assertEqual(scheduler.interval, 10)
+            scheduler.run()
+            self.assertEqual(sorted(calls), ['often', 'rarely'])
+
+            with unittest.mock.patch('freifunk_telemetry.scheduler.time.monotonic',
+                                     lambda: often.next_run):
+                scheduler.run()
+            self.assertEqual(sorted(calls), ['often', 'often', 'rarely'])
+        finally:
+            scheduler.close()
+
+
+class TestRates(TestCase):
+    def test_counter_delta(self):
+        self.assertEqual(counter_delta(10, 15), 5)
+        # 32 bit wrap-around
+        self.assertEqual(counter_delta(2 ** 32 - 10, 5), 15)
+        # reset, e.g. fastd restarted
+        self.assertIsNone(counter_delta(1000000, 10))
+        self.assertIsNone(counter_delta(2 ** 40, 10))
+
+    def test_add_rates(self):
+        rates = RateCalculator('add')
+        first = rates.process({'eth0.rx.bytes': 1000, 'load.1': 0.5, 'ipv4.Tcp.CurrEstab': 3}, 100)
+        self.assertEqual(first, {'eth0.rx.bytes': 1000, 'load.1': 0.5, 'ipv4.Tcp.CurrEstab': 3})
+
+        second = rates.process({'eth0.rx.bytes': 3000, 'load.1': 0.5, 'ipv4.Tcp.CurrEstab': 4}, 110)
+        self.assertEqual(second, {
+            'eth0.rx.bytes': 3000,
+            'eth0.rx.bytes.rate': 200,
+            'load.1': 0.5,
+            'ipv4.Tcp.CurrEstab': 4,
+        })
+
+        # the interface flapped, no rate until there are two samples again
+        third = rates.process({'eth0.rx.bytes': 10}, 120)
+        self.assertEqual(third, {'eth0.rx.bytes': 10})
+        fourth = rates.process({'eth0.rx.bytes': 110}, 130)
+        self.assertEqual(fourth, {'eth0.rx.bytes': 110, 'eth0.rx.bytes.rate': 10})
+
+    def test_replace_rates(self):
+        rates = RateCalculator('replace')
+        self.assertEqual(rates.process({'context_switches': 100}, 0), {})
+        self.assertEqual(rates.process({'context_switches': 150}, 5), {'context_switches': 10})
+
+    def test_top_peers_are_gauges(self):
+        # a different peer may be at the same rank next time, these are passed on as they are
+        for mode in ['add', 'replace']:
+            rates = RateCalculator(mode)
+            self.assertEqual(rates.process({'fastd.0.peers.top.1.rx.bytes': 10 ** 9}, 100),
+                             {'fastd.0.peers.top.1.rx.bytes': 10 ** 9})
+            self.assertEqual(rates.process({'fastd.0.peers.top.1.rx.bytes': 5 * 10 ** 9}, 110),
+                             {'fastd.0.peers.top.1.rx.bytes': 5 * 10 ** 9})
+
+    def test_scheduler_stage(self):
+        def read_counter(update):
+            update['fastd.drops'] = 5
+
+        scheduler = Scheduler([Plugin(read_counter, 10, 1)], [RateCalculator('replace')])
+        try:
+            self.assertEqual(scheduler.run(force=True)[0][1], {})
+            self.assertEqual(scheduler.run(force=True)[0][1], {'fastd.drops': 0})
+        finally:
+            scheduler.close()
+
+
+class TestInstrumentation(TestCase):
+    def test_plugin_stats(self):
+        release = threading.Event()
+
+        def read_fast(update):
+            update['fast'] = 1
+
+        def read_stalled(update):
+            release.wait(5)
+
+        def read_broken(update):
+            raise RuntimeError('broken')
+
+        instrumentation = Instrumentation()
+        scheduler = Scheduler([
+            Plugin(read_fast, 10, 1),
+            Plugin(read_stalled, 10, 0.1),
+            Plugin(read_broken, 10, 1),
+        ], instrumentation=instrumentation)
+        try:
+            scheduler.run()
+            scheduler.run(force=True)
+        finally:
+            release.set()
+            scheduler.close()
+        scheduler.executor.shutdown(wait=True)
+
+        stats = instrumentation.stats()
+        self.assertEqual(stats['telemetry.plugins.fast.success'], 2)
+        self.assertEqual(stats['telemetry.plugins.fast.duration.count'], 2)
+        self.assertEqual(stats['telemetry.plugins.fast.duration.le_10ms'], 2)
+        self.assertEqual(stats['telemetry.plugins.broken.failure'], 2)
+        self.assertEqual(stats['telemetry.plugins.broken.success'], 0)
+        self.assertEqual(stats['telemetry.plugins.stalled.timeout'], 1)
+        self.assertEqual(stats['telemetry.plugins.stalled.skipped'], 1)
+        # the stalled run only counts as a timeout, even once it returned
+        self.assertEqual(stats['telemetry.plugins.stalled.success'], 0)
+        self.assertEqual(stats['telemetry.plugins.stalled.failure'], 0)
+        self.assertEqual(stats['telemetry.plugins.stalled.duration.count'], 0)
+        self.assertGreater(stats['telemetry.process.rss'], 0)
+        self.assertIn('telemetry.process.cpu.user', stats)
+
+    def test_backend_stats(self):
+        udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp.bind(('127.0.0.1', 0))
+        sender = StatsDSender('127.0.0.1', udp.getsockname()[1], prefix='ff', hostname='gw01')
+        try:
+            sender.send({'foo': 1, 'bar': 2}, timestamp=100)
+            sender.flush()
+        finally:
+            sender.close()
+            udp.close()
+
+        instrumentation = Instrumentation()
+        instrumentation.backend_failed('statsd')
+        stats = instrumentation.stats([sender])
+        self.assertEqual(stats['telemetry.backends.statsd.metrics'], 2)
+        self.assertEqual(stats['telemetry.backends.statsd.bytes'], len(b'ff.gw01.foo:1|g\nff.gw01.bar:2|g'))
+        self.assertEqual(stats['telemetry.backends.statsd.failures'], 1)
+
+    def test_profiler(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            profiler = Profiler(tmpdir)
+            try:
+                profiler.poll()
+                self.assertEqual(profiler.call(sum, [1, 2]), 3)
+
+                profiler._on_sigusr1(None, None)
+                profiler._on_sigusr2(None, None)
+                profiler.poll()
+                self.assertEqual(profiler.call(sum, [1, 2]), 3)
+
+                profiler._on_sigusr1(None, None)
+                profiler._on_sigusr2(None, None)
+                profiler.poll()
+            finally:
+                profiler.uninstall()
+
+            self.assertEqual(sorted(name.rsplit('.', 1)[1] for name in os.listdir(tmpdir)),
+                             ['pstats', 'tracemalloc'])
+
+
+def record(update):
+    update['recorded'] = 1
+
+
+class TestPlugins(TestCase):
+    def test_select_plugins(self):
+        args = get_parser().parse_args(['--plugins', 'load,fastd', '--plugins', 'snmp', '--disable-plugin', 'fastd',
+                                        '--add-plugin', 'record=test:record', '--plugin-interval', 'record=5'])
+        with unittest.mock.patch('freifunk_telemetry.plugins.iter_entry_points', return_value=[]):
+            self.assertEqual(sorted(plugin.name for plugin in get_plugins(args)), ['load', 'snmp'])
+
+            args.plugins.append('record')
+            plugins = {plugin.name: plugin for plugin in get_plugins(args)}
+        self.assertEqual(sorted(plugins), ['load', 'record', 'snmp'])
+        self.assertEqual(plugins['record'].interval, 5)
+        self.assertEqual(plugins['record']()[1], {'recorded': 1})
+
+    def test_lazy_import(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            source = os.path.join(tmpdir, 'source')
+            plugin = LazyPlugin(PluginSpec('record', 'test:record', [source], None, 5))
+            with unittest.mock.patch('freifunk_telemetry.plugins.import_target') as import_target:
+                update = {}
+                plugin(update)
+                self.assertEqual(update, {})
+                self.assertFalse(import_target.called)
+
+            open(source, 'w').close()
+            plugin(update)
+            self.assertEqual(update, {'recorded': 1})
+
+    def test_package_import_is_light(self):
+        output = subprocess.check_output([
+            sys.executable, '-c',
+            'import sys, freifunk_telemetry; '
+            'print(sorted(m for m in ("psutil", "pyroute2", "freifunk_telemetry.fastd") if m in sys.modules))',
+        ])
+        self.assertEqual(output.strip(), b'[]')
+
+    def test_enable_plugin(self):
+        names = [plugin.name for plugin in get_plugins(get_parser().parse_args([]))]
+        self.assertNotIn('netlink_events', names)
+        self.assertNotIn('conntrack_table', names)
+        for argv in [['--enable-plugin', 'conntrack_table'], ['--plugins', 'conntrack_table']]:
+            names = [plugin.name for plugin in get_plugins(get_parser().parse_args(argv))]
+            self.assertIn('conntrack_table', names)
+        # netlink_events replaces neigh, unless that is asked for too
+        for argv, neigh in [(['--enable-plugin', 'netlink_events'], False),
+                            (['--plugins', 'netlink_events,load'], False),
+                            (['--plugins', 'netlink_events,neigh'], True),
+                            (['--enable-plugin', 'netlink_events', '--enable-plugin', 'neigh'], True)]:
+            names = [plugin.name for plugin in get_plugins(get_parser().parse_args(argv))]
+            self.assertIn('netlink_events', names)
+            self.assertEqual('neigh' in names, neigh, argv)
+
+
+class TestSample(TestCase):
+    def test_sample(self):
+        sample = Sample({'eth0.rx.bytes': 2 ** 40, 'load.1': 0.5, 'huge': 2 ** 64 - 1})
+        self.assertEqual(len(sample), 3)
+        self.assertEqual(sample['eth0.rx.bytes'], 2 ** 40)
+        self.assertIsInstance(sample['eth0.rx.bytes'], int)
+        self.assertEqual(sample['load.1'], 0.5)
+        self.assertEqual(sample['huge'], float(2 ** 64 - 1))
+        self.assertNotIn('missing', sample)
+        self.assertEqual(dict(sample), {'eth0.rx.bytes': 2 ** 40, 'load.1': 0.5, 'huge': float(2 ** 64 - 1)})
+
+        # samples with the same keys share them
+        other = Sample({'eth0.rx.bytes': 1, 'load.1': 0.1, 'huge': 0.0})
+        self.assertIs(list(sample)[0], list(other)[0])
+        self.assertIs(sample._int_keys, other._int_keys)
+
+    def test_filter(self):
+        sample_filter = SampleFilter(include=['ipv4.*', 'fastd.*'], exclude=['ipv4.Icmp.*'])
+        sample = sample_filter.process({
+            'ipv4.Ip.InReceives': '10',
+            'ipv4.Icmp.InMsgs': 5,
+            'load.1': 0.5,
+            'fastd.0.peers.top.some node.rx.bytes': 7,
+            'fastd.0.broken': 'n/a',
+        }, 0)
+        self.assertIsInstance(sample, Sample)
+        self.assertEqual(dict(sample), {'ipv4.Ip.InReceives': 10, 'fastd.0.peers.top.some_node.rx.bytes': 7})
+
+    def test_skip_zero_and_unchanged(self):
+        sample_filter = SampleFilter(skip_zero=True)
+        self.assertEqual(dict(sample_filter.process({'errors': 0, 'bytes': 10}, 0)), {'bytes': 10})
+        self.assertEqual(dict(sample_filter.process({'errors': 1, 'bytes': 10}, 10)), {'errors': 1, 'bytes': 10})
+        # once a series was non-zero, zeros are sent as well
+        self.assertEqual(dict(sample_filter.process({'errors': 0, 'bytes': 0}, 20)), {'errors': 0, 'bytes': 0})
+
+        sample_filter = SampleFilter(skip_unchanged=True)
+        self.assertEqual(dict(sample_filter.process({'max': 65536, 'count': 10}, 0)), {'max': 65536, 'count': 10})
+        self.assertEqual(dict(sample_filter.process({'max': 65536, 'count': 12}, 10)), {'count': 12})
+
+        # which values changed differs every time, these key sets don't push the stable ones out of the cache
+        sample_filter = SampleFilter(skip_unchanged=True, heartbeat=1000)
+        keys = ['cpu%d' % n for n in range(9)]
+        sample_filter.process({key: 0 for key in keys}, 0)
+        tables = dict(sample_module._key_tables)
+        for i in range(1, 2 ** len(keys)):
+            sample = sample_filter.process({key: i >> n & 1 for n, key in enumerate(keys)}, i)
+            self.assertTrue(sample)
+        self.assertEqual(sample_module._key_tables, tables)
+
+    def test_dead_band_and_heartbeat(self):
+        args = get_parser().parse_args(['--dead-band', 'load.*=0.05', '--dead-band', 'ipv4.neigh.*=10%',
+                                        '--heartbeat', '3'])
+        self.assertEqual(args.dead_bands, [('load.*', 0.05, False), ('ipv4.neigh.*', 10, True)])
+
+        sample_filter = SampleFilter(dead_bands=args.dead_bands, heartbeat=args.heartbeat)
+        sent = [dict(sample_filter.process(update, 0)) for update in [
+            {'load.1': 0.50, 'ipv4.neigh.gc_thresh1': 100, 'netfilter.max': 65536},
+            {'load.1': 0.54, 'ipv4.neigh.gc_thresh1': 109, 'netfilter.max': 65536},
+            {'load.1': 0.56, 'ipv4.neigh.gc_thresh1': 111, 'netfilter.max': 65536},
+            {'load.1': 0.56, 'ipv4.neigh.gc_thresh1': 111, 'netfilter.max': 65536},
+            {'load.1': 0.56, 'ipv4.neigh.gc_thresh1': 111, 'netfilter.max': 65536},
+        ]]
+        self.assertEqual([sorted(update) for update in sent], [
+            ['ipv4.neigh.gc_thresh1', 'load.1', 'netfilter.max'],
+            ['netfilter.max'],
+            # moved beyond the dead-band of the last value sent
+            ['ipv4.neigh.gc_thresh1', 'load.1', 'netfilter.max'],
+            ['netfilter.max'],
+            ['netfilter.max'],
+        ])
+
+        # heartbeat
+        self.assertEqual(dict(sample_filter.process({'load.1': 0.56}, 0)), {'load.1': 0.56})
+
+
+def nla(attr_type, payload):
+    data = struct.pack('=HH', 4 + len(payload), attr_type) + payload
+    return data + bytes(-len(data) % 4)
+
+
+class FakeConntrack:
+    def __init__(self, entries, cpu_stats):
+        self._entries = entries
+        self._cpu_stats = cpu_stats
+
+    def entries(self):
+        return iter(self._entries)
+
+    def cpu_stats(self):
+        return self._cpu_stats
+
+    def close(self):
+        pass
+
+
+class TestConntrack(TestCase):
+    def test_parse_entry(self):
+        proto = nla(0x8002, nla(1, bytes([socket.IPPROTO_TCP])) + nla(2, struct.pack('>H', 443)))
+        attrs = (
+            nla(0x8001, nla(0x8001, nla(1, bytes(4)) + nla(2, bytes(4))) + proto) +
+            nla(3, struct.pack('>I', 0x18e)) +
+            nla(0x8004, nla(0x8001, nla(1, bytes([7])) + nla(2, bytes([7])))) +
+            nla(18, struct.pack('>H', 3))
+        )
+        self.assertEqual(parse_entry(attrs, 0, len(attrs)), (socket.IPPROTO_TCP, 7, 3))
+
+        attrs = nla(0x8001, nla(0x8002, nla(1, bytes([socket.IPPROTO_UDP]))))
+        self.assertEqual(parse_entry(attrs, 0, len(attrs)), (socket.IPPROTO_UDP, None, 0))
+
+    def test_read_conntrack_table(self):
+        entries = (
+            [(socket.AF_INET, socket.IPPROTO_TCP, 3, 0)] * 3 +
+            [(socket.AF_INET, socket.IPPROTO_TCP, 7, 1)] * 2 +
+            [(socket.AF_INET6, socket.IPPROTO_UDP, None, 0)] * 4 +
+            [(socket.AF_INET, socket.IPPROTO_ICMP, None, 1)]
+        )
+        fake = FakeConntrack(entries, {'drop': 5, 'early_drop': 1})
+        with unittest.mock.patch('freifunk_telemetry.conntrack._conntrack', fake), \
+                unittest.mock.patch('freifunk_telemetry.conntrack._zones', {0}):
+            update = {}
+            read_conntrack_table(update)
+
+            self.assertEqual({key: value for key, value in update.items() if value}, {
+                'netfilter.conntrack.ipv4.tcp.count': 5,
+                'netfilter.conntrack.ipv4.tcp.established': 3,
+                'netfilter.conntrack.ipv4.tcp.time_wait': 2,
+                'netfilter.conntrack.ipv6.udp.count': 4,
+                'netfilter.conntrack.ipv4.icmp.count': 1,
+                'netfilter.conntrack.zone.0.count': 7,
+                'netfilter.conntrack.zone.1.count': 3,
+                'netfilter.conntrack.drop': 5,
+                'netfilter.conntrack.early_drop': 1,
+            })
+
+            # series of connections that are gone are reported as 0 instead of leaving a gap
+            fake._entries = []
+            empty = {}
+            read_conntrack_table(empty)
+            self.assertEqual(set(empty), set(update))
+            self.assertEqual(empty['netfilter.conntrack.ipv4.tcp.time_wait'], 0)
+            self.assertEqual(empty['netfilter.conntrack.ipv6.icmpv6.count'], 0)
+            self.assertEqual(empty['netfilter.conntrack.zone.1.count'], 0)
+            self.assertEqual(empty['netfilter.conntrack.drop'], 5)
+
+    def test_netlink_error(self):
+        class FailingSocket:
+            def send(self, request):
+                self.seq = struct.unpack_from('=IHHII', request)[3]
+
+            def recv_into(self, buffer):
+                message = struct.pack('=IHHIIi', 20, 2, 0, self.seq, 0, -1)
+                buffer[:len(message)] = message
+                return len(message)
+
+        with self.assertRaises(PermissionError):
+            list(ConntrackNetlink(sock=FailingSocket()).entries())
+
+
+def rtnl_message(msg_type, seq, payload):
+    return struct.pack('=IHHII', 16 + len(payload), msg_type, 0, seq, 0) + payload
+
+
+def link_message(msg_type, seq, index, name, running):
+    return rtnl_message(msg_type, seq, struct.pack('=BxHiII', 0, 1, index, 0x41 if running else 0x1, 0) +
+                        nla(3, name.encode() + b'\0'))
+
+
+def neigh_message(msg_type, seq, index, address, state):
+    return rtnl_message(msg_type, seq, struct.pack('=BxxxiHBB', socket.AF_INET, index, state, 0, 0) +
+                        nla(1, socket.inet_aton(address)))
+
+
+class TestNetlinkMonitor(TestCase):
+    def setUp(self):
+        self.kernel, sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.kernel.settimeout(5)
+        self.monitor = NetlinkMonitor(sock=sock)
+        self.addCleanup(self.kernel.close)
+        self.addCleanup(self.monitor.close)
+
+    def answer(self, *messages):
+        seq = struct.unpack_from('=IHHII', self.kernel.recv(4096))[3]
+        self.kernel.send(b''.join(message(seq) for message in messages) + rtnl_message(3, seq, bytes(4)))
+
+    def send_events(self, *messages):
+        events = self.monitor.events
+        self.kernel.send(b''.join(messages))
+        deadline = time.time() + 5
+        while self.monitor.events < events + len(messages) and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_events(self):
+        self.answer(lambda seq: link_message(16, seq, 2, 'eth0', True),
+                    lambda seq: link_message(16, seq, 3, 'bat0', True))
+        self.answer(lambda seq: neigh_message(28, seq, 3, '10.0.0.1', NUD_REACHABLE),
+                    lambda seq: neigh_message(28, seq, 3, '10.0.0.2', NUD_STALE))
+        self.answer()
+        self.assertTrue(self.monitor.synced.wait(5))
+
+        self.send_events(
+            link_message(16, 0, 2, 'eth0', False),
+            link_message(16, 0, 2, 'eth0', True),
+            neigh_message(28, 0, 3, '10.0.0.2', NUD_REACHABLE),
+            neigh_message(28, 0, 3, '10.0.0.3', NUD_STALE),
+            neigh_message(29, 0, 3, '10.0.0.1', NUD_REACHABLE),
+        )
+
+        stats = self.monitor.stats()
+        self.assertEqual(stats['eth0.link.up'], 1)
+        self.assertEqual(stats['eth0.link.up_events'], 1)
+        self.assertEqual(stats['eth0.link.down_events'], 1)
+        self.assertNotIn('bat0.link.up_events', stats)
+        self.assertEqual(stats['ipv4.neigh.bat0.count'], 2)
+        self.assertEqual(stats['ipv4.neigh.bat0.reachable'], 1)
+        self.assertEqual(stats['ipv4.neigh.bat0.stale'], 1)
+        self.assertEqual(stats['ipv4.neigh.eth0.count'], 0)
+        self.assertEqual(stats['ipv6.neigh.bat0.count'], 0)
+        self.assertEqual(stats['netlink.events'], 5)
+
+
+class TestRelay(TestCase):
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 2
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_frames(self):
+        data = {'load.1': 0.5, 'eth0.rx.bytes': 2 ** 40, 'huge': 2 ** 64, 'broken': 'n/a', 'count': '3'}
+        frames = encode_frames('gw01', 100.5, data.items(), max_size=60)
+        self.assertGreater(len(frames), 1)
+        self.assertTrue(all(len(frame) <= 60 for frame in frames))
+
+        merged = {}
+        for frame in frames:
+            hostname, timestamp, values = decode_frame(frame)
+            self.assertEqual((hostname, timestamp), ('gw01', 100.5))
+            merged.update(values)
+        self.assertEqual(merged, {'load.1': 0.5, 'eth0.rx.bytes': 2 ** 40, 'huge': float(2 ** 64), 'count': 3})
+
+        with self.assertRaises(ValueError):
+            decode_frame(frames[0][:-1])
+
+    def test_udp_and_tcp(self):
+        aggregator = Aggregator('127.0.0.1', 0)
+        url = '%s://127.0.0.1:%d'
+        senders = [
+            RelaySender(url % ('udp', aggregator.address[1]), hostname='gw01', max_datagram=100),
+            RelaySender(url % ('tcp', aggregator.address[1]), hostname='gw02.example'),
+        ]
+        try:
+            for i, sender in enumerate(senders):
+                sender.send({'fastd.vpn.peers.online': 10 + i, 'fastd.vpn.peers.count': 20, 'load.1': 0.5},
+                            timestamp=100)
+                sender.send({'dhcpd.active': 5}, timestamp=110)
+                self.assertTrue(sender.flush())
+            self.wait_for(lambda: aggregator.stats()['telemetry.relay.frames'] >= 7)
+
+            self.assertEqual(sorted(aggregator.drain()), [
+                ('gw01', 100, {'fastd.vpn.peers.online': 10, 'fastd.vpn.peers.count': 20, 'load.1': 0.5}),
+                ('gw01', 110, {'dhcpd.active': 5}),
+                ('gw02', 100, {'fastd.vpn.peers.online': 11, 'fastd.vpn.peers.count': 20, 'load.1': 0.5}),
+                ('gw02', 110, {'dhcpd.active': 5}),
+            ])
+            self.assertEqual(aggregator.drain(), [])
+            self.assertEqual(aggregator.sums(), {
+                'fastd.peers.count': 40,
+                'fastd.peers.online': 21,
+                'dhcpd.active': 10,
+                'dhcpd.current': 0,
+                'gateways': 2,
+            })
+            self.assertEqual(aggregator.sums(max_age=-1)['gateways'], 0)
+        finally:
+            for sender in senders:
+                sender.close()
+            aggregator.close()
+
+    def test_collector_forwards_to_outputs(self):
+        server = TCPServer()
+        server.start()
+        args = get_parser().parse_args(['--aggregate', '127.0.0.1:0', '--plugins', 'load', '--hostname', 'agg',
+                                        '--graphite-host', '127.0.0.1', '--graphite-port', str(server.port)])
+        collector = Collector(args)
+        sender = RelaySender('tcp://127.0.0.1:%d' % collector.aggregator.address[1], hostname='gw01')
+        try:
+            sender.send({'dhcpd.active': 7}, timestamp=100)
+            self.assertTrue(sender.flush())
+            self.wait_for(lambda: collector.aggregator.frames)
+            collector.run(force=True)
+            self.wait_for(lambda: b'cluster' in server.received)
+        finally:
+            sender.close()
+            collector.close()
+            close_aggregator()
+            server.join()
+
+        lines = server.received.decode('latin-1').splitlines()
+        self.assertIn('freifunk.gw01.dhcpd.active 7 100.0', lines)
+        self.assertTrue(any(line.startswith('freifunk.cluster.dhcpd.active 7 ') for line in lines))
+        self.assertTrue(any(line.startswith('freifunk.cluster.gateways 1 ') for line in lines))
+        self.assertTrue(any(line.startswith('freifunk.agg.load.1 ') for line in lines))
+        self.assertTrue(any(line.startswith('freifunk.agg.telemetry.relay.frames 1 ') for line in lines))
+
+    def test_relayed_metrics_are_filtered(self):
+        args = get_parser().parse_args(['--aggregate', '127.0.0.1:0', '--plugins', 'nonexistent', '--output', 'statsd',
+                                        '--exclude', 'load.*', '--skip-unchanged'])
+        with self.assertLogs('freifunk_telemetry', 'WARNING'):
+            collector = Collector(args)
+        backend = unittest.mock.Mock(name='backend')
+        backend.flush.return_value = True
+        collector.backends = [backend]
+        try:
+            for value in [1, 1]:
+                collector.aggregator._pending = {
+                    ('gw01', 100): {'foo 1 100\nevil.key': value, 'load.1': 0.5},
+                    ('gw02\nevil 1 100\n', 100): {'foo': value},
+                }
+                collector.run(force=True)
+        finally:
+            collector.close()
+            close_aggregator()
+
+        relayed = [(call[1]['hostname'], dict(call[0][0])) for call in backend.send.call_args_list
+                   if call[1].get('hostname') not in (None, 'cluster')]
+        # unchanged values of both gateways are held back on their own
+        self.assertEqual(relayed, [
+            ('gw01', {'foo_1_100_evil.key': 1}),
+            ('gw02_evil_1_100_', {'foo': 1}),
+            ('gw01', {}),
+            ('gw02_evil_1_100_', {}),
+        ])
+
+    def test_spool_is_not_shared_with_graphite(self):
+        with self.assertRaises(SystemExit), unittest.mock.patch('sys.stderr', StringIO()) as stderr:
+            main(['--test', '--output', 'graphite', '--output', 'relay', '--spool', '/nonexistent/spool'])
+        self.assertIn('--spool can only be used with one of', stderr.getvalue())
+
+    def test_cluster_max_age(self):
+        # the gateways' dhcp_leases counts, even if the aggregator doesn't run it
+        args = ['--test', '--plugins', 'load', '--interval', '60']
+        # unchanged values are only sent with every 10th run
+        for extra, max_age in [([], 900), (['--skip-unchanged'], 9000), (['--cluster-max-age', '120'], 120)]:
+            collector = Collector(get_parser().parse_args(args + extra))
+            try:
+                self.assertEqual(collector.cluster_max_age, max_age)
+            finally:
+                collector.close()
+
+
+class FakeGenlSocket:
+    def __init__(self, tables):
+        self.tables = tables
+        self.commands = []
+        self._reply = b''
+
+    def send(self, request):
+        msg_type, flags, seq = struct.unpack_from('=IHHII', request)[1:4]
+        cmd = request[16]
+
+        def message(attrs):
+            payload = struct.pack('=BBH', cmd, 1, 0) + attrs
+            return struct.pack('=IHHII', 16 + len(payload), msg_type, 0, seq, 0) + payload
+
+        if msg_type == 0x10:
+            entries = [nla(1, struct.pack('=H', 0x21))]
+        else:
+            self.commands.append(cmd)
+            entries = self.tables.get(cmd, [])
+        self._reply = b''.join(message(attrs) for attrs in entries)
+        if flags & 0x300:
+            self._reply += struct.pack('=IHHIIi', 20, 3, 0, seq, 0, 0)
+        else:
+            self._reply += struct.pack('=IHHIIi', 36, 2, 0, seq, 0, 0) + request[:16]
+
+    def recv_into(self, buffer):
+        reply, self._reply = self._reply, b''
+        buffer[:len(reply)] = reply
+        return len(reply)
+
+    def close(self):
+        pass
+
+
+class TestBatadv(TestCase):
+    def setUp(self):
+        u8 = lambda value: bytes([value])
+        u32 = lambda value: struct.pack('=I', value)
+        best = nla(22, b'')
+        self.tables = {
+            1: [nla(17, u8(7)) + nla(51, u8(1))],
+            5: [nla(6, u32(3)) + nla(7, b'mesh-vpn\0') + nla(15, b''),
+                nla(6, u32(4)) + nla(7, b'eth1\0')],
+            8: [nla(9, bytes(6)) + nla(6, u32(3)) + nla(25, u8(200)) + best,
+                nla(9, bytes(6)) + nla(6, u32(4)) + nla(25, u8(100)),
+                nla(9, b'\1' * 6) + nla(6, u32(3)) + nla(25, u8(100)) + best],
+            9: [nla(6, u32(3)), nla(6, u32(3)), nla(6, u32(4))],
+            10: [nla(9, b'\2' * 6) + nla(25, u8(180)) + nla(28, u32(500)) + nla(27, u32(100)) + best,
+                 nla(9, b'\3' * 6) + nla(25, u8(150))],
+            6: [nla(21, u32(0x100)), nla(21, u32(0)), nla(21, u32(0x10))],
+            7: [nla(21, u32(0)) + best, nla(21, u32(0)), nla(21, u32(0x12)) + best],
+        }
+        self.sock = FakeGenlSocket(self.tables)
+        self.batadv = BatadvNetlink(sock=self.sock)
+        self.state = MeshState()
+
+    def read(self, now):
+        update = {}
+        read_mesh(self.batadv, 'bat0', 5, self.state, update, now)
+        return update
+
+    def test_read_mesh(self):
+        self.assertEqual(self.read(0), {
+            'batadv.ffda-bat.gateways.mode': 1,
+            'batadv.ffda-bat.originators': 2,
+            'batadv.ffda-bat.neighbours': 3,
+            'batadv.ffda-bat.hardif.mesh-vpn.active': 1,
+            'batadv.ffda-bat.hardif.mesh-vpn.neighbours': 2,
+            'batadv.ffda-bat.hardif.mesh-vpn.originators': 2,
+            'batadv.ffda-bat.hardif.mesh-vpn.tq.mean': 150,
+            'batadv.ffda-bat.hardif.eth1.active': 0,
+            'batadv.ffda-bat.hardif.eth1.neighbours': 1,
+            'batadv.ffda-bat.hardif.eth1.originators': 0,
+            'batadv.ffda-bat.gateways.count': 2,
+            'batadv.ffda-bat.gateways.selected': 1,
+            'batadv.ffda-bat.gateways.changes': 0,
+            'batadv.ffda-bat.gateways.selected.tq': 180,
+            'batadv.ffda-bat.gateways.selected.bandwidth_down': 50000,
+            'batadv.ffda-bat.gateways.selected.bandwidth_up': 10000,
+            'batadv.ffda-bat.clients.local': 2,
+            'batadv.ffda-bat.clients.local_wifi': 1,
+            'batadv.ffda-bat.clients.global': 2,
+            'batadv.ffda-bat.clients.global_entries': 3,
+            'batadv.ffda-bat.clients.roaming': 1,
+            'batadv.ffda-bat.clients.wifi': 1,
+        })
+
+    def test_translation_tables_are_cached(self):
+        self.read(0)
+        self.assertIn(6, self.sock.commands)
+        self.assertIn(7, self.sock.commands)
+
+        # same table version and originators, the tables are not dumped again
+        del self.sock.commands[:]
+        update = self.read(10)
+        self.assertNotIn(6, self.sock.commands)
+        self.assertNotIn(7, self.sock.commands)
+        self.assertEqual(update['batadv.ffda-bat.clients.local'], 2)
+        self.assertEqual(update['batadv.ffda-bat.clients.global'], 2)
+
+        # a new local client bumps the table version
+        self.tables[1] = [nla(17, bytes([8]))]
+        self.tables[6].append(nla(21, bytes(4)))
+        # and another gateway is selected
+        self.tables[10] = [nla(9, b'\3' * 6) + nla(25, bytes([150])) + nla(22, b'')]
+        update = self.read(20)
+        self.assertEqual(self.sock.commands.count(6), 1)
+        self.assertNotIn(7, self.sock.commands)
+        self.assertEqual(update['batadv.ffda-bat.clients.local'], 3)
+        self.assertEqual(update['batadv.ffda-bat.gateways.changes'], 1)
+
+        # the global table is refreshed eventually
+        update = self.read(400)
+        self.assertIn(7, self.sock.commands)
+
+
+class TestInterfaceSampler(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        for name in ['tun-ffrl-ber', 'bat0', 'eth0']:
+            os.makedirs(os.path.join(self.directory.name, name, 'statistics'))
+            self.set_counters(name, 0, 0)
+        self.sampler = InterfaceSampler(['tun-*', 'bat0'], interval=1, capacity=4, sysfs=self.directory.name)
+        self.addCleanup(self.sampler.close)
+
+    def set_counters(self, name, rx_bytes, tx_bytes):
+        for counter, value in [('rx_bytes', rx_bytes), ('tx_bytes', tx_bytes), ('rx_packets', 0),
+                               ('tx_packets', 0)]:
+            with open(os.path.join(self.directory.name, name, 'statistics', counter), 'w') as fh:
+                fh.write('%d\n' % value)
+
+    def test_summarize(self):
+        self.assertEqual(summarize([float(i) for i in range(100, 0, -1)]), (1, 100, 50.5, 95))
+        self.assertEqual(summarize([3.0]), (3, 3, 3, 3))
+
+    def test_report(self):
+        self.assertEqual(self.sampler.report(), {})
+        for now, rx_bytes in enumerate([0, 100, 300, 300, 1300]):
+            self.set_counters('tun-ffrl-ber', rx_bytes, 2 * rx_bytes)
+            self.set_counters('eth0', rx_bytes, rx_bytes)
+            self.sampler.sample(now)
+
+        update = self.sampler.report()
+        self.assertEqual(update['tun-ffrl-ber.rx.bytes.rate.min'], 0)
+        self.assertEqual(update['tun-ffrl-ber.rx.bytes.rate.max'], 1000)
+        self.assertEqual(update['tun-ffrl-ber.rx.bytes.rate.mean'], 325)
+        self.assertEqual(update['tun-ffrl-ber.rx.bytes.rate.p95'], 1000)
+        self.assertEqual(update['tun-ffrl-ber.tx.bytes.rate.max'], 2000)
+        self.assertEqual(update['ffda-bat.rx.bytes.rate.max'], 0)
+        self.assertNotIn('eth0.rx.bytes.rate.max', update)
+        self.assertEqual(self.sampler.report(), {})
+
+    def test_ring_buffer_and_resets(self):
+        # six rates into a ring of four, the oldest two are overwritten
+        for now, rx_bytes in enumerate([0, 1000, 1000, 1100, 1200, 1300, 50]):
+            self.set_counters('tun-ffrl-ber', rx_bytes, 0)
+            self.sampler.sample(now)
+
+        update = self.sampler.report()
+        # the counter was reset in the last one
+        self.assertEqual(update['tun-ffrl-ber.rx.bytes.rate.min'], 100)
+        self.assertEqual(update['tun-ffrl-ber.rx.bytes.rate.max'], 100)
+
+    def test_interfaces_are_looked_up_again(self):
+        with unittest.mock.patch('freifunk_telemetry.sampler.DISCOVER_EVERY', 3):
+            for now in range(3):
+                self.sampler.sample(now)
+            shutil.rmtree(os.path.join(self.directory.name, 'bat0'))
+            os.makedirs(os.path.join(self.directory.name, 'tun-ffrl-fra', 'statistics'))
+            self.set_counters('tun-ffrl-fra', 0, 0)
+            for now, rx_bytes in [(3, 10), (4, 30), (5, 60)]:
+                self.set_counters('tun-ffrl-fra', rx_bytes, 0)
+                self.sampler.sample(now)
+
+        update = self.sampler.report()
+        self.assertEqual(update['tun-ffrl-fra.rx.bytes.rate.min'], 20)
+        self.assertEqual(update['tun-ffrl-fra.rx.bytes.rate.max'], 30)
+        self.assertIn('tun-ffrl-ber.rx.bytes.rate.max', update)
+        self.assertNotIn('ffda-bat.rx.bytes.rate.max', update)
+
+    def test_capacity_follows_the_reporting_interval(self):
+        # reported every 60s, when the only plugin runs, not every --interval
+        args = get_parser().parse_args(['--test', '--plugins', 'load', '--plugin-interval', 'load=60',
+                                        '--interval', '10', '--fast-interface', 'tun-*', '--fast-interval', '1'])
+        with unittest.mock.patch('freifunk_telemetry.get_sampler') as get_sampler:
+            collector = Collector(args)
+            collector.close()
+        get_sampler.assert_called_once_with(['tun-*'], 1, 121)
+
+
+class TestTimeSeriesStore(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.filename = os.path.join(self.tmpdir.name, 'store')
+
+    def test_ring_and_persistence(self):
+        store = TimeSeriesStore(self.filename, slots=4, max_series=8)
+        for timestamp in range(100, 160, 10):
+            store.send({'load.1': timestamp / 100}, timestamp)
+        store.send({'peers': 3}, 150, hostname='gw02')
+        store.close()
+
+        store = TimeSeriesStore(self.filename, slots=4, max_series=8)
+        try:
+            self.assertEqual(store.keys(), ['load.1', 'gw02.peers'])
+            # six values into four slots, the oldest two are gone
+            self.assertEqual(store.read('load.1'), [(120, 1.2), (130, 1.3), (140, 1.4), (150, 1.5)])
+            self.assertEqual(store.read('load.1', since=130, until=140), [(130, 1.3), (140, 1.4)])
+            self.assertEqual(store.read('gw02.peers'), [(150, 3)])
+            self.assertEqual(store.read('unknown'), [])
+        finally:
+            store.close()
+
+    def test_bounded(self):
+        store = TimeSeriesStore(self.filename, slots=4, max_series=2)
+        try:
+            for timestamp in range(100):
+                store.send({'a': timestamp, 'b': timestamp, 'c': timestamp, 'x' * 200: 1, 'text': 'foo'}, timestamp)
+            self.assertEqual(store.keys(), ['a', 'b'])
+            self.assertEqual(store.dropped, 200)
+            self.assertEqual(store.sent_metrics, 200)
+        finally:
+            store.close()
+        self.assertEqual(os.path.getsize(self.filename), file_size(4, 2))
+
+    def test_reader_sees_new_series(self):
+        store = TimeSeriesStore(self.filename, slots=4, max_series=8)
+        reader = TimeSeriesStore(self.filename, readonly=True)
+        try:
+            self.assertEqual((reader.slots, reader.max_series), (4, 8))
+            self.assertEqual(reader.keys(), [])
+            store.send({'foo': 1}, 100)
+            self.assertEqual(reader.keys(), ['foo'])
+            self.assertEqual(reader.read('foo'), [(100, 1)])
+        finally:
+            reader.close()
+            store.close()
+
+    def test_other_size_starts_over(self):
+        store = TimeSeriesStore(self.filename, slots=4, max_series=8)
+        store.send({'foo': 1}, 100)
+        store.close()
+
+        with self.assertLogs('freifunk_telemetry.store', 'WARNING'):
+            store = TimeSeriesStore(self.filename, slots=8, max_series=8)
+        try:
+            self.assertEqual(store.keys(), [])
+        finally:
+            store.close()
+        self.assertEqual(os.path.getsize(self.filename), file_size(8, 8))
+
+    def test_query(self):
+        store = TimeSeriesStore(self.filename, slots=8, max_series=8)
+        try:
+            for timestamp, rx_bytes in [(940, 0), (960, 600), (980, 1800), (1000, 100)]:
+                store.send({'bat0.rx.bytes': rx_bytes, 'load.1': 0.5}, timestamp)
+        finally:
+            store.close()
+
+        out = StringIO()
+        with unittest.mock.patch('freifunk_telemetry.time.time', lambda: 1000):
+            run_query([self.filename, 'bat0.*', '--since', '1m', '--rate'], out)
+        # the counter was reset in the last interval
+        self.assertEqual(out.getvalue(), 'bat0.rx.bytes 30.0 960\nbat0.rx.bytes 60.0 980\n')
+
+        out = StringIO()
+        with unittest.mock.patch('freifunk_telemetry.time.time', lambda: 1000):
+            run_query([self.filename, '--since', '30s', '--until', '10s'], out)
+        self.assertEqual(out.getvalue(), 'bat0.rx.bytes 1800.0 980\nload.1 0.5 980\n')
+
+    def test_collector_writes_store(self):
+        args = get_parser().parse_args(['--plugins', 'load', '--output', 'statsd', '--store', self.filename,
+                                        '--store-hours', '1', '--interval', '10'])
+        collector = Collector(args)
+        try:
+            collector.run(force=True)
+            store = collector.backends[-1]
+            self.assertEqual(store.slots, 360)
+            self.assertIn('load.1', store.keys())
+            self.assertIn('telemetry.backends.store.metrics', store.keys())
+        finally:
+            collector.close()
+
+        # written whenever the only plugin runs, every 30s
+        args = get_parser().parse_args(['--plugins', 'load', '--plugin-interval', 'load=30', '--output', 'statsd',
+                                        '--store', self.filename, '--store-hours', '1', '--interval', '10'])
+        collector = Collector(args)
+        try:
+            self.assertEqual(collector.backends[-1].slots, 120)
+        finally:
+            collector.close()